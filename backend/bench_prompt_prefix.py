@@ -0,0 +1,109 @@
+# backend/bench_prompt_prefix.py
+"""
+比較回測訊號 prompt 兩種排法在 Ollama 上的 prompt 計算時間
+  - interleaved: 舊版，人格 / 任務 / 數據混在同一個 user 訊息，每天的 prompt 幾乎沒有相同的開頭
+  - prefix:      新版，固定的 system (人格 + 任務 + JSON 格式) 在前，當天數據的 user 在後，
+                 Ollama 可以沿用上一個請求相同前綴的 KV 快取，只需要計算後面的數據
+
+用法 (需要本機或遠端的 Ollama):
+    python bench_prompt_prefix.py --stock 2330 --model gemma3:12b --days 30
+"""
+import argparse
+import time
+import requests
+from services.stock_service import StockService
+from services.ai_service import AIService
+
+# 舊版的訊號 prompt (數據夾在人格與任務中間)
+LEGACY_SIGNAL_PROMPT = """
+        {persona}
+        
+        請根據提供的股票數據進行分析。
+        股票代號: {stock_id}
+        數據摘要: {context_data}
+
+        任務：
+        1. 判斷是否適合進場（做多 Long 或 觀望 Hold）。
+        2. 如果做多，給出明確的進場價、停損價、停利價。
+        3. 嚴格輸出 JSON 格式，不要包含 Markdown 標記。
+
+        JSON 格式範例：
+        {{
+            "action": "BUY", 
+            "entry_price": 100.5,
+            "stop_loss": 95.0,
+            "take_profit": 110.0,
+            "reason": "依據激進策略，突破前高進場"
+        }}
+        """
+
+
+def build_payloads(ai: AIService, layout: str, model: str, stock_id: str, contexts: list, style: str) -> list:
+    payloads = []
+    for context in contexts:
+        if layout == "prefix":
+            system, user = ai.signal_messages(stock_id, context, style)
+            payload = ai._ollama_payload(model, user, json_mode=True, system=system)
+        else:
+            persona = ai.PROMPT_TEMPLATES.get(style, ai.PROMPT_TEMPLATES["balanced"])
+            prompt = LEGACY_SIGNAL_PROMPT.format(persona=persona, stock_id=stock_id, context_data=context)
+            payload = ai._ollama_payload(model, prompt, json_mode=True)
+        # 只量 prompt 計算，不需要真的產生回覆
+        payload["options"]["num_predict"] = 1
+        payloads.append(payload)
+    return payloads
+
+
+def run_layout(session: requests.Session, url: str, payloads: list) -> dict:
+    stats = {"requests": 0, "prompt_tokens": 0, "prompt_eval_s": 0.0, "wall_s": 0.0}
+    for payload in payloads:
+        start = time.time()
+        res = session.post(f"{url}/api/chat", json=payload, timeout=600)
+        res.raise_for_status()
+        data = res.json()
+        stats["wall_s"] += time.time() - start
+        stats["requests"] += 1
+        # prompt_eval_count 只算實際計算的 token (命中前綴快取的不算)
+        stats["prompt_tokens"] += data.get("prompt_eval_count", 0)
+        stats["prompt_eval_s"] += data.get("prompt_eval_duration", 0) / 1e9
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prompt 前綴快取效益測試")
+    parser.add_argument("--stock", default="2330")
+    parser.add_argument("--model", default="gemma3:12b")
+    parser.add_argument("--ollama-url", default="http://localhost:11434")
+    parser.add_argument("--style", default="balanced")
+    parser.add_argument("--days", type=int, default=30, help="模擬回測最後幾天的請求")
+    args = parser.parse_args()
+
+    stock_service = StockService()
+    ai = AIService()
+    url = args.ollama_url.rstrip("/")
+
+    df = stock_service.calculate_indicators(stock_service.fetch_data(args.stock))
+    # 跟回測一樣：第 i 天只看得到 i 以前的資料
+    contexts = [stock_service.get_technical_summary(df.iloc[:i + 1])["context_str"] for i in range(len(df) - args.days, len(df))]
+
+    session = requests.Session()
+    # 先載入模型，避免第一組吃到載入時間
+    session.post(f"{url}/api/chat", json={"model": args.model, "messages": [], "keep_alive": ai.OLLAMA_KEEP_ALIVE}, timeout=600)
+
+    results = {}
+    for layout in ("interleaved", "prefix"):
+        payloads = build_payloads(ai, layout, args.model, args.stock, contexts, args.style)
+        results[layout] = run_layout(session, url, payloads)
+
+    print(f"{'layout':<12} {'requests':>8} {'prompt tokens':>14} {'prompt eval (s)':>16} {'wall (s)':>10}")
+    for layout, r in results.items():
+        print(f"{layout:<12} {r['requests']:>8} {r['prompt_tokens']:>14} {r['prompt_eval_s']:>16.2f} {r['wall_s']:>10.2f}")
+
+    old, new = results["interleaved"], results["prefix"]
+    if old["prompt_eval_s"] > 0:
+        saved = (1 - new["prompt_eval_s"] / old["prompt_eval_s"]) * 100
+        print(f"prompt 計算時間節省 {saved:.1f}% ({old['prompt_eval_s'] - new['prompt_eval_s']:.2f} 秒 / {args.days} 天)")
+
+
+if __name__ == "__main__":
+    main()
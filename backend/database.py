@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
@@ -32,7 +32,28 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 # 5. 建立 Base 類別 (給 models.py 繼承用)
 Base = declarative_base()
 
-# 6. 依賴注入函數 (給 FastAPI 的路由使用)
+# 6. 補上既有資料表缺少的欄位
+# create_all 只會建立不存在的資料表，不會幫舊表加欄位；這裡把 models 新增的欄位 (皆可為 NULL) 補進去
+def add_missing_columns(metadata):
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                col_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}'))
+                print(f"Add column {table.name}.{column.name}")
+
+    # 新欄位的索引
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+# 7. 依賴注入函數 (給 FastAPI 的路由使用)
 def get_db():
     db = SessionLocal()
     try:
@@ -6,18 +6,24 @@ import json
 import hashlib
 
 # 匯入我們剛寫好的模組
-from database import get_db, engine
+from database import get_db, engine, add_missing_columns, SessionLocal
 import models
 import schemas
 from services.stock_service import StockService
 from services.ai_service import AIService
 from services.backtest_service import BacktestService
 from services.chip_service import ChipService
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from services.report_service import ReportService
+from services.portfolio_service import PortfolioService
+from services.monte_carlo_service import MonteCarloService
+from services.walk_forward_service import WalkForwardService
+from services.retention_service import RetentionService
+from services.llm_resilience import LLMRetryLaterError
 
 # 初始化 DB
 models.Base.metadata.create_all(bind=engine)
+add_missing_columns(models.Base.metadata)
 
 app = FastAPI()
 
@@ -28,6 +34,18 @@ ai_service = AIService()
 backtest_service = BacktestService()
 chip_service = ChipService()
 report_service = ReportService()
+portfolio_service = PortfolioService()
+monte_carlo_service = MonteCarloService()
+walk_forward_service = WalkForwardService()
+retention_service = RetentionService()
+
+# 舊的回測紀錄補上摘要欄位，並建立模型排行榜 (只有第一次啟動會有事做)
+with SessionLocal() as _db:
+    backtest_service.backfill_records(_db)
+
+# 背景定期去重、封存舊的回測紀錄
+retention_service.start_background(SessionLocal)
+
 # --- 工具函式：SHA256 加密 ---
 def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
@@ -77,6 +95,17 @@ def login(user_data: schemas.UserLogin, db: Session = Depends(get_db)):
         
     return user
 
+def build_chart_data(df_calculated) -> dict:
+    # 將 DataFrame 索引轉為字串以便 JSON 傳輸
+    chart_data = df_calculated.reset_index()
+    chart_data['Date'] = chart_data['Date'].astype(str) 
+    # 為了傳輸效率，通常只回傳最近 100-200 筆，或全部回傳視需求而定
+    return chart_data.tail(150).to_dict(orient='list')
+
+def sse_event(event: str, data) -> str:
+    # Server-Sent Events 格式：event 名稱 + 一行 JSON
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
 @app.post("/api/analyze", response_model=schemas.StockAnalysisResponse)
 def analyze_stock(req: schemas.StockAnalysisRequest, db: Session = Depends(get_db)):
     try:
@@ -98,7 +127,8 @@ def analyze_stock(req: schemas.StockAnalysisRequest, db: Session = Depends(get_d
             provider=req.provider,     
             model_name=req.model_name,  
             ollama_url=req.ollama_url,
-            prompt_style=req.prompt_style
+            prompt_style=req.prompt_style,
+            force_refresh=req.force_refresh
         )
 
         # 4. 存入資料庫 (PostgreSQL)
@@ -115,11 +145,7 @@ def analyze_stock(req: schemas.StockAnalysisRequest, db: Session = Depends(get_d
         db.refresh(db_log)
 
         # 5. 準備回傳給前端的圖表數據
-        # 將 DataFrame 索引轉為字串以便 JSON 傳輸
-        chart_data = df_calculated.reset_index()
-        chart_data['Date'] = chart_data['Date'].astype(str) 
-        # 為了傳輸效率，通常只回傳最近 100-200 筆，或全部回傳視需求而定
-        chart_data_dict = chart_data.tail(150).to_dict(orient='list')
+        chart_data_dict = build_chart_data(df_calculated)
 
         return schemas.StockAnalysisResponse(
             stock_id=req.stock_id,
@@ -133,7 +159,113 @@ def analyze_stock(req: schemas.StockAnalysisRequest, db: Session = Depends(get_d
         raise HTTPException(status_code=404, detail=str(ve))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"系統錯誤: {str(e)}")
-    
+
+@app.post("/api/analyze/stream")
+def analyze_stock_stream(req: schemas.StockAnalysisRequest):
+    """
+    串流版的 /api/analyze (text/event-stream)
+    事件順序: summary (技術數據與圖表，算完指標馬上送) -> token (AI 報告片段，多次) -> done (分析紀錄 id) / error
+    """
+    try:
+        df = stock_service.fetch_data(req.stock_id)
+        df_calculated = stock_service.calculate_indicators(df)
+        summary = stock_service.get_technical_summary(df_calculated)
+        chart_data_dict = build_chart_data(df_calculated)
+    except ValueError as ve:
+        raise HTTPException(status_code=404, detail=str(ve))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"系統錯誤: {str(e)}")
+
+    def event_stream():
+        yield sse_event("summary", {
+            "stock_id": req.stock_id,
+            "current_price": float(summary["close"]),
+            "trend": summary["trend"],
+            "technical_data": chart_data_dict
+        })
+
+        parts = []
+        try:
+            for chunk in ai_service.stream_analysis(
+                api_key=req.api_key,
+                stock_id=req.stock_id,
+                stock_name=req.stock_name,
+                mode=req.mode,
+                cost=req.cost,
+                context_data=summary["context_str"],
+                provider=req.provider,
+                model_name=req.model_name,
+                ollama_url=req.ollama_url,
+                prompt_style=req.prompt_style,
+                force_refresh=req.force_refresh
+            ):
+                parts.append(chunk)
+                yield sse_event("token", {"text": chunk})
+        except LLMRetryLaterError as e:
+            # AI 暫時無法使用：送出錯誤事件，不寫入分析紀錄
+            yield sse_event("error", {"detail": f"AI 暫時無法使用，請稍後再試: {e}", "retry_after": e.retry_after})
+            return
+        except ValueError as ve:
+            yield sse_event("error", {"detail": str(ve)})
+            return
+        except Exception as e:
+            yield sse_event("error", {"detail": f"AI 分析失敗: {str(e)}"})
+            return
+
+        # 串流結束後才寫入分析紀錄 (請求的 db session 在回應開始時就可能關閉，這裡自己開)
+        db = SessionLocal()
+        try:
+            db_log = models.AnalysisLog(
+                user_id=req.user_id,
+                stock_id=req.stock_id,
+                mode=req.mode,
+                cost_price=req.cost,
+                current_price=float(summary["close"]),
+                ai_advice="".join(parts)
+            )
+            db.add(db_log)
+            db.commit()
+            yield sse_event("done", {"log_id": db_log.id})
+        except Exception as e:
+            db.rollback()
+            yield sse_event("error", {"detail": f"系統錯誤: {str(e)}"})
+        finally:
+            db.close()
+
+    # X-Accel-Buffering: 經過 nginx 反向代理時不要緩衝，片段才會即時送到前端
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/api/llm/metrics")
+def get_llm_metrics():
+    # 每個 (Ollama 網址, 模型) 的執行中/排隊數、排隊時間與模型載入次數
+    return {
+        **ai_service.scheduler.metrics(),
+        "clients": ai_service.clients.stats(),
+        # 每個端點的斷路器狀態與對沖次數
+        "resilience": ai_service.resilience.metrics(),
+        # Ollama 端點池各節點的健康狀態、進行中請求與已載入模型
+        "endpoints": ai_service.pool.stats()
+    }
+
+@app.get("/api/llm/cache")
+def get_llm_cache_stats():
+    # AI 文字報告快取的筆數、容量與命中次數
+    return ai_service.cache.stats()
+
+@app.get("/api/llm/usage")
+def get_llm_usage(group_by: str = "model_style", since_days: int = 7, call_type: str = None, db: Session = Depends(get_db)):
+    # 每個模型/風格的呼叫次數、token、排隊/首 token/總耗時；交易訊號另外算每次回測與每 1% 報酬的成本
+    ai_service.usage.flush()
+    try:
+        return {
+            "since_days": since_days,
+            "dropped": ai_service.usage.dropped,
+            "rows": ai_service.usage.summary(db, group_by, since_days, call_type)
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 
 @app.post("/api/screen", response_model=List[schemas.ScreenResult])
 def screen_stocks(req: schemas.ScreenRequest, db: Session = Depends(get_db)):
@@ -206,17 +338,177 @@ def run_backtest_api(req: schemas.BacktestRequest, db: Session = Depends(get_db)
             initial_capital=req.initial_capital,
             provider=req.provider,      # <--- 傳入
             model_name=req.model_name,   # <--- 傳入
-            prompt_style=req.prompt_style
+            ollama_url=req.ollama_url,
+            prompt_style=req.prompt_style,
+            roll_window=req.roll_window,
+            gate=req.gate,
+            prefetch_window=req.prefetch_window
         )
+        if result.get("retry_later"):
+            # AI 端點暫時無法使用，進度已存檔，前端稍後重送同一個請求即可接續
+            retry_after = result.get("retry_after")
+            headers = {"Retry-After": str(int(retry_after) + 1)} if retry_after else None
+            raise HTTPException(status_code=503, detail=result["error"], headers=headers)
         return result
+    except HTTPException:
+        raise
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail=str(e))
     
+@app.post("/api/backtest/rule")
+def run_rule_backtest_api(req: schemas.RuleBacktestRequest, db: Session = Depends(get_db)):
+    try:
+        return backtest_service.run_rule_backtest(
+            db=db,
+            stock_id=req.stock_id,
+            strategies=req.strategies,
+            initial_capital=req.initial_capital,
+            stop_loss_pct=req.stop_loss_pct,
+            take_profit_pct=req.take_profit_pct
+        )
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/backtest/rule/universe")
+def run_rule_backtest_universe_api(req: schemas.RuleUniverseBacktestRequest):
+    try:
+        tickers = stock_service.resolve_tickers(req.scope, req.custom_tickers)
+        return backtest_service.run_rule_backtest_universe(
+            tickers=tickers,
+            strategies=req.strategies,
+            initial_capital=req.initial_capital,
+            stop_loss_pct=req.stop_loss_pct,
+            take_profit_pct=req.take_profit_pct,
+            period=req.period
+        )
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/backtest/replay")
+def replay_backtest_api(req: schemas.BacktestReplayRequest, db: Session = Depends(get_db)):
+    try:
+        return backtest_service.replay_backtest(
+            db=db,
+            record_id=req.record_id,
+            initial_capital=req.initial_capital,
+            order_expiry=req.order_expiry,
+            hold_cooldown=req.hold_cooldown,
+            cash_ratio=req.cash_ratio,
+            fee_rate=req.fee_rate,
+            tax_rate=req.tax_rate
+        )
+    except ValueError as ve:
+        raise HTTPException(status_code=404, detail=str(ve))
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/backtest/replay/grid")
+def replay_backtest_grid_api(req: schemas.BacktestReplayGridRequest, db: Session = Depends(get_db)):
+    try:
+        return backtest_service.replay_grid(
+            db=db,
+            record_id=req.record_id,
+            grid=req.grid,
+            initial_capital=req.initial_capital
+        )
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/backtest/portfolio")
+def run_portfolio_backtest_api(req: schemas.PortfolioBacktestRequest, db: Session = Depends(get_db)):
+    try:
+        return portfolio_service.run_portfolio_backtest(
+            db=db,
+            ticker_configs=[t.model_dump() for t in req.tickers],
+            initial_capital=req.initial_capital,
+            sizing=req.sizing,
+            max_positions=req.max_positions,
+            position_pct=req.position_pct,
+            period=req.period
+        )
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/backtest/walkforward")
+def run_walk_forward_api(req: schemas.WalkForwardRequest):
+    try:
+        return walk_forward_service.run(
+            stock_id=req.stock_id,
+            configs=[c.model_dump() for c in req.configs],
+            initial_capital=req.initial_capital,
+            period=req.period,
+            train_days=req.train_days,
+            test_days=req.test_days,
+            step_days=req.step_days,
+            api_key=req.api_key,
+            ollama_url=req.ollama_url
+        )
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/backtest/montecarlo")
+def run_monte_carlo_api(req: schemas.MonteCarloRequest, db: Session = Depends(get_db)):
+    try:
+        return monte_carlo_service.run(
+            db=db,
+            record_ids=req.record_ids,
+            stock_id=req.stock_id,
+            n_paths=req.n_paths,
+            method=req.method,
+            ruin_pct=req.ruin_pct,
+            seed=req.seed
+        )
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"系統錯誤: {str(e)}")
+
 @app.get("/api/backtest/history", response_model=List[schemas.BacktestHistoryItem])
-def get_backtest_history(stock_id: str = None, db: Session = Depends(get_db)):
+def get_backtest_history(stock_id: str = None, with_metrics: bool = True, db: Session = Depends(get_db)):
     # 如果前端有傳 stock_id 就篩選，沒有就回傳全部
-    return backtest_service.get_history(db, stock_id)
+    return backtest_service.get_history(db, stock_id, with_metrics)
+
+@app.get("/api/backtest/leaderboard")
+def get_backtest_leaderboard(stock_id: str = None, limit: int = 10, include_rule: bool = False, db: Session = Depends(get_db)):
+    # 有 stock_id 回傳該股最佳設定；沒有則彙整所有股票，依模型/風格的平均報酬排名
+    return backtest_service.get_leaderboard(db, stock_id, limit, include_rule)
+
+@app.post("/api/backtest/compact")
+def compact_backtests_api(db: Session = Depends(get_db)):
+    # 立即執行一次去重與封存 (平常由背景執行緒定期處理)
+    return retention_service.compact(db)
+
+@app.get("/api/backtest/archives")
+def get_backtest_archives(stock_id: str = None, db: Session = Depends(get_db)):
+    return retention_service.get_archives(db, stock_id)
+
+@app.get("/api/backtest/archives/{archive_id}")
+def get_backtest_archive(archive_id: int, db: Session = Depends(get_db)):
+    archive = retention_service.load_archive(db, archive_id)
+    if archive is None:
+        raise HTTPException(status_code=404, detail="找不到封存紀錄")
+    return archive
+
+@app.get("/api/backtest/records/{record_id}/curve")
+def get_backtest_curve(record_id: int, db: Session = Depends(get_db)):
+    # 資產曲線與交易明細 (歷史列表只回傳摘要，點選某筆紀錄時才查)
+    curve = backtest_service.get_curve(db, record_id)
+    if curve is None:
+        raise HTTPException(status_code=404, detail="找不到回測紀錄")
+    return curve
 
 @app.get("/api/backtest/stocks", response_model=List[str])
 def get_backtest_stock_list(db: Session = Depends(get_db)):
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Text, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, Text, DateTime, ForeignKey, LargeBinary, Index, Boolean
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -60,13 +60,143 @@ class BacktestRecord(Base):
     strategy_name = Column(String)  # 例如 "AI_Gemini_Flash"
     initial_capital = Column(Float)
     
-    # 儲存完整的統計結果 (JSON 轉字串存入)
-    # 包含: final_balance, total_return, trades_list, equity_curve
+    # 儲存統計摘要 (JSON 轉字串存入)
+    # 包含: final_equity, total_return_pct, sim_state, signal_set_id ...
+    # 資產曲線與交易明細另外存在 backtest_curves (舊資料可能還是整包存在這裡)
     result_data = Column(Text) 
+
+    # 常用的績效數字獨立成欄位，列表查詢不用解析 JSON
+    final_equity = Column(Float, nullable=True)
+    total_return_pct = Column(Float, nullable=True, index=True)
+    trade_count = Column(Integer, nullable=True)
+
+    # 從 strategy_name 拆出來的設定 (規則型回測的 provider 為 "rule")，方便依模型/風格查詢
+    provider = Column(String(20), nullable=True, index=True)
+    model_name = Column(String(100), nullable=True, index=True)
+    prompt_style = Column(String(50), nullable=True, index=True)
+
+    # 結果內容的雜湊 (SHA-256)，同樣的回測結果不重複存
+    content_hash = Column(String(64), nullable=True, index=True)
+
+    # 快取版本：價格資料快照、prompt 模板版本、撮合引擎版本都一樣才能沿用結果
+    data_snapshot_id = Column(String(32), nullable=True, index=True)
+    prompt_version = Column(String(32), nullable=True)
+    engine_version = Column(String(16), nullable=True)
     
     # 建立時間 (用來判斷快取是否過期，例如超過 1 天就重跑)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        # 某檔股票報酬率前幾名
+        Index("ix_backtest_records_stock_return", "stock_id", "total_return_pct"),
+    )
+
+class BacktestArchive(Base):
+    """
+    回測封存 (backtest_archives)
+    超過保留筆數的舊紀錄從 backtest_records 搬到這裡：完整結果 (含資產曲線、交易與 AI 訊號) 以 zlib 壓縮存放，
+    讓常用的資料表保持精簡
+    """
+    __tablename__ = "backtest_archives"
+
+    id = Column(Integer, primary_key=True, index=True)
+    record_id = Column(Integer, index=True)  # 原本 backtest_records 的 id
+    stock_id = Column(String(20), index=True)
+    strategy_name = Column(String)
+    initial_capital = Column(Float)
+    total_return_pct = Column(Float)
+    content_hash = Column(String(64))
+    payload = Column(LargeBinary)  # zlib 壓縮的 JSON
+    created_at = Column(DateTime(timezone=True))  # 原本紀錄的建立時間
+    archived_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class BacktestLeaderboard(Base):
+    """
+    模型排行榜 (backtest_leaderboard)
+    每檔股票、每種策略設定只留一列 (最新一次回測的結果)，存檔時同步更新，
+    報告與儀表板要找最佳模型時直接用索引取前幾名
+    """
+    __tablename__ = "backtest_leaderboard"
+
+    id = Column(Integer, primary_key=True, index=True)
+    stock_id = Column(String(20))
+    strategy_name = Column(String)
+    provider = Column(String(20), index=True)
+    model_name = Column(String(100))
+    prompt_style = Column(String(50))
+
+    record_id = Column(Integer, ForeignKey("backtest_records.id"))
+    initial_capital = Column(Float)
+    final_equity = Column(Float)
+    total_return_pct = Column(Float, index=True)
+    trade_count = Column(Integer)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index("ix_backtest_leaderboard_key", "stock_id", "strategy_name", unique=True),
+        Index("ix_backtest_leaderboard_stock_return", "stock_id", "total_return_pct"),
+        Index("ix_backtest_leaderboard_config", "provider", "model_name", "prompt_style"),
+    )
+
+class BacktestCurve(Base):
+    """
+    回測資產曲線與交易明細 (backtest_curves)
+    資產曲線用緊湊的二進位格式儲存：
+      - date_offsets: int32 陣列，距離 base_date 的天數
+      - equity_deltas: float32 陣列，每天資產 - equity_base
+    只有在儀表板真的要畫圖時才讀取
+    """
+    __tablename__ = "backtest_curves"
+
+    id = Column(Integer, primary_key=True, index=True)
+    record_id = Column(Integer, ForeignKey("backtest_records.id"), unique=True, index=True)
+
+    base_date = Column(String(10))      # 第一天 (YYYY-MM-DD)
+    equity_base = Column(Float)         # 第一天的資產
+    date_offsets = Column(LargeBinary)
+    equity_deltas = Column(LargeBinary)
+
+    # 交易明細 (JSON 字串)
+    trades_data = Column(Text)
+
+class BacktestSignalSet(Base):
+    """
+    回測訊號紀錄 (backtest_signal_sets)
+    保存回測期間每次詢問 AI 的原始回覆，之後換執行參數可以直接重播，不用再呼叫 AI
+    """
+    __tablename__ = "backtest_signal_sets"
+
+    id = Column(Integer, primary_key=True, index=True)
+    stock_id = Column(String, index=True)
+    strategy_name = Column(String)
+
+    # 訊號列表 (JSON 字串)，每筆: date, action, entry_price, stop_loss, take_profit, reason
+    signals = Column(Text)
+
+    # 訊號只跟價格資料與 prompt 有關，兩者都沒變才能沿用
+    data_snapshot_id = Column(String(32), nullable=True)
+    prompt_version = Column(String(32), nullable=True)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class BacktestCheckpoint(Base):
+    """
+    回測中途存檔 (backtest_checkpoints)
+    回測跑到一半中斷 (後端重啟、AI 逾時...) 時，下次從這裡接續，不用重新呼叫 AI
+    """
+    __tablename__ = "backtest_checkpoints"
+
+    id = Column(Integer, primary_key=True, index=True)
+    stock_id = Column(String, index=True)
+    strategy_name = Column(String)
+    initial_capital = Column(Float)
+
+    # 模擬器狀態 (JSON 字串)
+    # 包含: balance, position, pending_order, ai_cooldown, trades, equity_curve, next_date
+    state_data = Column(Text)
+
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
 class ChipDaily(Base):
     """
     籌碼日報表 (chip_daily)
@@ -94,4 +224,57 @@ class ChipDaily(Base):
     dealer_sell = Column(Float, default=0)
     dealer_net = Column(Float, default=0)
     
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
\ No newline at end of file
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class LLMResponseCache(Base):
+    """
+    LLM 回覆快取 (llm_response_cache)
+    以 (provider, 模型, 完整 prompt) 的雜湊當 key，同一天同一檔股票重複分析時直接回傳，不用再等 AI
+    """
+    __tablename__ = "llm_response_cache"
+
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String(64), unique=True, index=True)  # sha256(provider, model, prompt)
+    provider = Column(String(20))
+    model_name = Column(String(100))
+    response = Column(Text)
+    size_bytes = Column(Integer)
+    hit_count = Column(Integer, default=0)
+
+    created_at = Column(DateTime, server_default=func.now())
+    expires_at = Column(DateTime, index=True)      # 下一次收盤資料更新的時間 (UTC)
+    last_used_at = Column(DateTime, index=True)    # LRU 淘汰用
+
+class LLMCallLog(Base):
+    """
+    LLM 呼叫紀錄 (llm_call_logs)
+    每次 get_analysis / get_trade_signal 一列：token 數與各段耗時 (毫秒)，
+    用來看批次時間花在哪、哪個模型/風格最划算
+    """
+    __tablename__ = "llm_call_logs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    created_at = Column(DateTime, index=True)   # 呼叫開始時間 (UTC)
+
+    provider = Column(String(20))
+    model_name = Column(String(100))
+    prompt_style = Column(String(50))
+    call_type = Column(String(10))    # signal (交易訊號) / report (文字報告)
+    priority = Column(String(12))
+    stock_id = Column(String(20))
+    status = Column(String(12))       # ok / cached / busy (排隊逾時) / unavailable (端點故障) / error / cancelled
+    base_url = Column(String(200), nullable=True)   # 實際回覆的 Ollama 端點
+    hedged = Column(Boolean, default=False)         # 是否同時送到備援端點
+
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+    queue_ms = Column(Integer, nullable=True)     # 在排程器排隊
+    ttft_ms = Column(Integer, nullable=True)      # 送出到第一個 token
+    latency_ms = Column(Integer)                  # 整個呼叫 (含排隊)
+    eval_ms = Column(Integer, nullable=True)      # Ollama eval_duration (純產生 token 的時間)
+    early_stop = Column(Boolean, default=False)
+
+    __table_args__ = (
+        Index("ix_llm_call_logs_config", "provider", "model_name", "prompt_style"),
+    )
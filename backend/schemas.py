@@ -12,8 +12,10 @@ class StockAnalysisRequest(BaseModel):
     api_key: Optional[str] = None
     provider: str = "gemini" 
     model_name: str = "gemini-1.5-flash"
+    # 不填時：有設定 OLLAMA_URLS 就由端點池挑節點，否則用 localhost
     ollama_url: Optional[str] = None
     prompt_style: str = "standard"
+    force_refresh: bool = False  # True = 不使用快取，重新請 AI 分析
 class AnalysisLogResponse(BaseModel):
     id: int
     stock_id: str
@@ -84,14 +86,105 @@ class BacktestRequest(BaseModel):
     api_key: Optional[str] = None # 如果選 Ollama，這個可以為空
     provider: str = "gemini"     # "gemini" 或 "ollama"
     model_name: str = "gemini-1.5-flash" # 或 "llama3", "mistral" 等
+    ollama_url: Optional[str] = None  # 不填時由端點池 (OLLAMA_URLS) 或 localhost 處理
     prompt_style: str = "balanced"  # 預設為 "平衡型"
+    roll_window: bool = False  # 延伸舊結果時，是否只保留最近一年的區間
+    # AI 預篩條件，例如 ["trend", "volume"] 或 ["Close > MA20 and K < 30"]，通過的日子才問 AI
+    gate: Optional[List[str]] = None
+    # 預先並行查詢 AI 的天數 (0 = 不預先查詢，逐日依序呼叫)
+    prefetch_window: int = 0
+
+# 規則型回測 (不呼叫 AI，用選股策略當訊號)
+class RuleBacktestRequest(BaseModel):
+    stock_id: str
+    strategies: List[str]
+    initial_capital: float = 100000
+    stop_loss_pct: float = 0.05    # 停損 5%
+    take_profit_pct: float = 0.10  # 停利 10%
+
+class RuleUniverseBacktestRequest(BaseModel):
+    strategies: List[str]
+    scope: str = "TW50"  # "TW50", "Finance", "Custom"
+    custom_tickers: Optional[List[str]] = None
+    initial_capital: float = 100000
+    stop_loss_pct: float = 0.05
+    take_profit_pct: float = 0.10
+    period: str = "2y"
+
+# 訊號重播：用已保存的 AI 訊號換一組執行參數重新模擬 (不呼叫 AI)
+class BacktestReplayRequest(BaseModel):
+    record_id: int
+    initial_capital: Optional[float] = None  # 不填就沿用原紀錄的資金
+    order_expiry: int = 5       # 掛單有效天數
+    hold_cooldown: int = 3      # 觀望後冷卻天數
+    cash_ratio: float = 0.98    # 下單使用的現金比例
+    fee_rate: float = 0.001425  # 手續費率
+    tax_rate: float = 0.003     # 證交稅率
+
+class BacktestReplayGridRequest(BaseModel):
+    record_id: int
+    initial_capital: Optional[float] = None
+    # 例如 {"hold_cooldown": [0, 1, 3], "order_expiry": [3, 5, 10]}
+    grid: Dict[str, List[float]]
+
+# 組合回測：多檔股票共用一個現金水位
+class PortfolioTickerConfig(BaseModel):
+    stock_id: str
+    source: str = "rule"  # "rule" (選股策略) 或 "signals" (重播已保存的 AI 訊號)
+    strategies: Optional[List[str]] = None  # source="rule" 時使用
+    record_id: Optional[int] = None         # source="signals" 時使用的回測紀錄
+    stop_loss_pct: float = 0.05
+    take_profit_pct: float = 0.10
+
+class PortfolioBacktestRequest(BaseModel):
+    tickers: List[PortfolioTickerConfig]
+    initial_capital: float = 1000000
+    sizing: str = "equal"     # "equal" (總資產平均分成 max_positions 份) 或 "fraction" (每檔 position_pct)
+    max_positions: int = 10
+    position_pct: float = 0.1
+    period: str = "1y"
+
+# Walk-forward：長期歷史切成滾動視窗分別回測
+class WalkForwardConfig(BaseModel):
+    type: str = "rule"  # "rule" (選股策略) 或 "ai"
+    strategies: Optional[List[str]] = None  # type="rule" 時使用
+    stop_loss_pct: float = 0.05
+    take_profit_pct: float = 0.10
+    provider: Optional[str] = None  # type="ai" 時使用
+    model_name: Optional[str] = None
+    prompt_style: str = "balanced"
+    gate: Optional[List[str]] = None
+
+class WalkForwardRequest(BaseModel):
+    stock_id: str
+    configs: List[WalkForwardConfig]
+    initial_capital: float = 100000
+    period: str = "5y"
+    train_days: int = 60     # 每個視窗前面的暖身天數
+    test_days: int = 120     # 每個視窗實際模擬的天數
+    step_days: Optional[int] = None  # 視窗每次往後移幾天 (預設 = test_days，不重疊)
+    api_key: Optional[str] = None
+    ollama_url: Optional[str] = None
+
+# Monte Carlo 穩健度測試：重新抽樣已保存的交易
+class MonteCarloRequest(BaseModel):
+    record_ids: Optional[List[int]] = None  # 不指定就跑全部 (或 stock_id 的全部) 紀錄
+    stock_id: Optional[str] = None
+    n_paths: int = 1000
+    method: str = "bootstrap"   # "bootstrap" (可重複抽) 或 "shuffle" (打亂順序)
+    ruin_pct: float = 0.5       # 資產曾跌掉這個比例視為破產
+    seed: Optional[int] = None
 
 class BacktestHistoryItem(BaseModel):
     id: int
     stock_id: str
     strategy_name: str
     initial_capital: float
-    result_data: Json[Any]  # 自動將 JSON 字串轉為 Python Dict
+    result_data: Json[Any]  # 自動將 JSON 字串轉為 Python Dict (只有摘要，曲線要另外查)
+    final_equity: Optional[float] = None
+    total_return_pct: Optional[float] = None
+    trade_count: Optional[int] = None
+    metrics: Optional[Dict[str, Optional[float]]] = None  # sharpe, sortino, max_drawdown_pct, win_rate_pct, exposure_pct...
     created_at: datetime
 
     class Config:
@@ -122,5 +215,6 @@ class AutoReportRequest(BaseModel):
     custom_tickers: Optional[List[str]] = None
     
     # 🔥 修改：移除 api_key，加入 ollama 模型設定
-    ollama_url: str = "http://localhost:11434"
+    # 不填時由端點池 (OLLAMA_URLS) 分配到多台 Ollama，沒有設定端點池就用 localhost
+    ollama_url: Optional[str] = None
     ollama_model_name: str = "gpt-oss:20b" # 預設模型
\ No newline at end of file
@@ -1,7 +1,16 @@
 # backend/services/ai_service.py
 import google.generativeai as genai
 import json
-import requests
+import os
+import time
+import hashlib
+from datetime import datetime
+from services.llm_cache import response_cache
+from services.llm_clients import client_pool
+from services.llm_scheduler import scheduler, LLMSchedulerError
+from services.llm_resilience import resilience, LLMRetryLaterError, LLMUnavailableError
+from services.ollama_pool import endpoint_pool
+from services.llm_usage import usage_log
 
 class AIService:
     PROMPT_TEMPLATES = {
@@ -34,17 +43,100 @@ class AIService:
         """
     }
 
+    # Prompt 分成兩段：固定的 system (人格 + 任務 + JSON 格式，每種風格一份) 與每次不同的 user (代號、數據)
+    # 固定的部分放在最前面，Ollama / Gemini 可以重複使用前綴的 KV 快取，回測每天只需要重新計算後面的數據
+
+    # 回測交易訊號
+    SIGNAL_SYSTEM_PROMPT = """
+        {persona}
+
+        你會收到一檔股票的代號與技術數據摘要，請根據數據進行分析。
+
+        任務：
+        1. 判斷是否適合進場（做多 Long 或 觀望 Hold）。
+        2. 如果做多，給出明確的進場價、停損價、停利價。
+        3. 嚴格輸出 JSON 格式，不要包含 Markdown 標記。
+
+        JSON 格式範例：
+        {{
+            "action": "BUY", 
+            "entry_price": 100.5,
+            "stop_loss": 95.0,
+            "take_profit": 110.0,
+            "reason": "依據激進策略，突破前高進場"
+        }}
+        """
+    SIGNAL_USER_PROMPT = """
+        股票代號: {stock_id}
+        數據摘要: {context_data}
+        """
+
+    # 文字報告
+    ANALYSIS_SYSTEM_PROMPT = """
+            {persona}
+
+            你會收到一檔股票的參數 (代號、名稱、方向、成本) 與技術數據，請進行分析。
+
+            任務:
+            1. 給出明確操作建議 (買進/賣出/續抱/止損)。
+            2. 指出關鍵支撐與壓力價位。
+            3. 使用條列式，口語化，500字內。
+            4. 是否適合作為隔日沖的標的。
+            5. 根據分析結果給出 (1) 進場價格 (2) 停利價格 (3) 停損價格
+            6. 根據近20日的資料給出壓力價位、支撐價位、爆大量日期，請務必在文章結尾附上以下 JSON 格式的關鍵數據（不要放在程式碼區塊中）：
+            {{ "resistancePrice": "數值", "supportPrice": "數值", "volumeSpikeDate": "YYYY/MM/DD" }}
+            
+            ⚠️ 重要：請直接輸出純文字報告，不要使用 JSON 格式。
+            """
+    ANALYSIS_USER_PROMPT = """
+            請分析以下股票數據。
+            參數: 代號 {stock_id}, 股票名稱 {stock_name} 方向 {mode}, 成本 {cost}
+            數據: {context_data}
+            """
+
+    # 各種呼叫的生成設定
+    # signal: 交易訊號只要一個小 JSON，token 上限壓低、溫度低讓結果穩定，JSON 物件一結束就停止
+    # report: 文字報告需要比較長的篇幅與變化
+    GENERATION_PROFILES = {
+        "signal": {"num_predict": 384, "temperature": 0.1, "top_p": 0.9},
+        "report": {"num_predict": 2048, "temperature": 0.7, "top_p": 0.9},  # 2048 避免話講一半被切掉
+    }
+
+    # Ollama 模型閒置多久才卸載 (Ollama 預設 5 分鐘)
+    OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+    # Ollama 兩個片段之間 / 整個回覆最久等幾秒 (連線本身 10 秒沒建立就算失敗)
+    OLLAMA_READ_TIMEOUT = 120
+    # Gemini 交易訊號最久等幾秒
+    GEMINI_SIGNAL_TIMEOUT = 60
+
     def __init__(self):
-        pass
+        # 文字報告的回覆快取 (交易訊號另外有回測訊號快取)
+        self.cache = response_cache
+        # 共用的 HTTP session / Gemini client
+        self.clients = client_pool
+        # Ollama 請求的排程 (每個模型的同時執行數與優先序)
+        self.scheduler = scheduler
+        # 每次呼叫的 token 與耗時紀錄 (llm_call_logs)
+        self.usage = usage_log
+        # 每個端點的斷路器與對沖請求
+        self.resilience = resilience
+        # 多台 Ollama 的端點池 (OLLAMA_URLS)
+        self.pool = endpoint_pool
+
+    def prompt_version(self, prompt_style: str) -> str:
+        """
+        交易訊號 prompt 的版本 (persona + 固定模板的雜湊)，模板一改回測快取就會失效
+        """
+        system, _ = self.signal_messages("", "", prompt_style)
+        return hashlib.sha256((system + self.SIGNAL_USER_PROMPT).encode("utf-8")).hexdigest()[:12]
 
     def get_available_models(self, api_key: str) -> list:
        """
        列出該 API Key 可用的所有生成式模型
        """
        try:
-           genai.configure(api_key=api_key)
            model_list = []
-           for m in genai.list_models():
+           for m in genai.list_models(client=self.clients.gemini_model_client(api_key)):
                # 只列出支援 'generateContent' (文字生成) 的模型
                if 'generateContent' in m.supported_generation_methods:
                    model_list.append(m.name)
@@ -56,102 +148,189 @@ class AIService:
            print(f"Fetch models error: {e}")
            return []
 
-    def get_analysis(self, api_key: str, stock_id: str, stock_name: str, mode: str, cost: float, context_data: str, provider: str = "gemini", model_name: str = "gemini-1.5-flash", ollama_url: str = None, prompt_style: str = "standard"):
+    def analysis_messages(self, stock_id: str, stock_name: str, mode: str, cost: float, context_data: str, prompt_style: str = "standard") -> tuple:
         """
-        呼叫 AI 進行操盤分析 (回傳文字報告)
+        組合文字報告的 Prompt，回傳 (system, user)
+        system 只跟風格有關 (人格 + 任務)，user 是這次的股票參數與數據
         """
-        try:
-            # 1. 取得對應的人格設定 (若找不到則預設用 standard)
-            persona = self.PROMPT_TEMPLATES.get(prompt_style, self.PROMPT_TEMPLATES["standard"])
+        # 取得對應的人格設定 (若找不到則預設用 standard)
+        persona = self.PROMPT_TEMPLATES.get(prompt_style, self.PROMPT_TEMPLATES["standard"])
 
-            if(mode == "long"):
-                mode = "做多"
-            elif(mode == "short"):
-                mode = "做空"
+        if(mode == "long"):
+            mode = "做多"
+        elif(mode == "short"):
+            mode = "做空"
 
-            # 2. 組合完整的 Prompt (人格 + 數據 + 任務)
-            prompt = f"""
-            {persona}
+        system = self.ANALYSIS_SYSTEM_PROMPT.format(persona=persona)
+        user = self.ANALYSIS_USER_PROMPT.format(stock_id=stock_id, stock_name=stock_name, mode=mode, cost=cost, context_data=context_data)
+        return system, user
 
-            請分析以下股票數據。
-            參數: 代號 {stock_id}, 股票名稱 {stock_name} 方向 {mode}, 成本 {cost}
-            數據: {context_data}
-            
-            任務:
-            1. 給出明確操作建議 (買進/賣出/續抱/止損)。
-            2. 指出關鍵支撐與壓力價位。
-            3. 使用條列式，口語化，500字內。
-            4. 是否適合作為隔日沖的標的。
-            5. 根據分析結果給出 (1) 進場價格 (2) 停利價格 (3) 停損價格
-            6. 根據近20日的資料給出壓力價位、支撐價位、爆大量日期，請務必在文章結尾附上以下 JSON 格式的關鍵數據（不要放在程式碼區塊中）：
-            {{ "resistancePrice": "數值", "supportPrice": "數值", "volumeSpikeDate": "YYYY/MM/DD" }}
-            
-            ⚠️ 重要：請直接輸出純文字報告，不要使用 JSON 格式。
-            """
+    def signal_messages(self, stock_id: str, context_data: str, prompt_style: str = "balanced") -> tuple:
+        """
+        組合回測交易訊號的 Prompt，回傳 (system, user)
+        """
+        # 如果找不到對應風格，就用預設 balanced
+        persona = self.PROMPT_TEMPLATES.get(prompt_style, self.PROMPT_TEMPLATES["balanced"])
+        return self.SIGNAL_SYSTEM_PROMPT.format(persona=persona), self.SIGNAL_USER_PROMPT.format(stock_id=stock_id, context_data=context_data)
 
+    def get_analysis(self, api_key: str, stock_id: str, stock_name: str, mode: str, cost: float, context_data: str, provider: str = "gemini", model_name: str = "gemini-1.5-flash", ollama_url: str = None, prompt_style: str = "standard", force_refresh: bool = False, priority: str = "interactive"):
+        """
+        呼叫 AI 進行操盤分析 (回傳文字報告)
+        同一個 prompt 在同一個交易日內直接回傳快取，force_refresh=True 時強制重新產生
+        :param priority: Ollama 排隊的優先序 (interactive / report / batch)
+        """
+        call = self._new_call("report", provider, model_name, prompt_style, priority, stock_id)
+        try:
+            system, prompt = self.analysis_messages(stock_id, stock_name, mode, cost, context_data, prompt_style)
+
+            cache_key = self.cache.make_key(provider, model_name, system, prompt)
+            if not force_refresh:
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    call["status"] = "cached"
+                    return cached
 
             if provider == "ollama":
             # 呼叫 Ollama，json_mode=False (我們要文字報告)
-                return self._call_ollama(model_name, prompt, ollama_url, json_mode=False)
+                text = self._call_ollama(model_name, prompt, ollama_url, json_mode=False, priority=priority, system=system, usage=call)
+                # 連線失敗時回傳的是 dict，不寫入快取
+                if not isinstance(text, str):
+                    return text
             else:
                 # 呼叫 Gemini
                 if not api_key:
                     return "⚠️ 請輸入 Gemini API Key"
                 try:
-                    genai.configure(api_key=api_key)
-                    model = genai.GenerativeModel(model_name)
-                    response = model.generate_content(prompt)
-                    return response.text
+                    with self.clients.gemini_model(api_key, model_name, system) as model, \
+                            self.resilience.guard(self.clients.gemini_endpoint(api_key, model_name)):
+                        response = model.generate_content(prompt, generation_config=self._gemini_config("report"))
+                    self._gemini_usage(call, response)
+                    text = response.text
+                except LLMRetryLaterError:
+                    raise
                 except Exception as e:
+                    call["status"] = "error"
                     return f"Gemini Error: {e}"
-            
+
+            self.cache.put(cache_key, provider, model_name, text)
+            return text
+
+        except LLMRetryLaterError as e:
+            call["status"] = self._retry_status(e)
+            return f"AI 暫時無法使用，請稍後再試: {e}"
         except Exception as e:
+            call["status"] = "error"
             return f"AI 分析失敗: {str(e)}"
-        
-    def get_trade_signal(self, api_key: str, stock_id: str, context_data: str, provider: str = "gemini", model_name: str = "gemini-1.5-flash", ollama_url: str = None, prompt_style: str = "balanced"):
-        # 1. 根據風格取得對應的 Persona 設定
-        # 如果找不到對應風格，就用預設 balanced
-        persona = self.PROMPT_TEMPLATES.get(prompt_style, self.PROMPT_TEMPLATES["balanced"])
+        finally:
+            self._finish_call(call)
 
-        # 2. 組合最終 System Prompt
-        system_prompt = f"""
-        {persona}
-        
-        請根據提供的股票數據進行分析。
-        股票代號: {stock_id}
-        數據摘要: {context_data}
+    def stream_analysis(self, api_key: str, stock_id: str, stock_name: str, mode: str, cost: float, context_data: str, provider: str = "gemini", model_name: str = "gemini-1.5-flash", ollama_url: str = None, prompt_style: str = "standard", force_refresh: bool = False, priority: str = "interactive"):
+        """
+        跟 get_analysis 一樣，但模型一邊產生一邊 yield 文字片段 (給 SSE 串流用)
+        有快取時一次 yield 整份報告；完整產生成功才寫入快取
+        失敗時直接丟出例外 (不當成報告內容 yield)，端點暫時無法使用是 LLMRetryLaterError
+        """
+        call = self._new_call("report", provider, model_name, prompt_style, priority, stock_id)
+        try:
+            system, prompt = self.analysis_messages(stock_id, stock_name, mode, cost, context_data, prompt_style)
+            cache_key = self.cache.make_key(provider, model_name, system, prompt)
+            if not force_refresh:
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    call["status"] = "cached"
+                    yield cached
+                    return
 
-        任務：
-        1. 判斷是否適合進場（做多 Long 或 觀望 Hold）。
-        2. 如果做多，給出明確的進場價、停損價、停利價。
-        3. 嚴格輸出 JSON 格式，不要包含 Markdown 標記。
+            parts = []
+            # 前端中途斷線 (generator 被關閉) 時會停在這個狀態
+            call["status"] = "cancelled"
+            if provider == "ollama":
+                for chunk in self._stream_ollama(model_name, prompt, ollama_url, priority=priority, system=system, usage=call):
+                    parts.append(chunk)
+                    yield chunk
+            else:
+                if not api_key:
+                    raise ValueError("請輸入 Gemini API Key")
+                with self.clients.gemini_model(api_key, model_name, system) as model, \
+                        self.resilience.guard(self.clients.gemini_endpoint(api_key, model_name)):
+                    response = model.generate_content(prompt, stream=True, generation_config=self._gemini_config("report"))
+                    for chunk in response:
+                        if chunk.text:
+                            if not parts:
+                                call["ttft_ms"] = round((time.time() - call["start"]) * 1000)
+                            parts.append(chunk.text)
+                            yield chunk.text
+                self._gemini_usage(call, response)
 
-        JSON 格式範例：
-        {{
-            "action": "BUY", 
-            "entry_price": 100.5,
-            "stop_loss": 95.0,
-            "take_profit": 110.0,
-            "reason": "依據激進策略，突破前高進場"
-        }}
+            if parts:
+                self.cache.put(cache_key, provider, model_name, "".join(parts))
+        except LLMRetryLaterError as e:
+            call["status"] = self._retry_status(e)
+            raise
+        except Exception:
+            call["status"] = "error"
+            raise
+        finally:
+            self._finish_call(call)
+
+    def get_trade_signal(self, api_key: str, stock_id: str, context_data: str, provider: str = "gemini", model_name: str = "gemini-1.5-flash", ollama_url: str = None, prompt_style: str = "balanced", priority: str = "batch"):
         """
+        問 AI 交易訊號 (dict)；模型回覆有問題時回傳 HOLD 並附上原因
+        端點故障、逾時或排隊太久時丟出 LLMRetryLaterError (不是 HOLD，呼叫端應該稍後重試)
+        """
+        # 根據風格組合 Prompt (固定的 system + 當天數據的 user)
+        system, user = self.signal_messages(stock_id, context_data, prompt_style)
 
-        if provider == "ollama":
-            return self._call_ollama(model_name, system_prompt, ollama_url, json_mode=True)
-        else:
-            return self._call_gemini(api_key, model_name, system_prompt)
+        call = self._new_call("signal", provider, model_name, prompt_style, priority, stock_id)
+        try:
+            if provider == "ollama":
+                return self._call_ollama(model_name, user, ollama_url, json_mode=True, priority=priority, system=system, usage=call)
+            else:
+                return self._call_gemini(api_key, model_name, user, system=system, usage=call)
+        finally:
+            self._finish_call(call)
+
+    def _new_call(self, call_type: str, provider: str, model_name: str, prompt_style: str, priority: str, stock_id: str) -> dict:
+        """
+        一次 LLM 呼叫的紀錄 (llm_call_logs 的一列)，底層的 _call_* 成功時補上 token 與耗時並把 status 改成 ok
+        """
+        return {
+            "created_at": datetime.utcnow(), "start": time.time(),
+            "provider": provider, "model_name": model_name, "prompt_style": prompt_style,
+            "call_type": call_type, "priority": priority, "stock_id": stock_id, "status": "error",
+        }
+
+    def _retry_status(self, error: LLMRetryLaterError) -> str:
+        # 呼叫紀錄的狀態：排隊逾時 / 佇列滿 = busy，端點故障或斷路中 = unavailable
+        return "busy" if isinstance(error, LLMSchedulerError) else "unavailable"
 
+    def _finish_call(self, call: dict) -> None:
+        """
+        寫入呼叫紀錄 (背景批次寫入)；成功的呼叫也累計到排程器的生成統計 (/api/llm/metrics)
+        """
+        latency = time.time() - call.pop("start")
+        call["latency_ms"] = round(latency * 1000)
+        if call["status"] == "ok":
+            # 生成統計不含排隊時間
+            self.scheduler.record_generation(
+                call["call_type"], latency - (call.get("queue_ms") or 0) / 1000,
+                call.get("prompt_tokens"), call.get("completion_tokens"), call.get("early_stop", False)
+            )
+        self.usage.record(**call)
 
-    def _call_gemini(self, api_key, model_name, prompt):
+    def _call_gemini(self, api_key, model_name, prompt, system=None, usage=None):
+        usage = usage if usage is not None else {}
         try:
             if not api_key:
                 return {"action": "HOLD", "reason": "未提供 Gemini API Key"}
                 
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel(model_name)
-            
             # 加上 JSON mode 提示比較保險
-            response = model.generate_content(prompt + "\n請確保只回傳 JSON 字串。")
+            with self.clients.gemini_model(api_key, model_name, system) as model, \
+                    self.resilience.guard(self.clients.gemini_endpoint(api_key, model_name)):
+                response = model.generate_content(
+                    prompt + "\n請確保只回傳 JSON 字串。", generation_config=self._gemini_config("signal"),
+                    request_options={"timeout": self.GEMINI_SIGNAL_TIMEOUT}
+                )
             text = response.text.strip()
             
             # 清理 markdown
@@ -160,51 +339,221 @@ class AIService:
             if text.endswith("```"):
                 text = text[:-3]
             
-            return json.loads(text)
+            signal = json.loads(text)
+            self._gemini_usage(usage, response)
+            return signal
+        except LLMRetryLaterError as e:
+            print(f"Gemini unavailable: {e}")
+            usage["status"] = self._retry_status(e)
+            raise
         except Exception as e:
             print(f"Gemini Error: {e}")
             return {"action": "HOLD", "reason": f"Gemini 錯誤: {str(e)}"}
 
-    def _call_ollama(self, model_name, prompt, custom_url=None, json_mode=False):
+    def _gemini_config(self, profile: str) -> dict:
+        # Gemini 只套用溫度：2.5 系列的思考 token 也算在 max_output_tokens 裡，壓太低會把回覆截斷
+        options = self.GENERATION_PROFILES[profile]
+        return {"temperature": options["temperature"], "top_p": options["top_p"]}
+
+    def _gemini_usage(self, usage: dict, response) -> None:
+        # Gemini 的 token 數在 usage_metadata (沒有排隊、也沒有產生時間的細項)
+        meta = getattr(response, "usage_metadata", None)
+        usage.update({
+            "status": "ok",
+            "prompt_tokens": getattr(meta, "prompt_token_count", None),
+            "completion_tokens": getattr(meta, "candidates_token_count", None),
+        })
+
+    def _ollama_usage(self, usage: dict, result: dict, start: float) -> None:
         """
-        呼叫本地 Ollama API
+        從 Ollama 的統計補上 token 與耗時 (*_duration 單位是奈秒)
+        串流時 first_token 是收到第一個片段的時間；非串流就用 載入 + prompt 計算 的時間當作第一個 token 的時間
         """
-        try:
-            # 如果有傳入 custom_url (Ngrok網址)，就用它；否則用 localhost
-            base_url = custom_url if custom_url else "http://localhost:11434"
-            # 確保網址結尾沒有斜線，避免變成 //api/chat
-            base_url = base_url.rstrip("/")
-            
-            url = f"{base_url}/api/chat"
-            
-            payload = {
-                "model": model_name,
-                "messages": [{"role": "user", "content": prompt}],
-                "stream": False,
-                "options": {
-                    "num_predict": 2048,  # 強制讓它最多可以生成 2048 個 token (避免話講一半被切掉)
-                    "temperature": 0.7,   # 0.7 比較有創意，0.1 比較死板
-                    "top_p": 0.9
-                }
-            }
-            
-            # 只有在回測功能 (json_mode=True) 時才強制 JSON
-            if json_mode:
-                payload["format"] = "json"
-            
-            # 設定 timeout，避免等太久
-            response = requests.post(url, json=payload, timeout=120)
-            
-            if response.status_code == 200:
-                result = response.json()
-                content = result.get("message", {}).get("content", "{}")
+        if result.get("first_token"):
+            ttft = (result["first_token"] - start) * 1000
+        elif result.get("prompt_eval_duration") is not None:
+            ttft = (result.get("load_duration", 0) + result["prompt_eval_duration"]) / 1e6
+        else:
+            ttft = None
+        usage.update({
+            "status": "ok",
+            "prompt_tokens": result.get("prompt_eval_count"),
+            "completion_tokens": result.get("eval_count"),
+            "ttft_ms": round(ttft) if ttft is not None else None,
+            "eval_ms": round(result["eval_duration"] / 1e6) if result.get("eval_duration") else None,
+            "early_stop": bool(result.get("early_stop")),
+        })
+
+    def _ollama_payload(self, model_name, prompt, json_mode=False, stream=False, system=None):
+        messages = [{"role": "user", "content": prompt}]
+        if system:
+            messages.insert(0, {"role": "system", "content": system})
+        payload = {
+            "model": model_name,
+            "messages": messages,
+            "stream": stream,
+            # 用完後讓模型在記憶體多留一段時間，批次工作下一個請求不用重新載入
+            "keep_alive": self.OLLAMA_KEEP_ALIVE,
+            # json_mode (交易訊號) 用 signal 設定，其餘用 report 設定
+            "options": dict(self.GENERATION_PROFILES["signal" if json_mode else "report"])
+        }
+
+        # 只有在回測功能 (json_mode=True) 時才強制 JSON
+        if json_mode:
+            payload["format"] = "json"
+        return payload
+
+    def _stream_ollama(self, model_name, prompt, custom_url=None, priority="interactive", system=None, usage=None):
+        """
+        串流呼叫 Ollama：每一行是一個 JSON，message.content 是新產生的文字，done=true 代表結束
+        連線失敗或排隊逾時直接丟出例外 (由呼叫端轉成錯誤訊息)；整段串流都佔用一個執行槽
+        文字報告不對沖 (太長)，只經過斷路器
+        """
+        usage = usage if usage is not None else {}
+        base_url, _ = self._ollama_route(custom_url, model_name)
+        payload = self._ollama_payload(model_name, prompt, json_mode=False, stream=True, system=system)
+        with self.resilience.guard(base_url), self.pool.lease(base_url), self.scheduler.slot(base_url, model_name, priority) as wait:
+            usage["queue_ms"] = round(wait * 1000)
+            usage["base_url"] = base_url
+            start = time.time()
+            first_token = None
+            # timeout = (連線, 兩個片段之間最久等多久)
+            with self.clients.http_session(base_url).post(f"{base_url}/api/chat", json=payload, stream=True, timeout=(10, self.OLLAMA_READ_TIMEOUT)) as response:
+                self._check_ollama_status(response)
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    if data.get("error"):
+                        raise RuntimeError(data["error"])
+                    content = data.get("message", {}).get("content")
+                    if content:
+                        first_token = first_token or time.time()
+                        yield content
+                    if data.get("done"):
+                        self.scheduler.record_load(base_url, model_name, data.get("load_duration", 0) / 1e9)
+                        self._ollama_usage(usage, {**data, "first_token": first_token}, start)
+                        break
+
+    def _ollama_route(self, custom_url, model_name) -> tuple:
+        """
+        決定送到哪台 Ollama，回傳 (端點, 備援端點)
+        有端點池時，沒指定網址或指定的是池裡的節點就由池挑選 (其他節點當備援)；
+        池外的網址 (例如自己的 ngrok) 照用，備援回傳 None (用 OLLAMA_FALLBACK_URLS)
+        """
+        url = (custom_url or "").rstrip("/")
+        if self.pool.enabled and (not url or self.pool.contains(url)):
+            ranked = self.pool.ranked(model_name)
+            if not ranked:
+                raise LLMUnavailableError(f"沒有可用的 Ollama 節點可以跑 {model_name}", retry_after=self.pool.HEALTH_INTERVAL)
+            return ranked[0], ranked[1:]
+        # 沒指定就用 localhost
+        return url or "http://localhost:11434", None
+
+    def _check_ollama_status(self, response) -> None:
+        # 5xx / 429 是端點的問題 (稍後再試)，其他非 200 (例如模型不存在) 是請求本身的問題
+        status = response.status_code
+        if status >= 500 or status == 429:
+            raise LLMUnavailableError(f"Ollama HTTP {status}")
+        if status != 200:
+            raise RuntimeError(f"Ollama HTTP {status}")
+
+    def _read_json_stream(self, response, cancel=None) -> tuple:
+        """
+        串流讀取 Ollama 的 JSON 回覆，最外層的 {} 一結束就停止 (關閉連線，Ollama 會中止生成)
+        有些模型在 format=json 時，物件結束後還會一直吐空白直到 num_predict 用完
+        回傳 (內容, 統計)；提早停止時拿不到 Ollama 的最後統計，輸出 token 數以片段數估計
+        統計裡的 first_token 是收到第一個片段的時間；cancel (threading.Event) 被設定時直接停止
+        """
+        parts = []
+        depth, in_string, escape, started = 0, False, False, False
+        chunks = 0
+        first_token = None
+        for line in response.iter_lines():
+            if cancel is not None and cancel.is_set():
+                return "", {"cancelled": True}
+            if not line:
+                continue
+            data = json.loads(line)
+            if data.get("error"):
+                raise RuntimeError(data["error"])
+            if data.get("done"):
+                return "".join(parts), {**data, "first_token": first_token}
+            content = data.get("message", {}).get("content", "")
+            first_token = first_token or time.time()
+            chunks += 1
+            parts.append(content)
+            for ch in content:
+                if in_string:
+                    if escape:
+                        escape = False
+                    elif ch == "\\":
+                        escape = True
+                    elif ch == '"':
+                        in_string = False
+                elif ch == '"':
+                    in_string = True
+                elif ch == "{":
+                    depth += 1
+                    started = True
+                elif ch == "}":
+                    depth -= 1
+            if started and depth <= 0:
+                text = "".join(parts)
+                return text[:text.rindex("}") + 1], {"eval_count": chunks, "early_stop": True, "first_token": first_token}
+        return "".join(parts), {"eval_count": chunks, "first_token": first_token}
+
+    def _ollama_attempt(self, base_url, model_name, payload, json_mode, priority, cancel, started) -> dict:
+        """
+        對一個 Ollama 端點送出一次請求 (先經過排程器排隊)
+        取得執行槽後設定 started；cancel 被設定時 (對沖的另一個端點先回來) 停止讀取並關閉連線
+        """
+        with self.pool.lease(base_url), self.scheduler.slot(base_url, model_name, priority) as wait:
+            started.set()
+            start = time.time()
+            if cancel.is_set():
+                return {"start": start, "queue": wait}
+            with self.clients.http_session(base_url).post(f"{base_url}/api/chat", json=payload, stream=json_mode, timeout=(10, self.OLLAMA_READ_TIMEOUT)) as response:
+                self._check_ollama_status(response)
                 if json_mode:
-                    return json.loads(content)
+                    content, result = self._read_json_stream(response, cancel)
                 else:
-                    return content # 直接回傳文字
+                    result = response.json()
+                    content = result.get("message", {}).get("content", "{}")
+        self.scheduler.record_load(base_url, model_name, result.get("load_duration", 0) / 1e9)
+        return {"content": content, "result": result, "queue": wait, "start": start}
+
+    def _call_ollama(self, model_name, prompt, custom_url=None, json_mode=False, priority="batch", system=None, usage=None):
+        """
+        呼叫本地 Ollama API (經過斷路器與排程器)
+        json_mode=True (交易訊號) 用串流讀取，JSON 物件結束就不再等模型；跑太久會對沖到備援端點
+        端點故障、斷路中或排隊太久丟出 LLMRetryLaterError；模型回錯誤或 JSON 壞掉回傳 HOLD
+        usage: 呼叫紀錄 (見 _new_call)，成功時補上排隊時間、token 與耗時
+        """
+        usage = usage if usage is not None else {}
+        payload = self._ollama_payload(model_name, prompt, json_mode, stream=json_mode, system=system)
+
+        def attempt(url, cancel, started):
+            return self._ollama_attempt(url, model_name, payload, json_mode, priority, cancel, started)
+
+        try:
+            # 指定的網址 (Ngrok 等) 或端點池挑的節點
+            base_url, alternates = self._ollama_route(custom_url, model_name)
+            out = self.resilience.call(base_url, attempt, model_name, "signal" if json_mode else "report",
+                                       hedge=json_mode, alternates=alternates)
+            usage.update({"queue_ms": round(out["queue"] * 1000), "base_url": out["endpoint"], "hedged": out["hedged"]})
+            if json_mode:
+                signal = json.loads(out["content"])
+                self._ollama_usage(usage, out["result"], out["start"])
+                return signal
             else:
-                return {"action": "HOLD", "reason": f"Ollama HTTP {response.status_code}"}
-                
+                self._ollama_usage(usage, out["result"], out["start"])
+                return out["content"] # 直接回傳文字
+
+        except LLMRetryLaterError as e:
+            print(f"Ollama unavailable: {e}")
+            usage["status"] = self._retry_status(e)
+            raise
         except Exception as e:
             print(f"Ollama Error: {e}")
-            return {"action": "HOLD", "reason": "Ollama 連線失敗或逾時"}
\ No newline at end of file
+            return {"action": "HOLD", "reason": f"Ollama 錯誤: {e}"}
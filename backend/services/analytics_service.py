@@ -0,0 +1,169 @@
+# backend/services/analytics_service.py
+import json
+import numpy as np
+from sqlalchemy.orm import Session
+import models
+
+
+class AnalyticsService:
+    """
+    回測績效指標 (Sharpe, Sortino, 最大回撤, 勝率, 持倉比例)
+    一次讀出多筆紀錄的資產曲線，補齊成 (紀錄數 x 天數) 的矩陣後用 NumPy 一次算完，
+    不需要逐筆把 equity_curve 轉成 dict 再計算
+    """
+    TRADING_DAYS = 252  # 年化用的交易日數
+
+    def load_curves(self, db: Session, records: list) -> dict:
+        """
+        讀取多筆紀錄的資產曲線與交易明細
+        回傳 {record_id: {"dates": datetime64[D] 陣列, "equity": float 陣列, "trades": list}}
+        """
+        ids = [r.id for r in records]
+        rows = db.query(models.BacktestCurve).filter(models.BacktestCurve.record_id.in_(ids)).all() if ids else []
+
+        data = {}
+        for row in rows:
+            if row.base_date:
+                offsets = np.frombuffer(row.date_offsets, dtype="<i4")
+                dates = np.datetime64(row.base_date, "D") + offsets.astype("timedelta64[D]")
+                equity = row.equity_base + np.frombuffer(row.equity_deltas, dtype="<f4").astype(float)
+            else:
+                dates, equity = np.array([], dtype="datetime64[D]"), np.array([])
+            data[row.record_id] = {"dates": dates, "equity": equity, "trades": json.loads(row.trades_data or "[]")}
+
+        # 還沒搬成精簡格式的舊紀錄
+        for record in records:
+            if record.id not in data:
+                raw = json.loads(record.result_data)
+                curve = raw.get("equity_curve") or []
+                data[record.id] = {
+                    "dates": np.array([p["date"] for p in curve], dtype="datetime64[D]"),
+                    "equity": np.array([p["equity"] for p in curve], dtype=float),
+                    "trades": raw.get("trades") or []
+                }
+        return data
+
+    def compute_curve_metrics(self, curves: list) -> dict:
+        """
+        多條資產曲線的 Sharpe、Sortino、最大回撤 (長度可以不同)
+        :param curves: list of 1-D equity 陣列
+        :return: 每個指標一個長度 = len(curves) 的陣列
+        """
+        n = len(curves)
+        lengths = np.array([len(c) for c in curves], dtype=int)
+        width = max(int(lengths.max()), 2) if n else 2
+
+        # 補齊成矩陣：每條曲線結束後的位置用最後一天的資產填 (不影響回撤，報酬率另外遮掉)
+        mask = np.arange(width)[None, :] < lengths[:, None]
+        equity = np.full((n, width), np.nan)
+        equity[mask] = np.concatenate(curves) if n else []
+        # 沒有曲線的紀錄整列填 1，指標都會是 0
+        last = np.array([c[-1] if len(c) else 1.0 for c in curves])
+        equity = np.where(mask, equity, last[:, None])
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            returns = equity[:, 1:] / equity[:, :-1] - 1
+            returns[~mask[:, 1:]] = np.nan
+            valid = np.sum(~np.isnan(returns), axis=1)
+
+            mean = np.nansum(returns, axis=1) / np.maximum(valid, 1)
+            var = np.nansum((returns - mean[:, None]) ** 2, axis=1) / np.maximum(valid - 1, 1)
+            std = np.sqrt(var)
+            downside = np.sqrt(np.nansum(np.minimum(returns, 0) ** 2, axis=1) / np.maximum(valid, 1))
+
+            scale = np.sqrt(self.TRADING_DAYS)
+            sharpe = np.where(std > 0, mean / std * scale, 0.0)
+            sortino = np.where(downside > 0, mean / downside * scale, 0.0)
+
+            peak = np.maximum.accumulate(equity, axis=1)
+            drawdown = np.min(equity / peak - 1, axis=1)
+
+        short = valid < 2  # 資料太少，指標沒有意義
+        sharpe[short] = 0.0
+        sortino[short] = 0.0
+
+        return {
+            "sharpe": sharpe,
+            "sortino": sortino,
+            "max_drawdown_pct": np.abs(drawdown) * 100,
+            "volatility_pct": std * scale * 100,
+        }
+
+    def compute_trade_metrics(self, trades_list: list, spans: list) -> dict:
+        """
+        多筆紀錄的勝率、平均每筆報酬、獲利因子與持倉比例
+        :param trades_list: 每筆紀錄的交易明細
+        :param spans: 每筆紀錄的 (第一天, 最後一天)，用來算持倉天數佔整段回測的比例
+        """
+        n = len(trades_list)
+        owner = np.repeat(np.arange(n), [len(t) for t in trades_list])
+        flat = [t for trades in trades_list for t in trades]
+
+        profit = np.array([t.get("profit", 0) for t in flat], dtype=float)
+        profit_pct = np.array([t.get("profit_pct", 0) for t in flat], dtype=float)
+        entry = np.array([t["entry_date"] for t in flat], dtype="datetime64[D]")
+        exit_ = np.array([t["exit_date"] for t in flat], dtype="datetime64[D]")
+
+        count = np.bincount(owner, minlength=n).astype(float)
+        wins = np.bincount(owner, weights=(profit > 0).astype(float), minlength=n)
+        gross_win = np.bincount(owner, weights=np.maximum(profit, 0), minlength=n)
+        gross_loss = np.bincount(owner, weights=np.maximum(-profit, 0), minlength=n)
+        pct_sum = np.bincount(owner, weights=profit_pct, minlength=n)
+        held_days = np.bincount(owner, weights=np.busday_count(entry, exit_), minlength=n)
+
+        first = np.array([s[0] for s in spans], dtype="datetime64[D]")
+        last = np.array([s[1] for s in spans], dtype="datetime64[D]")
+        total_days = np.busday_count(first, last)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            win_rate = np.where(count > 0, wins / count * 100, 0.0)
+            avg_trade = np.where(count > 0, pct_sum / count, 0.0)
+            profit_factor = np.where(gross_loss > 0, gross_win / gross_loss, np.where(gross_win > 0, np.inf, 0.0))
+            exposure = np.where(total_days > 0, np.minimum(held_days / np.maximum(total_days, 1), 1) * 100, 0.0)
+
+        return {
+            "win_rate_pct": win_rate,
+            "avg_trade_pct": avg_trade,
+            "profit_factor": profit_factor,
+            "exposure_pct": exposure,
+        }
+
+    def compute_metrics(self, db: Session, records: list) -> dict:
+        """
+        計算多筆回測紀錄的所有指標 (從資料庫讀資產曲線)
+        :return: {record_id: {"sharpe": ..., "sortino": ..., ...}}
+        """
+        if not records:
+            return {}
+        data = self.load_curves(db, records)
+        rows = self._metrics_for([data[r.id] for r in records])
+        return {record.id: row for record, row in zip(records, rows)}
+
+    def result_metrics(self, result: dict) -> dict:
+        """
+        單一回測結果 (還在記憶體裡、含 equity_curve 與 trades) 的所有指標，存檔時先算好
+        """
+        curve = result.get("equity_curve") or []
+        item = {
+            "dates": np.array([p["date"] for p in curve], dtype="datetime64[D]"),
+            "equity": np.array([p["equity"] for p in curve], dtype=float),
+            "trades": result.get("trades") or []
+        }
+        return self._metrics_for([item])[0]
+
+    def _metrics_for(self, items: list) -> list:
+        curve_metrics = self.compute_curve_metrics([d["equity"] for d in items])
+        empty = np.datetime64("1970-01-01", "D")
+        spans = [(d["dates"][0], d["dates"][-1]) if len(d["dates"]) else (empty, empty) for d in items]
+        trade_metrics = self.compute_trade_metrics([d["trades"] for d in items], spans)
+
+        metrics = {**curve_metrics, **trade_metrics}
+        results = []
+        for k in range(len(items)):
+            row = {}
+            for name, values in metrics.items():
+                value = float(values[k])
+                # JSON 沒有 inf，沒有虧損的獲利因子用 None 表示
+                row[name] = round(value, 3) if np.isfinite(value) else None
+            results.append(row)
+        return results
@@ -0,0 +1,330 @@
+# backend/services/backtest_engine.py
+import pandas as pd
+
+
+class BacktestEngine:
+    """
+    回測撮合引擎 (不含 AI 與資料庫)
+    負責: 掛單成交/過期、停損停利、冷卻時間、資產曲線
+    所有可變狀態都放在 state dict 裡，方便存檔 (checkpoint) 後接續執行
+    """
+
+    # 撮合邏輯的版本，修改成交/停損停利/冷卻規則時要加 1 (舊的回測快取會失效)
+    ENGINE_VERSION = "1"
+
+    # 從第 60 天開始跑 (前面留給 MA 計算)
+    START_INDEX = 60
+
+    # 每筆訊號要保存的欄位 (重播時只需要這些)
+    SIGNAL_FIELDS = ("action", "entry_price", "stop_loss", "take_profit", "reason")
+
+    def __init__(self, fee_rate: float = 0.001425, tax_rate: float = 0.003,
+                 order_expiry: int = 5, hold_cooldown: int = 3, cash_ratio: float = 0.98):
+        self.fee_rate = fee_rate
+        self.tax_rate = tax_rate
+        self.order_expiry = int(order_expiry)      # 掛單有效天數
+        self.hold_cooldown = int(hold_cooldown)    # AI 說觀望後幾天內不再詢問
+        self.cash_ratio = cash_ratio          # 下單時使用的現金比例 (預留手續費)
+
+    def calculate_cost(self, price: float, shares: int, is_buy: bool) -> float:
+        """
+        計算交易成本 (含手續費與稅)
+        """
+        amount = price * shares
+        # 手續費最低 20 元 (這裡簡化，先不設低消)
+        fee = int(amount * self.fee_rate)
+
+        if is_buy:
+            return amount + fee
+        else:
+            tax = int(amount * self.tax_rate)
+            return amount - fee - tax
+
+    def new_state(self, initial_capital: float) -> dict:
+        """
+        建立一份全新的模擬狀態
+        """
+        return {
+            "balance": initial_capital,
+            "position": None,       # 持倉狀態: None 或 dict
+            "pending_order": None,  # 掛單狀態: None 或 {entry_price, expiry, reason, sl, tp}
+            "ai_cooldown": 0,       # 為了節省 Token，設定冷卻時間
+            "trades": [],           # 交易紀錄
+            "equity_curve": [],     # 資產曲線
+            "signals": [],          # 每次詢問訊號來源的原始回覆 (可拿來重播)
+            "next_index": self.START_INDEX,
+        }
+
+    def run(self, df: pd.DataFrame, state: dict, stock_id: str, signal_fn,
+            on_checkpoint=None, checkpoint_every: int = 20, bars: dict = None) -> dict:
+        """
+        從 state['next_index'] 開始逐日模擬到資料結尾
+        :param signal_fn: signal_fn(i) -> dict，回傳第 i 天收盤後的交易訊號 (action/entry_price/stop_loss/take_profit)
+        :param on_checkpoint: on_checkpoint(state)，每跑 checkpoint_every 天呼叫一次
+        :param bars: 已經 prepare_bars 過的資料 (同一份 df 重複模擬時可省下轉換時間)
+        """
+        if bars is None:
+            bars = self.prepare_bars(df)
+        steps = 0
+        for i in range(state["next_index"], len(df) - 1):
+            self.step(bars, i, state, stock_id, signal_fn)
+            state["next_index"] = i + 1
+
+            steps += 1
+            if on_checkpoint and steps % checkpoint_every == 0:
+                on_checkpoint(state)
+
+        return state
+
+    def prepare_bars(self, df: pd.DataFrame) -> dict:
+        """
+        先把 OHLC 轉成 NumPy 陣列、日期轉成字串，避免每天都做 df.iloc (很慢)
+        """
+        return {
+            "dates": [str(d.date()) for d in df.index],
+            "open": df['Open'].to_numpy(dtype=float),
+            "high": df['High'].to_numpy(dtype=float),
+            "low": df['Low'].to_numpy(dtype=float),
+            "close": df['Close'].to_numpy(dtype=float),
+        }
+
+    def step(self, bars: dict, i: int, state: dict, stock_id: str, signal_fn):
+        """
+        模擬單一交易日 (第 i 天收盤後決策，第 i+1 天成交)
+        注意：signal_fn 拋出例外時，state 不會被修改 (可安全從第 i 天重跑)
+        """
+        # 隔天的價格用來模擬成交
+        next_open = bars["open"][i + 1]
+        next_high = bars["high"][i + 1]
+        next_low = bars["low"][i + 1]
+        next_date = bars["dates"][i + 1]
+
+        position = state["position"]
+        pending_order = state["pending_order"]
+
+        # 每日資產快照 (現金 + 持倉市值)，等這一天跑完才寫入
+        current_equity = state["balance"]
+        if position:
+            current_equity += (position['shares'] * bars["close"][i])
+        equity_point = {"date": bars["dates"][i], "equity": current_equity}
+
+        # --- 狀態 1: 持倉中 (檢查停損停利) ---
+        if position:
+            # 檢查隔天是否觸發出場
+            exit_price = None
+            exit_reason = ""
+
+            # 優先檢查停損 (假設盤中先碰到低點)
+            if next_low <= position['stop_loss']:
+                exit_price = min(next_open, position['stop_loss'])
+                exit_reason = "停損出場"
+
+            # 再檢查停利
+            elif next_high >= position['take_profit']:
+                exit_price = max(next_open, position['take_profit'])
+                exit_reason = "停利出場"
+
+            # 執行出場
+            if exit_price:
+                revenue = self.calculate_cost(exit_price, position['shares'], is_buy=False)
+                state["balance"] += revenue
+                profit = revenue - position['cost_basis']
+                profit_pct = (profit / position['cost_basis']) * 100
+
+                state["trades"].append({
+                    "entry_date": position['entry_date'],
+                    "exit_date": next_date,
+                    "stock_id": stock_id,
+                    "type": "Long",
+                    "entry_price": position['entry_price'],
+                    "exit_price": exit_price,
+                    "stop_loss": position['stop_loss'],     # 當時設定的停損
+                    "take_profit": position['take_profit'], # 當時設定的停利
+                    "shares": position['shares'],
+                    "profit": int(profit),
+                    "profit_pct": round(profit_pct, 2),
+                    "reason": exit_reason
+                })
+                state["position"] = None # 恢復空手
+                state["ai_cooldown"] = 0 # 剛賣出，可以馬上再問 AI
+
+        # --- 狀態 2: 有掛單 (檢查是否成交或過期) ---
+        elif pending_order:
+            # 1. 檢查過期
+            pending_order['expiry'] -= 1
+            if pending_order['expiry'] <= 0:
+                # 訂單過期，取消
+                state["pending_order"] = None
+                state["ai_cooldown"] = 0 # 重新分析
+
+            # 2. 檢查是否成交 (隔天最低價 < 掛單價)
+            elif next_low <= pending_order['entry_price']:
+                # 成交！
+                # 如果開盤就低於掛單價，以開盤價成交 (買更便宜)
+                real_entry_price = min(next_open, pending_order['entry_price'])
+
+                # 計算可買股數 (簡單全倉，預留部分現金付手續費)
+                max_amount = state["balance"] * self.cash_ratio
+                shares = int(max_amount / real_entry_price)
+
+                if shares > 0:
+                    cost_basis = self.calculate_cost(real_entry_price, shares, is_buy=True)
+                    if state["balance"] >= cost_basis:
+                        state["balance"] -= cost_basis
+                        state["position"] = {
+                            "entry_date": next_date,
+                            "entry_price": real_entry_price,
+                            "shares": shares,
+                            "cost_basis": cost_basis,
+                            "stop_loss": pending_order['sl'],
+                            "take_profit": pending_order['tp']
+                        }
+                        # 成交後清除掛單
+                        state["pending_order"] = None
+
+        # --- 狀態 3: 空手且無掛單 (詢問訊號來源) ---
+        else:
+            if state["ai_cooldown"] > 0:
+                state["ai_cooldown"] -= 1
+            else:
+                signal = signal_fn(i)
+                state["signals"].append({
+                    "date": bars["dates"][i],
+                    **{k: signal.get(k) for k in self.SIGNAL_FIELDS if k in signal}
+                })
+
+                # 缺少價位的 BUY 視同觀望
+                is_buy = signal.get('action') == "BUY" and all(
+                    k in signal for k in ("entry_price", "stop_loss", "take_profit")
+                )
+                if signal.get('action') == "SKIP":
+                    # 預篩沒通過 (沒有問 AI)，隔天繼續檢查，不進入冷卻
+                    pass
+                elif is_buy:
+                    # 建議買進 -> 建立掛單
+                    state["pending_order"] = {
+                        "entry_price": signal['entry_price'],
+                        "sl": signal['stop_loss'],
+                        "tp": signal['take_profit'],
+                        "expiry": self.order_expiry,
+                        "reason": signal.get('reason', 'AI Signal')
+                    }
+                else:
+                    # 說 HOLD -> 冷卻 N 天別吵它
+                    state["ai_cooldown"] = self.hold_cooldown
+
+        state["equity_curve"].append(equity_point)
+
+    def summarize(self, df: pd.DataFrame, state: dict, stock_id: str, initial_capital: float, rolled: bool = False) -> dict:
+        """
+        整理最終結果
+        :param rolled: 資產曲線已經 roll_window 過，報酬率改以區間第一天的資產為基準
+        """
+        final_equity = state["balance"]
+        position = state["position"]
+        if position: # 如果最後一天還持倉，以收盤價計算市值
+            # 這裡簡化不扣賣出手續費，僅算市值
+            final_equity += (position['shares'] * df.iloc[-1]['Close'])
+
+        base_equity = initial_capital
+        if rolled and state["equity_curve"]:
+            base_equity = state["equity_curve"][0]["equity"]
+
+        result = {
+            "stock_id": stock_id,
+            "initial_capital": initial_capital,
+            "final_equity": int(final_equity),
+            "total_return_pct": round(((final_equity - base_equity) / base_equity) * 100, 2),
+            "trade_count": len(state["trades"]),
+            "trades": state["trades"],
+            "equity_curve": state["equity_curve"],
+            # 最後的模擬狀態，之後有新交易日時可直接接續 (不含 trades/equity_curve/signals)
+            "sim_state": self.final_state(df, state)
+        }
+        if rolled:
+            result["window_start_equity"] = base_equity
+        return result
+
+    def final_state(self, df: pd.DataFrame, state: dict) -> dict:
+        dumped = self.dump_state(df, state)
+        dumped.pop("trades")
+        dumped.pop("equity_curve")
+        dumped.pop("signals", None)
+        return dumped
+
+    def state_from_result(self, df: pd.DataFrame, result: dict, signals: list = None):
+        """
+        從舊的回測結果還原狀態 (用來延伸到新的交易日)，無法延伸時回傳 None
+        """
+        sim_state = result.get("sim_state")
+        if not sim_state:
+            return None
+
+        dumped = dict(sim_state)
+        dumped["trades"] = list(result.get("trades", []))
+        dumped["equity_curve"] = list(result.get("equity_curve", []))
+        dumped["signals"] = list(signals or [])
+        return self.load_state(df, dumped)
+
+    def replay(self, df: pd.DataFrame, stock_id: str, initial_capital: float, signals: list, bars: dict = None) -> dict:
+        """
+        用已保存的訊號重新模擬 (不呼叫 AI)，可搭配不同的執行參數
+        原本回測沒問過的日子 (例如當時在冷卻中) 一律視為觀望，次數記在 replay_stats
+        """
+        if bars is None:
+            bars = self.prepare_bars(df)
+        by_date = {s["date"]: s for s in signals}
+
+        state = self.new_state(initial_capital)
+        # 從原本回測的第一個訊號日開始 (資料區間可能已經往後位移)
+        if signals and signals[0]["date"] in bars["dates"]:
+            state["next_index"] = bars["dates"].index(signals[0]["date"])
+
+        missing = []
+        def recorded_signal(i):
+            signal = by_date.get(bars["dates"][i])
+            if signal is None:
+                missing.append(bars["dates"][i])
+                return {"action": "HOLD"}
+            return signal
+
+        self.run(df, state, stock_id, recorded_signal, bars=bars)
+        result = self.summarize(df, state, stock_id, initial_capital)
+        result["replay_stats"] = {
+            "signals_used": len(state["signals"]) - len(missing),
+            "missing_signals": len(missing)
+        }
+        return result
+
+    def roll_window(self, df: pd.DataFrame, state: dict):
+        """
+        把資料區間起點之前的資產曲線與交易紀錄移除 (讓延伸後的結果維持在最近一段區間)
+        """
+        window_start = str(df.index[self.START_INDEX].date())
+        state["equity_curve"] = [p for p in state["equity_curve"] if p["date"] >= window_start]
+        state["trades"] = [t for t in state["trades"] if t["exit_date"] >= window_start]
+        state["signals"] = [s for s in state.get("signals", []) if s["date"] >= window_start]
+
+    def dump_state(self, df: pd.DataFrame, state: dict) -> dict:
+        """
+        轉成可存入資料庫的格式 (索引換成日期，避免資料區間位移後對不上)
+        """
+        dumped = dict(state)
+        next_index = dumped.pop("next_index")
+        dumped["next_date"] = str(df.index[next_index].date())
+        return dumped
+
+    def load_state(self, df: pd.DataFrame, dumped: dict):
+        """
+        從存檔還原狀態，若存檔日期已不在這份資料中則回傳 None
+        """
+        dates = [str(d.date()) for d in df.index]
+        next_date = dumped.get("next_date")
+        if next_date not in dates:
+            return None
+
+        state = dict(dumped)
+        state.pop("next_date")
+        state.setdefault("signals", [])
+        state["next_index"] = dates.index(next_date)
+        return state
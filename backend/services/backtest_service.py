@@ -1,77 +1,606 @@
 # backend/services/backtest_service.py
 import json
+import hashlib
+import itertools
 from typing import Optional
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 import models
 from services.stock_service import StockService
 from services.ai_service import AIService
+from services.llm_resilience import LLMRetryLaterError
+from services.backtest_engine import BacktestEngine
+from services.signal_prefetcher import SignalPrefetcher
+from services.analytics_service import AnalyticsService
+
+
+def simulate_rule_backtest(df: pd.DataFrame, stock_id: str, strategies: list, initial_capital: float,
+                           stop_loss_pct: float = 0.05, take_profit_pct: float = 0.10, start_index: int = None,
+                           flags: pd.DataFrame = None) -> dict:
+    """
+    規則型回測 (不呼叫 AI)：選股策略任一成立的那天收盤掛單買進
+    掛單、停損、停利的撮合方式與 AI 回測相同；訊號不花錢，所以觀望後不設冷卻
+    :param start_index: 從第幾根 K 棒開始模擬 (預設 BacktestEngine.START_INDEX)
+    :param flags: 事先算好、跟 df 對齊的策略訊號 (df 是長歷史的片段時，由呼叫端用完整歷史算好再切片，
+                  避免 MA120 等長週期指標在片段開頭算不出來)
+    """
+    engine = BacktestEngine(hold_cooldown=0)
+    stock_service = StockService()
+
+    # 一次算完整段歷史的策略訊號
+    if flags is None:
+        flags = stock_service.compute_strategy_signals(df, strategies)
+    entry_mask = flags.any(axis=1).to_numpy()
+    flag_values = flags.to_numpy()
+    closes = df['Close'].to_numpy(dtype=float)
+
+    def rule_signal(i):
+        if not entry_mask[i]:
+            return {"action": "HOLD"}
+        price = float(closes[i])
+        matched = [stock_service.STRATEGY_LABELS[code] for code, hit in zip(flags.columns, flag_values[i]) if hit]
+        return {
+            "action": "BUY",
+            "entry_price": price,
+            "stop_loss": round(price * (1 - stop_loss_pct), 2),
+            "take_profit": round(price * (1 + take_profit_pct), 2),
+            "reason": "、".join(matched)
+        }
+
+    state = engine.new_state(initial_capital)
+    if start_index is not None:
+        state["next_index"] = start_index
+    state = engine.run(df, state, stock_id, rule_signal)
+    result = engine.summarize(df, state, stock_id, initial_capital)
+    result["signals"] = state["signals"]
+    return result
+
+
+def _rule_backtest_worker(job: tuple) -> dict:
+    """
+    給 ProcessPoolExecutor 用的 worker (必須是模組層級函式才能 pickle)
+    只回傳摘要，避免大量資產曲線在行程間搬來搬去
+    """
+    stock_id, df, strategies, initial_capital, stop_loss_pct, take_profit_pct = job
+    try:
+        result = simulate_rule_backtest(df, stock_id, strategies, initial_capital, stop_loss_pct, take_profit_pct)
+        return {
+            "stock_id": stock_id,
+            "final_equity": result["final_equity"],
+            "total_return_pct": result["total_return_pct"],
+            "trade_count": result["trade_count"]
+        }
+    except Exception as e:
+        return {"stock_id": stock_id, "error": str(e)}
+
 
 class BacktestService:
+    # 每模擬幾個交易日存檔一次
+    CHECKPOINT_EVERY = 20
+    # 存檔保留天數，太舊的存檔不接續 (資料已經過期)
+    CHECKPOINT_TTL_DAYS = 3
+    # 不放進 result_data 的大欄位 (另外存到 backtest_curves)
+    CURVE_FIELDS = ("equity_curve", "trades")
+    # 每次執行都可能不同、不影響回測結果的欄位 (計算內容雜湊時排除)
+    VOLATILE_FIELDS = ("signal_set_id", "reused_signals", "prefetch_stats", "gate_stats", "metrics")
+    # 網格重播最多幾組參數
+    MAX_REPLAY_GRID = 1000
+    # 可以在重播時調整的執行參數 (對應 BacktestEngine 的建構參數)
+    REPLAY_PARAMS = ("fee_rate", "tax_rate", "order_expiry", "hold_cooldown", "cash_ratio")
+    # 找可重用的訊號時看最近幾份訊號紀錄
+    REUSE_SIGNAL_SETS = 5
+    # AI 預篩條件 (gate) 的內建名稱；其他字串視為選股策略代號或 DataFrame.eval 運算式
+    GATE_PRESETS = ("trend", "kd", "volume")
+
     def __init__(self):
         self.stock_service = StockService()
         self.ai_service = AIService()
+        self.engine = BacktestEngine()
+        self.analytics = AnalyticsService()
+
+    def build_versions(self, df_raw: pd.DataFrame, prompt_style: Optional[str] = None) -> dict:
+        """
+        回測結果的版本：價格資料快照、prompt 版本 (規則型回測沒有 prompt)、撮合引擎版本
+        df_raw 要先經過 StockService.completed_sessions，快照才不會隨盤中價格變動
+        """
+        return {
+            "data_snapshot_id": self.stock_service.price_digest(df_raw),
+            "prompt_version": self.ai_service.prompt_version(prompt_style) if prompt_style else None,
+            "engine_version": BacktestEngine.ENGINE_VERSION,
+        }
+
+    def data_tail(self, df_raw: pd.DataFrame, end_pos: int) -> dict:
+        """
+        記錄到第 end_pos 根 K 棒為止的價格雜湊，之後接續時用來確認重疊區間的資料沒有變
+        """
+        end_date = str(df_raw.index[end_pos].date())
+        return {"end_date": end_date, "digest": self.stock_service.tail_digest(df_raw, end_date)}
+
+    def can_resume(self, df_raw: pd.DataFrame, meta: Optional[dict], versions: dict) -> bool:
+        """
+        舊的狀態 (存檔或上次的結果) 能不能接續：prompt、引擎版本相同，且重疊區間的價格沒被調整過
+        """
+        if not meta:
+            return False
+        if meta.get("prompt_version") != versions["prompt_version"] or meta.get("engine_version") != versions["engine_version"]:
+            return False
+        tail = meta.get("data_tail") or {}
+        digest = self.stock_service.tail_digest(df_raw, tail.get("end_date"))
+        return digest is not None and digest == tail.get("digest")
 
-    def get_cached_result(self, db: Session, stock_id: str, capital: float, strategy_name: str):
+    def get_cached_result(self, db: Session, stock_id: str, capital: float, strategy_name: str, versions: dict):
         """
-        檢查是否有 24 小時內的有效快取
+        找出資料快照、prompt 版本、引擎版本完全相同的結果 (不限時間，任一版本變了就不算)
         """
-        one_day_ago = datetime.utcnow() - timedelta(days=1)
         record = db.query(models.BacktestRecord).filter(
             models.BacktestRecord.stock_id == stock_id,
             models.BacktestRecord.initial_capital == capital,
             models.BacktestRecord.strategy_name == strategy_name,
-            models.BacktestRecord.created_at >= one_day_ago
+            models.BacktestRecord.data_snapshot_id == versions["data_snapshot_id"],
+            models.BacktestRecord.prompt_version == versions["prompt_version"],
+            models.BacktestRecord.engine_version == versions["engine_version"]
         ).order_by(models.BacktestRecord.created_at.desc()).first()
         
         if record:
-            return json.loads(record.result_data)
+            return self.load_full_result(db, record)
         return None
 
-    def save_result(self, db: Session, stock_id: str, capital: float, result: dict, strategy_name: str):
+    def save_result(self, db: Session, stock_id: str, capital: float, result: dict, strategy_name: str, versions: Optional[dict] = None):
         """
         將結果存入資料庫
+        result_data 只放摘要；資產曲線與交易明細另外壓縮存到 backtest_curves，列表頁不用整包讀出來
         """
+        content_hash = self.content_hash(stock_id, capital, strategy_name, result)
+
+        # 完全一樣的結果已經存過：更新時間就好 (快取重新計時)，不再新增一筆
+        existing = db.query(models.BacktestRecord).filter(
+            models.BacktestRecord.stock_id == stock_id,
+            models.BacktestRecord.strategy_name == strategy_name,
+            models.BacktestRecord.initial_capital == capital,
+            models.BacktestRecord.content_hash == content_hash
+        ).first()
+        if existing:
+            existing.created_at = func.now()
+            self._set_versions(existing, versions)
+            # 這次剛存的訊號改由舊紀錄引用 (版本與紀錄一致)，原本那份沒人用了才會被保留政策清掉
+            summary = json.loads(existing.result_data)
+            if result.get("signal_set_id") and summary.get("signal_set_id") != result["signal_set_id"]:
+                summary["signal_set_id"] = result["signal_set_id"]
+                existing.result_data = json.dumps(summary)
+            self.update_leaderboard(db, existing)
+            db.commit()
+            return
+
+        summary = {k: v for k, v in result.items() if k not in self.CURVE_FIELDS}
+        # 績效指標存檔時就算好，歷史列表不用每次讀出所有資產曲線
+        summary["metrics"] = self.analytics.result_metrics(result)
+        provider, model_name, prompt_style = self.parse_strategy_key(strategy_name)
         db_record = models.BacktestRecord(
             stock_id=stock_id,
             strategy_name=strategy_name,
             initial_capital=capital,
-            result_data=json.dumps(result) # 轉成 JSON 字串
+            result_data=json.dumps(summary), # 轉成 JSON 字串
+            final_equity=result.get("final_equity"),
+            total_return_pct=result.get("total_return_pct"),
+            trade_count=result.get("trade_count"),
+            provider=provider,
+            model_name=model_name,
+            prompt_style=prompt_style,
+            content_hash=content_hash
         )
+        self._set_versions(db_record, versions)
         db.add(db_record)
+        db.flush()  # 先拿到 id
+        db.add(self._build_curve(db_record.id, result))
+        self.update_leaderboard(db, db_record)
+        db.commit()
+
+    def _set_versions(self, row, versions: Optional[dict]) -> None:
+        for key, value in (versions or {}).items():
+            setattr(row, key, value)
+
+    def content_hash(self, stock_id: str, capital: float, strategy_name: str, result: dict) -> str:
+        """
+        回測結果的內容雜湊 (不含每次執行都會不同的統計欄位)
+        資產曲線由交易與價格決定，而且存檔後只保留 float32 精度，所以不列入雜湊
+        """
+        payload = {k: v for k, v in result.items() if k not in self.VOLATILE_FIELDS and k != "equity_curve"}
+        raw = json.dumps([stock_id, float(capital), strategy_name, payload], sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def parse_strategy_key(self, strategy_name: str):
+        """
+        拆解 build_strategy_key 產生的名稱，回傳 (provider, model_name, prompt_style)
+        例如 "Backtest_ollama_gemma3:12b_balanced|gate:trend" -> ("ollama", "gemma3:12b", "balanced")
+        規則型 "Backtest_rule_KD_Golden_Cross_sl5-tp10" -> ("rule", "KD_Golden_Cross", "sl5-tp10")
+        """
+        clean = strategy_name.split("|")[0]
+        if clean.startswith("Backtest_"):
+            clean = clean[len("Backtest_"):]
+        parts = clean.split("_")
+        if len(parts) < 3:
+            return parts[0], None, None
+        # 模型名稱可能含有 "_"，所以頭尾以外的都算模型名稱
+        return parts[0], "_".join(parts[1:-1]), parts[-1]
+
+    def update_leaderboard(self, db: Session, record) -> None:
+        """
+        把一筆回測紀錄寫進排行榜 (同一檔股票、同一個策略設定只保留最新的結果)，不會 commit
+        """
+        entry = db.query(models.BacktestLeaderboard).filter(
+            models.BacktestLeaderboard.stock_id == record.stock_id,
+            models.BacktestLeaderboard.strategy_name == record.strategy_name
+        ).first()
+        if entry is None:
+            entry = models.BacktestLeaderboard(stock_id=record.stock_id, strategy_name=record.strategy_name)
+            db.add(entry)
+
+        entry.provider = record.provider
+        entry.model_name = record.model_name
+        entry.prompt_style = record.prompt_style
+        entry.record_id = record.id
+        entry.initial_capital = record.initial_capital
+        entry.final_equity = record.final_equity
+        entry.total_return_pct = record.total_return_pct
+        entry.trade_count = record.trade_count
+
+    def backfill_records(self, db: Session) -> int:
+        """
+        補齊舊紀錄的摘要欄位與排行榜 (啟動時執行一次)
+        :return: 補了幾筆
+        """
+        legacy = db.query(models.BacktestRecord).filter(
+            (models.BacktestRecord.provider.is_(None)) | (models.BacktestRecord.final_equity.is_(None))
+        ).order_by(models.BacktestRecord.created_at).all()
+        has_board = db.query(models.BacktestLeaderboard.id).first() is not None
+        if not legacy and has_board:
+            return 0
+
+        for record in legacy:
+            if record.final_equity is None:
+                self._compact_record(db, record)
+            record.provider, record.model_name, record.prompt_style = self.parse_strategy_key(record.strategy_name)
+
+        # 每個 (股票, 策略設定) 取最新一筆寫入排行榜
+        db.flush()
+        latest = {}
+        for record in db.query(models.BacktestRecord).order_by(models.BacktestRecord.created_at, models.BacktestRecord.id).all():
+            latest[(record.stock_id, record.strategy_name)] = record
+        for record in latest.values():
+            self.update_leaderboard(db, record)
         db.commit()
+        return len(legacy)
+
+    def get_top_configs(self, db: Session, stock_id: str, limit: int = 2, include_rule: bool = False, include_variants: bool = True) -> list:
+        """
+        某檔股票報酬率最高的幾個策略設定 (走 stock_id + total_return_pct 索引)
+        :param include_variants: False 時排除有附加設定 ("|gate:..."、"|rolled") 的策略，只看單純的模型 + 風格
+        """
+        query = db.query(models.BacktestLeaderboard).filter(models.BacktestLeaderboard.stock_id == stock_id)
+        if not include_rule:
+            query = query.filter(models.BacktestLeaderboard.provider != "rule")
+        if not include_variants:
+            query = query.filter(~models.BacktestLeaderboard.strategy_name.contains("|"))
+        return query.order_by(models.BacktestLeaderboard.total_return_pct.desc()).limit(limit).all()
+
+    def get_leaderboard(self, db: Session, stock_id: Optional[str] = None, limit: int = 10, include_rule: bool = False) -> dict:
+        """
+        排行榜：指定股票時列出該股最佳設定；沒指定時彙整所有股票，依策略設定的平均報酬排名
+        以完整的策略名稱分組，有預篩條件 (|gate:...) 或 roll_window 的變體不會跟原本的設定平均在一起
+        """
+        if stock_id:
+            entries = self.get_top_configs(db, stock_id, limit, include_rule)
+            return {"stock_id": stock_id, "entries": [self._leaderboard_row(e) for e in entries]}
+
+        board = models.BacktestLeaderboard
+        query = db.query(
+            board.strategy_name, board.provider, board.model_name, board.prompt_style,
+            func.count(func.distinct(board.stock_id)), func.avg(board.total_return_pct),
+            func.max(board.total_return_pct), func.min(board.total_return_pct)
+        )
+        if not include_rule:
+            query = query.filter(board.provider != "rule")
+        rows = query.group_by(board.strategy_name, board.provider, board.model_name, board.prompt_style)\
+            .order_by(func.avg(board.total_return_pct).desc())\
+            .limit(limit).all()
+
+        top_entries = db.query(board)
+        if not include_rule:
+            top_entries = top_entries.filter(board.provider != "rule")
+        top_entries = top_entries.order_by(board.total_return_pct.desc()).limit(limit).all()
+
+        return {
+            "configs": [{
+                "strategy_name": r[0],
+                "provider": r[1],
+                "model_name": r[2],
+                "prompt_style": r[3],
+                "stock_count": r[4],
+                "avg_return_pct": round(r[5], 2) if r[5] is not None else None,
+                "best_return_pct": r[6],
+                "worst_return_pct": r[7]
+            } for r in rows],
+            "entries": [self._leaderboard_row(e) for e in top_entries]
+        }
+
+    def _leaderboard_row(self, entry) -> dict:
+        return {
+            "stock_id": entry.stock_id,
+            "strategy_name": entry.strategy_name,
+            "provider": entry.provider,
+            "model_name": entry.model_name,
+            "prompt_style": entry.prompt_style,
+            "record_id": entry.record_id,
+            "initial_capital": entry.initial_capital,
+            "final_equity": entry.final_equity,
+            "total_return_pct": entry.total_return_pct,
+            "trade_count": entry.trade_count,
+            "updated_at": entry.updated_at
+        }
+
+    def _build_curve(self, record_id: int, result: dict):
+        """
+        資產曲線轉成「起始日 + 天數差 (int32)」與「起始資產 + 差值 (float32)」兩段二進位資料
+        """
+        curve = result.get("equity_curve") or []
+        row = models.BacktestCurve(record_id=record_id, trades_data=json.dumps(result.get("trades") or []))
+        if curve:
+            dates = np.array([p["date"] for p in curve], dtype="datetime64[D]")
+            equity = np.array([p["equity"] for p in curve], dtype=float)
+            row.base_date = str(dates[0])
+            row.equity_base = float(equity[0])
+            row.date_offsets = (dates - dates[0]).astype("<i4").tobytes()
+            row.equity_deltas = (equity - equity[0]).astype("<f4").tobytes()
+        return row
+
+    def _unpack_curve(self, row) -> dict:
+        equity_curve = []
+        if row.base_date:
+            offsets = np.frombuffer(row.date_offsets, dtype="<i4")
+            deltas = np.frombuffer(row.equity_deltas, dtype="<f4").astype(float)
+            dates = np.datetime64(row.base_date, "D") + offsets.astype("timedelta64[D]")
+            # float32 只保留約 7 位有效數字，取到小數第二位就夠了
+            equity = np.round(row.equity_base + deltas, 2)
+            equity_curve = [{"date": str(d), "equity": float(e)} for d, e in zip(dates, equity)]
+        return {"equity_curve": equity_curve, "trades": json.loads(row.trades_data or "[]")}
+
+    def get_curve(self, db: Session, record_id: int) -> Optional[dict]:
+        """
+        取得單筆紀錄的資產曲線與交易明細 (舊資料直接從 result_data 取)
+        """
+        row = db.query(models.BacktestCurve).filter(models.BacktestCurve.record_id == record_id).first()
+        if row:
+            return {"record_id": record_id, **self._unpack_curve(row)}
+
+        record = db.query(models.BacktestRecord).filter(models.BacktestRecord.id == record_id).first()
+        if not record:
+            return None
+        data = json.loads(record.result_data)
+        return {"record_id": record_id, "equity_curve": data.get("equity_curve", []), "trades": data.get("trades", [])}
+
+    def load_full_result(self, db: Session, record) -> dict:
+        """
+        摘要 + 資產曲線 + 交易明細，組回跟 run_backtest 回傳相同的格式
+        """
+        result = json.loads(record.result_data)
+        if "equity_curve" not in result:
+            curve = self.get_curve(db, record.id)
+            result["equity_curve"] = curve["equity_curve"]
+            result["trades"] = curve["trades"]
+        return result
+
+    def _compact_record(self, db: Session, record) -> None:
+        """
+        舊格式 (整包 JSON) 的紀錄搬到新格式：補上摘要欄位，曲線移到 backtest_curves
+        """
+        data = json.loads(record.result_data)
+        if any(k in data for k in self.CURVE_FIELDS):
+            db.add(self._build_curve(record.id, data))
+            record.result_data = json.dumps({k: v for k, v in data.items() if k not in self.CURVE_FIELDS})
+        record.final_equity = data.get("final_equity")
+        record.total_return_pct = data.get("total_return_pct")
+        record.trade_count = data.get("trade_count")
 
     def calculate_cost(self, price: float, shares: int, is_buy: bool) -> float:
         """
         計算交易成本 (含手續費與稅)
         """
-        fee_rate = 0.001425
-        tax_rate = 0.003
-        
-        amount = price * shares
-        # 手續費最低 20 元 (這裡簡化，先不設低消)
-        fee = int(amount * fee_rate)
-        
-        if is_buy:
-            return amount + fee
+        return self.engine.calculate_cost(price, shares, is_buy)
+
+    def save_signals(self, db: Session, stock_id: str, strategy_name: str, signals: list, versions: Optional[dict] = None, digests: Optional[dict] = None) -> int:
+        """
+        保存回測期間的原始訊號，回傳紀錄 id
+        :param digests: stock_service.tail_digests 的結果，每個訊號記下當天的價格雜湊 (之後逐日判斷能不能重用)
+        """
+        if digests:
+            signals = [{**s, "digest": digests.get(s["date"])} for s in signals]
+        signal_set = models.BacktestSignalSet(
+            stock_id=stock_id,
+            strategy_name=strategy_name,
+            signals=json.dumps(signals),
+            data_snapshot_id=(versions or {}).get("data_snapshot_id"),
+            prompt_version=(versions or {}).get("prompt_version")
+        )
+        db.add(signal_set)
+        db.commit()
+        db.refresh(signal_set)
+        return signal_set.id
+
+    def get_reusable_signals(self, db: Session, stock_id: str, strategy_name: str, versions: dict, digests: dict) -> dict:
+        """
+        訊號只跟股價與 AI 設定有關，跟初始資金無關
+        同一檔股票、同一組策略、同一個 prompt 版本最近幾次保存的訊號，
+        當天 (含之前 20 根 K 棒) 的價格沒變的日子就沿用 (換資金、多了新交易日都不用重問 AI)
+        沒有逐日雜湊的舊訊號只有價格快照完全相同時才沿用
+        :param digests: 目前價格資料的 stock_service.tail_digests
+        回傳 {日期: 訊號}
+        """
+        signal_sets = db.query(models.BacktestSignalSet).filter(
+            models.BacktestSignalSet.stock_id == stock_id,
+            models.BacktestSignalSet.strategy_name == strategy_name,
+            models.BacktestSignalSet.prompt_version == versions["prompt_version"]
+        ).order_by(models.BacktestSignalSet.created_at.desc()).limit(self.REUSE_SIGNAL_SETS).all()
+
+        known = {}
+        # 由舊到新寫入，同一天以最新的為準
+        for signal_set in reversed(signal_sets):
+            same_snapshot = signal_set.data_snapshot_id == versions["data_snapshot_id"]
+            for signal in json.loads(signal_set.signals):
+                digest = signal.pop("digest", None)
+                if (digest is not None and digest == digests.get(signal["date"])) or (digest is None and same_snapshot):
+                    known[signal["date"]] = signal
+        return known
+
+    def load_signals(self, db: Session, signal_set_id: Optional[int]) -> list:
+        if not signal_set_id:
+            return []
+        signal_set = db.query(models.BacktestSignalSet).filter(models.BacktestSignalSet.id == signal_set_id).first()
+        return json.loads(signal_set.signals) if signal_set else []
+
+    def compute_gate_mask(self, df: pd.DataFrame, gate: list) -> np.ndarray:
+        """
+        一次算出每一天是否通過預篩 (任一條件成立即通過)，只有通過的日子才需要問 AI
+        gate 每個元素可以是:
+          - 內建條件: "trend" (收盤 > MA20 > MA60)、"kd" (K > D)、"volume" (量 > 前 5 日均量 1.5 倍)
+          - 選股策略代號: 例如 "KD_Golden_Cross"
+          - 運算式: 例如 "Close > MA20 and K < 30" (欄位為 calculate_indicators 的結果)
+        """
+        mask = pd.Series(False, index=df.index)
+        for cond in gate:
+            if cond == "trend":
+                hit = (df['Close'] > df['MA20']) & (df['MA20'] > df['MA60'])
+            elif cond == "kd":
+                hit = df['K'] > df['D']
+            elif cond == "volume":
+                hit = df['Volume'] > df['Volume'].rolling(5).mean().shift(1) * 1.5
+            elif cond in self.stock_service.STRATEGY_LABELS:
+                hit = self.stock_service.compute_strategy_signals(df, [cond])[cond]
+            else:
+                hit = df.eval(cond)
+                if not isinstance(hit, pd.Series) or hit.dtype != bool:
+                    raise ValueError(f"預篩條件必須是布林運算式: {cond}")
+            mask |= hit
+        return mask.to_numpy()
+
+    def build_strategy_key(self, provider: str, model_name: str, prompt_style: str, gate: list = None, rolled: bool = False) -> str:
+        """
+        組合出唯一的策略名稱，例如 "Backtest_ollama_llama3_balanced"
+        有預篩條件時加在 "|" 後面 (例如 "Backtest_ollama_llama3_balanced|gate:trend,kd")
+        roll_window 的結果只保留最近區間、報酬率基準也不同，另外加上 "|rolled"，快取與延伸都不會跟沒 roll 的混用
+        """
+        strategy_key = f"Backtest_{provider}_{model_name}_{prompt_style}"
+        if gate:
+            strategy_key += "|gate:" + ",".join(gate)
+        if rolled:
+            strategy_key += "|rolled"
+        return strategy_key
+
+    def load_checkpoint(self, db: Session, stock_id: str, capital: float, strategy_name: str):
+        """
+        找出尚未跑完的回測存檔 (超過 CHECKPOINT_TTL_DAYS 天就不接續了)
+        """
+        expire_time = datetime.utcnow() - timedelta(days=self.CHECKPOINT_TTL_DAYS)
+        return db.query(models.BacktestCheckpoint).filter(
+            models.BacktestCheckpoint.stock_id == stock_id,
+            models.BacktestCheckpoint.initial_capital == capital,
+            models.BacktestCheckpoint.strategy_name == strategy_name,
+            models.BacktestCheckpoint.updated_at >= expire_time
+        ).order_by(models.BacktestCheckpoint.updated_at.desc()).first()
+
+    def save_checkpoint(self, db: Session, stock_id: str, capital: float, strategy_name: str, df: pd.DataFrame, state: dict, versions: Optional[dict] = None):
+        """
+        將目前的模擬狀態存檔 (同一組回測只保留一筆)
+        cache_meta 記錄當時的版本與價格雜湊，接續前先確認沒有變
+        """
+        dumped = self.engine.dump_state(df, state)
+        if versions:
+            dumped["cache_meta"] = {
+                "prompt_version": versions["prompt_version"],
+                "engine_version": versions["engine_version"],
+                "data_tail": self.data_tail(df, state["next_index"])
+            }
+        state_json = json.dumps(dumped)
+        checkpoint = db.query(models.BacktestCheckpoint).filter(
+            models.BacktestCheckpoint.stock_id == stock_id,
+            models.BacktestCheckpoint.initial_capital == capital,
+            models.BacktestCheckpoint.strategy_name == strategy_name
+        ).first()
+
+        if checkpoint:
+            checkpoint.state_data = state_json
+            checkpoint.updated_at = datetime.utcnow()
         else:
-            tax = int(amount * tax_rate)
-            return amount - fee - tax
+            db.add(models.BacktestCheckpoint(
+                stock_id=stock_id,
+                strategy_name=strategy_name,
+                initial_capital=capital,
+                state_data=state_json
+            ))
+        db.commit()
+
+    def clear_checkpoint(self, db: Session, stock_id: str, capital: float, strategy_name: str):
+        """
+        回測跑完後刪除存檔
+        """
+        db.query(models.BacktestCheckpoint).filter(
+            models.BacktestCheckpoint.stock_id == stock_id,
+            models.BacktestCheckpoint.initial_capital == capital,
+            models.BacktestCheckpoint.strategy_name == strategy_name
+        ).delete()
+        db.commit()
+
+    def get_latest_record(self, db: Session, stock_id: str, capital: float, strategy_name: str):
+        """
+        取得最近一次的回測紀錄 (不管版本)，用來延伸到新的交易日
+        """
+        return db.query(models.BacktestRecord).filter(
+            models.BacktestRecord.stock_id == stock_id,
+            models.BacktestRecord.initial_capital == capital,
+            models.BacktestRecord.strategy_name == strategy_name
+        ).order_by(models.BacktestRecord.created_at.desc()).first()
+
+    def request_signal(self, df: pd.DataFrame, i: int, api_key: str, stock_id: str, provider: str, model_name: str, ollama_url: str = None, prompt_style: str = "balanced") -> dict:
+        """
+        問 AI 第 i 天收盤後的交易訊號 (模型回覆有問題視為觀望)
+        AI 暫時無法使用 (LLMRetryLaterError) 不能當成觀望，直接往上丟讓回測存檔停止
+        """
+        # 準備數據給 AI
+        subset_df = df.iloc[:i+1] # 只看過去
+        summary = self.stock_service.get_technical_summary(subset_df)
+        try:
+            return self.ai_service.get_trade_signal(api_key, stock_id, summary['context_str'], provider=provider, model_name=model_name, ollama_url=ollama_url, prompt_style=prompt_style)
+        except LLMRetryLaterError:
+            raise
+        except Exception as e:
+            print(f"AI Call Error: {e}")
+            return {"action": "HOLD", "reason": str(e)}
 
     # 修改 run_backtest 簽章，接收 provider 和 model_name
-    def run_backtest(self, db: Session, api_key: str, stock_id: str, initial_capital: float, provider: str, model_name: str, ollama_url: str = None, prompt_style: str = "balanced"):
+    def run_backtest(self, db: Session, api_key: str, stock_id: str, initial_capital: float, provider: str, model_name: str, ollama_url: str = None, prompt_style: str = "balanced", roll_window: bool = False, gate: list = None, prefetch_window: int = 0):
+        """
+        :param roll_window: 延伸舊結果時，把超出最近一年區間的資產曲線與交易移除
+        :param gate: AI 預篩條件 (見 compute_gate_mask)，沒通過的日子不問 AI、也不進入冷卻
+        :param prefetch_window: 大於 0 時，預先並行查詢接下來幾個可能要問 AI 的日子 (見 SignalPrefetcher)
+        """
         
         # 組合出唯一的策略名稱，例如 "Backtest_ollama_llama3" 或 "Backtest_gemini_gemini-1.5-flash"
-        strategy_key = f"Backtest_{provider}_{model_name}_{prompt_style}"
+        strategy_key = self.build_strategy_key(provider, model_name, prompt_style, gate, rolled=roll_window)
+        # 訊號跟有沒有 roll_window 無關，roll 與沒 roll 的回測共用同一份訊號
+        signal_key = self.build_strategy_key(provider, model_name, prompt_style, gate)
+
+        # 1. 抓取數據 (回測最近 1 年)，價格有快取所以很快
+        # 只用已收盤的交易日：盤中的 K 棒每次抓價都不同，資料快照 (快取的 key) 會一直變
+        df_raw = self.stock_service.completed_sessions(self.stock_service.fetch_data(stock_id))
+        versions = self.build_versions(df_raw, prompt_style)
 
-        # 1. 檢查快取 (傳入新的 key)
-        cached = self.get_cached_result(db, stock_id, initial_capital, strategy_key)
+        # 2. 檢查快取：價格資料、prompt、引擎版本都沒變就直接沿用
+        cached = self.get_cached_result(db, stock_id, initial_capital, strategy_key, versions)
         if cached:
             return cached
-
-        # 2. 抓取數據 (回測最近 1 年)
-        df_raw = self.stock_service.fetch_data(stock_id)
         
         # 🔥🔥🔥 修正重點：加上這行來計算技術指標 (MA, KD, ...) 🔥🔥🔥
         df = self.stock_service.calculate_indicators(df_raw)
@@ -80,158 +609,218 @@ class BacktestService:
         if len(df) < 100:
             return {"error": "資料不足，無法回測"}
 
-        balance = initial_capital
-        position = None       # 持倉狀態: None 或 dict
-        pending_order = None  # 掛單狀態: None 或 {price, expiry, reason, sl, tp}
-        
-        trades = []           # 交易紀錄
-        equity_curve = []     # 資產曲線
-        
-        # 為了節省 Token，設定冷卻時間 (若 AI 說觀望，N 天內不問)
-        ai_cooldown = 0 
-
-        # 從第 60 天開始跑 (前面留給 MA 計算)
-        for i in range(60, len(df) - 1):
-            curr_date = df.index[i]
-            curr_row = df.iloc[i]
-            next_row = df.iloc[i+1] # 用來模擬隔天成交
-            
-            # 每日資產快照 (現金 + 持倉市值)
-            current_equity = balance
-            if position:
-                current_equity += (position['shares'] * curr_row['Close'])
-            equity_curve.append({"date": str(curr_date.date()), "equity": current_equity})
-
-            # --- 狀態 1: 持倉中 (檢查停損停利) ---
-            if position:
-                # 檢查隔天是否觸發出場
-                exit_price = None
-                exit_reason = ""
-
-                # 優先檢查停損 (假設盤中先碰到低點)
-                if next_row['Low'] <= position['stop_loss']:
-                    exit_price = min(next_row['Open'], position['stop_loss'])
-                    exit_reason = "停損出場"
-                
-                # 再檢查停利
-                elif next_row['High'] >= position['take_profit']:
-                    exit_price = max(next_row['Open'], position['take_profit'])
-                    exit_reason = "停利出場"
-                
-                # 執行出場
-                if exit_price:
-                    revenue = self.calculate_cost(exit_price, position['shares'], is_buy=False)
-                    balance += revenue
-                    profit = revenue - position['cost_basis']
-                    profit_pct = (profit / position['cost_basis']) * 100
-                    
-                    trades.append({
-                        "entry_date": position['entry_date'],
-                        "exit_date": str(next_row.name.date()),
-                        "stock_id": stock_id,
-                        "type": "Long",
-                        "entry_price": position['entry_price'],
-                        "exit_price": exit_price,
-                        "stop_loss": position['stop_loss'],     # 當時設定的停損
-                        "take_profit": position['take_profit'], # 當時設定的停利
-                        "shares": position['shares'],
-                        "profit": int(profit),
-                        "profit_pct": round(profit_pct, 2),
-                        "reason": exit_reason
-                    })
-                    position = None # 恢復空手
-                    ai_cooldown = 0 # 剛賣出，可以馬上再問 AI
-
-            # --- 狀態 2: 有掛單 (檢查是否成交或過期) ---
-            elif pending_order:
-                # 1. 檢查過期
-                pending_order['expiry'] -= 1
-                if pending_order['expiry'] <= 0:
-                    # 訂單過期，取消
-                    pending_order = None
-                    ai_cooldown = 0 # 重新分析
-                    continue
-                
-                # 2. 檢查是否成交 (隔天最低價 < 掛單價)
-                if next_row['Low'] <= pending_order['entry_price']:
-                    # 成交！
-                    # 如果開盤就低於掛單價，以開盤價成交 (買更便宜)
-                    real_entry_price = min(next_row['Open'], pending_order['entry_price'])
-                    
-                    # 計算可買股數 (簡單全倉，或固定比例)
-                    # 預留 2% 現金付手續費
-                    max_amount = balance * 0.98 
-                    shares = int(max_amount / real_entry_price)
-                    
-                    if shares > 0:
-                        cost_basis = self.calculate_cost(real_entry_price, shares, is_buy=True)
-                        if balance >= cost_basis:
-                            balance -= cost_basis
-                            position = {
-                                "entry_date": str(next_row.name.date()),
-                                "entry_price": real_entry_price,
-                                "shares": shares,
-                                "cost_basis": cost_basis,
-                                "stop_loss": pending_order['sl'],
-                                "take_profit": pending_order['tp']
-                            }
-                            # 成交後清除掛單
-                            pending_order = None 
-
-            # --- 狀態 3: 空手且無掛單 (詢問 AI) ---
-            else:
-                if ai_cooldown > 0:
-                    ai_cooldown -= 1
-                else:
-                    # 準備數據給 AI
-                    subset_df = df.iloc[:i+1] # 只看過去
-                    summary = self.stock_service.get_technical_summary(subset_df)
-                    
-                    # 呼叫 AI (這裡假設 ai_service 已經有 get_trade_signal 方法)
-                    try:
-                        signal = self.ai_service.get_trade_signal(api_key, stock_id, summary['context_str'], provider=provider, model_name=model_name, prompt_style=prompt_style)
-                        
-                        if signal.get('action') == "BUY":
-                            # AI 建議買進 -> 建立掛單
-                            pending_order = {
-                                "entry_price": signal['entry_price'],
-                                "sl": signal['stop_loss'],
-                                "tp": signal['take_profit'],
-                                "expiry": 5, # 訂單有效期 5 天
-                                "reason": signal.get('reason', 'AI Signal')
-                            }
-                        else:
-                            # AI 說 HOLD -> 冷卻 3 天別吵它
-                            ai_cooldown = 3
-                            
-                    except Exception as e:
-                        print(f"AI Call Error: {e}")
-                        ai_cooldown = 3
+        # 3. 有未完成的存檔就接續，否則從頭開始
+        state = None
+        checkpoint = self.load_checkpoint(db, stock_id, initial_capital, strategy_key)
+        if checkpoint:
+            saved = json.loads(checkpoint.state_data)
+            if self.can_resume(df_raw, saved.pop("cache_meta", None), versions):
+                state = self.engine.load_state(df, saved)
+        # 4. 沒有存檔就看舊的結果能不能延伸 (只需要跑新的交易日)
+        if state is None:
+            record = self.get_latest_record(db, stock_id, initial_capital, strategy_key)
+            if record:
+                previous = self.load_full_result(db, record)
+                meta = {"prompt_version": record.prompt_version, "engine_version": record.engine_version, "data_tail": previous.get("data_tail")}
+                if self.can_resume(df_raw, meta, versions):
+                    signals = self.load_signals(db, previous.get("signal_set_id"))
+                    state = self.engine.state_from_result(df, previous, signals)
 
-        # 整理最終結果
-        final_equity = balance
-        if position: # 如果最後一天還持倉，以收盤價計算市值
-            # 這裡簡化不扣賣出手續費，僅算市值
-            final_equity += (position['shares'] * df.iloc[-1]['Close'])
+        if state is None:
+            state = self.engine.new_state(initial_capital)
+        else:
+            print(f"Resume backtest {stock_id} {strategy_key} from {df.index[state['next_index']].date()}")
 
-        result = {
-            "stock_id": stock_id,
-            "initial_capital": initial_capital,
-            "final_equity": int(final_equity),
-            "total_return_pct": round(((final_equity - initial_capital) / initial_capital) * 100, 2),
-            "trade_count": len(trades),
-            "trades": trades,
-            "equity_curve": equity_curve
-        }
+        # 換了初始資金也能沿用之前的訊號，只有沒問過的日子才需要問 AI
+        digests = self.stock_service.tail_digests(df_raw)
+        known_signals = self.get_reusable_signals(db, stock_id, signal_key, versions, digests)
+        reuse_stats = {"reused": 0}
+
+        # 預篩：先用便宜的向量化條件排除不值得問 AI 的日子
+        gate_mask = self.compute_gate_mask(df, gate) if gate else None
+        gate_stats = {"checked_days": 0, "skipped_days": 0}
+
+        def fetch_signal(i):
+            # 可能在預先查詢的執行緒裡跑，這裡不更新統計 (由 ask_ai 在回測的執行緒計數)
+            known = known_signals.get(str(df.index[i].date()))
+            if known:
+                return known
 
-        # 3. 寫入快取
-        self.save_result(db, stock_id, initial_capital, result, strategy_key)
+            return self.request_signal(df, i, api_key, stock_id, provider, model_name, ollama_url, prompt_style)
+
+        # 推測式預先查詢：假設 AI 都回 HOLD，先並行問接下來幾個會用到的日子
+        prefetcher = None
+        if prefetch_window > 0:
+            prefetcher = SignalPrefetcher(fetch_signal, len(df), self.engine.hold_cooldown, window=prefetch_window, candidate_mask=gate_mask)
+
+        def ask_ai(i):
+            if gate_mask is not None:
+                gate_stats["checked_days"] += 1
+                if not gate_mask[i]:
+                    gate_stats["skipped_days"] += 1
+                    return {"action": "SKIP"}
+
+            signal = prefetcher(i) if prefetcher else fetch_signal(i)
+            if str(df.index[i].date()) in known_signals:
+                reuse_stats["reused"] += 1
+            return signal
+
+        def checkpoint_fn(s):
+            self.save_checkpoint(db, stock_id, initial_capital, strategy_key, df, s, versions)
+
+        try:
+            self.engine.run(df, state, stock_id, ask_ai, on_checkpoint=checkpoint_fn, checkpoint_every=self.CHECKPOINT_EVERY)
+        except LLMRetryLaterError as e:
+            # AI 暫時無法使用：存檔後回報稍後重試 (這天不當成觀望)，下次從這天接續
+            db.rollback()
+            checkpoint_fn(state)
+            resume_date = str(df.index[state["next_index"]].date())
+            return {
+                "error": f"AI 暫時無法使用，已存檔，稍後重試會從 {resume_date} 接續: {e}",
+                "retry_later": True,
+                "retry_after": e.retry_after,
+                "resume_from": resume_date
+            }
+        except Exception:
+            # 中途失敗：先把已經跑完的部分存起來，下次從這裡接續
+            db.rollback()
+            checkpoint_fn(state)
+            raise
+        finally:
+            if prefetcher:
+                prefetcher.close()
+
+        if roll_window:
+            self.engine.roll_window(df, state)
+
+        # 整理最終結果
+        result = self.engine.summarize(df, state, stock_id, initial_capital, rolled=roll_window)
+        result["data_tail"] = self.data_tail(df_raw, len(df_raw) - 1)
+        result["signal_set_id"] = self.save_signals(db, stock_id, signal_key, state["signals"], versions, digests)
+        if gate_mask is not None:
+            checked = gate_stats["checked_days"]
+            result["gate_stats"] = {
+                "gate": gate,
+                "checked_days": checked,
+                "skipped_days": gate_stats["skipped_days"],
+                "llm_calls": checked - gate_stats["skipped_days"],
+                "skip_rate_pct": round(gate_stats["skipped_days"] / checked * 100, 2) if checked else 0
+            }
+        if prefetcher:
+            result["prefetch_stats"] = prefetcher.stats
+        if known_signals:
+            result["reused_signals"] = reuse_stats["reused"]
+
+        # 5. 寫入快取，並刪除存檔
+        self.save_result(db, stock_id, initial_capital, result, strategy_key, versions)
+        self.clear_checkpoint(db, stock_id, initial_capital, strategy_key)
         
         return result
     
-    def get_history(self, db: Session, stock_id: Optional[str] = None):
+    def run_rule_backtest(self, db: Session, stock_id: str, strategies: list, initial_capital: float, stop_loss_pct: float = 0.05, take_profit_pct: float = 0.10):
+        """
+        單檔規則型回測 (作為 AI 模型的比較基準)，結果一樣存入回測紀錄
+        """
+        # 策略名稱格式與 AI 回測相同: Backtest_{provider}_{model}_{style}
+        strategy_key = f"Backtest_rule_{'+'.join(strategies)}_sl{stop_loss_pct:g}-tp{take_profit_pct:g}"
+
+        df = self.stock_service.completed_sessions(self.stock_service.fetch_data(stock_id))
+        versions = self.build_versions(df)
+        cached = self.get_cached_result(db, stock_id, initial_capital, strategy_key, versions)
+        if cached:
+            return cached
+
+        if len(df) < 100:
+            return {"error": "資料不足，無法回測"}
+
+        result = simulate_rule_backtest(df, stock_id, strategies, initial_capital, stop_loss_pct, take_profit_pct)
+        result["signal_set_id"] = self.save_signals(db, stock_id, strategy_key, result.pop("signals"), versions)
+        self.save_result(db, stock_id, initial_capital, result, strategy_key, versions)
+        return result
+
+    def run_rule_backtest_universe(self, tickers: list, strategies: list, initial_capital: float, stop_loss_pct: float = 0.05, take_profit_pct: float = 0.10, period: str = "2y", max_workers: int = None) -> list:
+        """
+        對整個股票池跑規則型回測 (多行程平行)，依報酬率由高到低排序
+        """
+        stock_data = self.stock_service.fetch_data_batch(tickers, period=period)
+        jobs = [
+            (stock_id, df, strategies, initial_capital, stop_loss_pct, take_profit_pct)
+            for stock_id, df in stock_data.items() if len(df) >= 100
+        ]
+        if not jobs:
+            return []
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_rule_backtest_worker, jobs, chunksize=16))
+
+        results.sort(key=lambda r: r.get("total_return_pct", -999), reverse=True)
+        return results
+
+    def _load_replay_source(self, db: Session, record_id: int):
+        """
+        取得重播需要的原始紀錄、訊號與價格資料
+        """
+        record = db.query(models.BacktestRecord).filter(models.BacktestRecord.id == record_id).first()
+        if not record:
+            raise ValueError(f"找不到回測紀錄 {record_id}")
+
+        signals = self.load_signals(db, json.loads(record.result_data).get("signal_set_id"))
+        if not signals:
+            raise ValueError("此回測紀錄沒有保存訊號，無法重播")
+
+        df = self.stock_service.fetch_data(record.stock_id)
+        return record, signals, df
+
+    def replay_backtest(self, db: Session, record_id: int, initial_capital: Optional[float] = None, **params):
+        """
+        用已保存的 AI 訊號重新模擬 (不呼叫 AI)
+        params 為 BacktestEngine 的執行參數: fee_rate, tax_rate, order_expiry, hold_cooldown, cash_ratio
+        """
+        record, signals, df = self._load_replay_source(db, record_id)
+        capital = initial_capital or record.initial_capital
+
+        engine = BacktestEngine(**params)
+        result = engine.replay(df, record.stock_id, capital, signals)
+        result["strategy_name"] = record.strategy_name
+        result["params"] = params
+        return result
+
+    def replay_grid(self, db: Session, record_id: int, grid: dict, initial_capital: Optional[float] = None) -> list:
+        """
+        對多組執行參數做網格重播，回傳各組摘要 (依報酬率排序)
+        grid 例如: {"hold_cooldown": [0, 1, 3], "order_expiry": [3, 5, 10]}
+        """
+        record, signals, df = self._load_replay_source(db, record_id)
+        capital = initial_capital or record.initial_capital
+
+        names = list(grid.keys())
+        unknown = [n for n in names if n not in self.REPLAY_PARAMS]
+        if unknown:
+            raise ValueError(f"不支援的參數: {', '.join(unknown)}")
+        combos = list(itertools.product(*[grid[n] for n in names]))
+        if len(combos) > self.MAX_REPLAY_GRID:
+            raise ValueError(f"參數組合過多 ({len(combos)} > {self.MAX_REPLAY_GRID})")
+
+        bars = self.engine.prepare_bars(df)
+        results = []
+        for values in combos:
+            params = dict(zip(names, values))
+            result = BacktestEngine(**params).replay(df, record.stock_id, capital, signals, bars=bars)
+            results.append({
+                "params": params,
+                "final_equity": result["final_equity"],
+                "total_return_pct": result["total_return_pct"],
+                "trade_count": result["trade_count"],
+                "replay_stats": result["replay_stats"]
+            })
+
+        results.sort(key=lambda r: r["total_return_pct"], reverse=True)
+        return results
+
+    def get_history(self, db: Session, stock_id: Optional[str] = None, with_metrics: bool = True):
         """
         查詢回測歷史紀錄
+        :param with_metrics: 一併計算績效指標 (Sharpe、最大回撤等)，放在每筆紀錄的 metrics
         """
         query = db.query(models.BacktestRecord)
         
@@ -239,7 +828,28 @@ class BacktestService:
             query = query.filter(models.BacktestRecord.stock_id == stock_id)
             
         # 依時間倒序排列，最新的在前面
-        return query.order_by(models.BacktestRecord.created_at.desc()).all()
+        records = query.order_by(models.BacktestRecord.created_at.desc()).all()
+
+        # 舊紀錄第一次被查到時順便搬成精簡格式
+        legacy = [r for r in records if r.final_equity is None]
+        if legacy:
+            for record in legacy:
+                self._compact_record(db, record)
+            db.commit()
+
+        if with_metrics:
+            # 指標在 save_result 時已經存進摘要；只有還沒有指標的舊紀錄才讀曲線計算，算完寫回去
+            summaries = {r.id: json.loads(r.result_data) for r in records}
+            missing = [r for r in records if "metrics" not in summaries[r.id]]
+            if missing:
+                computed = self.analytics.compute_metrics(db, missing)
+                for record in missing:
+                    summaries[record.id]["metrics"] = computed.get(record.id)
+                    record.result_data = json.dumps(summaries[record.id])
+                db.commit()
+            for record in records:
+                record.metrics = summaries[record.id].get("metrics")
+        return records
     
     def get_tested_stocks(self, db: Session):
         """
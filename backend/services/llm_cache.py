@@ -0,0 +1,156 @@
+# backend/services/llm_cache.py
+import os
+import hashlib
+import threading
+from datetime import datetime, timedelta, time
+from zoneinfo import ZoneInfo
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+import models
+from database import SessionLocal
+
+
+class LLMResponseCache:
+    """
+    LLM 文字報告的持久化快取
+    - key = sha256(provider, 模型, system + user prompt)；prompt 已經包含當天的技術數據，數據一變 key 就不同
+    - 有效期限到下一次收盤資料更新 (台股交易日 14:00)，之後就算 prompt 一樣也重新問
+    - 超過筆數或容量上限時，淘汰最久沒用到的 (LRU)
+    快取本身出錯 (資料庫連不上...) 只印 log，不影響分析
+    """
+    MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "2000"))
+    MAX_BYTES = int(float(os.getenv("LLM_CACHE_MAX_MB", "50")) * 1024 * 1024)
+
+    MARKET_TZ = ZoneInfo("Asia/Taipei")
+    # 收盤 13:30，留一點時間給資料源更新
+    SESSION_REFRESH = time(14, 0)
+
+    def __init__(self, session_factory=None):
+        self.session_factory = session_factory or SessionLocal
+        self._lock = threading.Lock()
+
+    def make_key(self, provider: str, model_name: str, *prompts: str) -> str:
+        h = hashlib.sha256()
+        for part in (provider or "", model_name or "", *prompts):
+            h.update(part.encode("utf-8"))
+            h.update(b"\x00")
+        return h.hexdigest()
+
+    def session_expiry(self, now: datetime = None) -> datetime:
+        """
+        下一個交易日資料更新時間 (回傳 naive UTC)，週末順延到週一
+        """
+        local = (now or datetime.utcnow()).replace(tzinfo=ZoneInfo("UTC")).astimezone(self.MARKET_TZ)
+        expiry = datetime.combine(local.date(), self.SESSION_REFRESH, tzinfo=self.MARKET_TZ)
+        if local >= expiry:
+            expiry += timedelta(days=1)
+        while expiry.weekday() >= 5:
+            expiry += timedelta(days=1)
+        return expiry.astimezone(ZoneInfo("UTC")).replace(tzinfo=None)
+
+    def get(self, key: str):
+        """
+        取出未過期的回覆，沒有就回傳 None
+        """
+        db = self.session_factory()
+        try:
+            row = db.query(models.LLMResponseCache).filter(models.LLMResponseCache.cache_key == key).first()
+            if not row:
+                return None
+            now = datetime.utcnow()
+            if row.expires_at <= now:
+                db.delete(row)
+                db.commit()
+                return None
+            response = row.response
+            # 直接在資料庫上加一，多個執行緒同時命中也不會蓋掉彼此的計數
+            db.query(models.LLMResponseCache).filter(models.LLMResponseCache.id == row.id).update(
+                {models.LLMResponseCache.hit_count: func.coalesce(models.LLMResponseCache.hit_count, 0) + 1,
+                 models.LLMResponseCache.last_used_at: now},
+                synchronize_session=False
+            )
+            db.commit()
+            return response
+        except Exception as e:
+            db.rollback()
+            print(f"LLM cache read failed: {e}")
+            return None
+        finally:
+            db.close()
+
+    def put(self, key: str, provider: str, model_name: str, response: str) -> None:
+        db = self.session_factory()
+        try:
+            try:
+                self._upsert(db, key, provider, model_name, response)
+            except IntegrityError:
+                # 另一個請求剛好也寫入同一個 key：回滾後重新讀出那一筆再更新
+                db.rollback()
+                self._upsert(db, key, provider, model_name, response)
+            self.evict(db)
+        except Exception as e:
+            db.rollback()
+            print(f"LLM cache write failed: {e}")
+        finally:
+            db.close()
+
+    def _upsert(self, db, key: str, provider: str, model_name: str, response: str) -> None:
+        now = datetime.utcnow()
+        row = db.query(models.LLMResponseCache).filter(models.LLMResponseCache.cache_key == key).first()
+        if not row:
+            row = models.LLMResponseCache(cache_key=key, provider=provider, model_name=model_name, hit_count=0)
+            db.add(row)
+        row.response = response
+        row.size_bytes = len(response.encode("utf-8"))
+        row.expires_at = self.session_expiry(now)
+        row.last_used_at = now
+        db.commit()
+
+    def evict(self, db) -> int:
+        """
+        清掉過期的，再依 last_used_at 由舊到新淘汰到筆數與容量都在上限內
+        """
+        with self._lock:
+            removed = db.query(models.LLMResponseCache).filter(
+                models.LLMResponseCache.expires_at <= datetime.utcnow()
+            ).delete(synchronize_session=False)
+
+            count, total = db.query(func.count(models.LLMResponseCache.id), func.coalesce(func.sum(models.LLMResponseCache.size_bytes), 0)).one()
+            if count > self.MAX_ENTRIES or total > self.MAX_BYTES:
+                victims = []
+                rows = db.query(models.LLMResponseCache.id, models.LLMResponseCache.size_bytes).order_by(
+                    models.LLMResponseCache.last_used_at.asc()
+                ).yield_per(500)
+                for row_id, size in rows:
+                    if count <= self.MAX_ENTRIES and total <= self.MAX_BYTES:
+                        break
+                    victims.append(row_id)
+                    count -= 1
+                    total -= size or 0
+                if victims:
+                    db.query(models.LLMResponseCache).filter(models.LLMResponseCache.id.in_(victims)).delete(synchronize_session=False)
+                removed += len(victims)
+            db.commit()
+            return removed
+
+    def stats(self) -> dict:
+        db = self.session_factory()
+        try:
+            count, total, hits = db.query(
+                func.count(models.LLMResponseCache.id),
+                func.coalesce(func.sum(models.LLMResponseCache.size_bytes), 0),
+                func.coalesce(func.sum(models.LLMResponseCache.hit_count), 0)
+            ).one()
+            return {
+                "entries": count,
+                "size_bytes": int(total),
+                "hits": int(hits),
+                "max_entries": self.MAX_ENTRIES,
+                "max_bytes": self.MAX_BYTES
+            }
+        finally:
+            db.close()
+
+
+# 整個行程共用一份 (所有 AIService 共用同一把淘汰鎖)
+response_cache = LLMResponseCache()
@@ -0,0 +1,167 @@
+# backend/services/llm_clients.py
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+import google.generativeai as genai
+import google.ai.generativelanguage as glm
+from services.llm_resilience import LLMRetryLaterError
+
+
+class LLMClientPool:
+    """
+    重複使用的 LLM 連線
+    - Ollama：每個 base URL 一個 requests.Session (keep-alive，不用每次重新 TCP/TLS 握手，ngrok 網址差很多)
+    - Gemini：每把 API Key 一組 service client、每個 (Key, 模型, system prompt) 一個 GenerativeModel，
+      不呼叫 genai.configure 改全域設定，不同使用者的 Key 同時使用也不會互相蓋掉
+    Gemini 的 client 數量有上限，超過時淘汰最久沒用的
+    """
+    # 每個 Ollama 網址的連線數 (要 >= 同時呼叫的數量，否則多的連線用完就丟)
+    HTTP_POOL_SIZE = int(os.getenv("LLM_HTTP_POOL_SIZE", "8"))
+    # 最多保留幾把 Gemini Key / 幾個 (Key, 模型, system prompt)
+    MAX_GEMINI_KEYS = int(os.getenv("GEMINI_CLIENT_CACHE_KEYS", "16"))
+    MAX_GEMINI_MODELS = int(os.getenv("GEMINI_CLIENT_CACHE_MODELS", "64"))
+    # 退回全域 configure 時：等鎖最多幾秒 (等不到就請呼叫端稍後再試)、每次請求的逾時秒數
+    CONFIGURE_WAIT = float(os.getenv("GEMINI_CONFIGURE_WAIT", "30"))
+    CONFIGURE_CALL_TIMEOUT = float(os.getenv("GEMINI_CONFIGURE_CALL_TIMEOUT", "120"))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._key_clients = OrderedDict()
+        self._models = OrderedDict()
+        # 退回全域 genai.configure 時用 (見 gemini_model)
+        self._configure_lock = threading.Lock()
+        self._warned_private_client = False
+
+    # --- Ollama ---
+    def http_session(self, base_url: str) -> requests.Session:
+        base_url = base_url.rstrip("/")
+        with self._lock:
+            session = self._sessions.get(base_url)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.HTTP_POOL_SIZE)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[base_url] = session
+            return session
+
+    # --- Gemini ---
+    def _key_id(self, api_key: str) -> str:
+        # dict 的 key 用雜湊，避免 API Key 出現在除錯輸出
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+    def _clients_for_key(self, api_key: str) -> dict:
+        key_id = self._key_id(api_key)
+        clients = self._key_clients.get(key_id)
+        if clients is None:
+            options = {"api_key": api_key}
+            clients = {
+                "generative": glm.GenerativeServiceClient(client_options=options),
+                "model": glm.ModelServiceClient(client_options=options),
+            }
+            self._key_clients[key_id] = clients
+            if len(self._key_clients) > self.MAX_GEMINI_KEYS:
+                old_id, _ = self._key_clients.popitem(last=False)
+                for k in [k for k in self._models if k[0] == old_id]:
+                    del self._models[k]
+        else:
+            self._key_clients.move_to_end(key_id)
+        return clients
+
+    @contextmanager
+    def gemini_model(self, api_key: str, model_name: str, system_instruction: str = None):
+        """
+        取得綁定這把 Key 的 GenerativeModel (不經過全域 configure)，用法: with client_pool.gemini_model(...) as model
+        system_instruction 是固定的 system prompt，每種 (模型, system) 各一個物件
+        SDK 沒有 _client 屬性 (見 _bind_client) 時退回全域 configure (見 _GlobalConfigModel)：
+        每次請求都在鎖裡送出，同一時間只服務一把 Key
+        """
+        model = self._shared_model(api_key, model_name, system_instruction)
+        if model is None:
+            model = _GlobalConfigModel(self, api_key, model_name, system_instruction)
+        yield model
+
+    def _shared_model(self, api_key: str, model_name: str, system_instruction: str = None):
+        with self._lock:
+            clients = self._clients_for_key(api_key)
+            system_id = hashlib.sha256(system_instruction.encode("utf-8")).hexdigest()[:16] if system_instruction else None
+            key = (self._key_id(api_key), model_name, system_id)
+            model = self._models.get(key)
+            if model is None:
+                model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+                if not self._bind_client(model, clients["generative"]):
+                    return None
+                self._models[key] = model
+                if len(self._models) > self.MAX_GEMINI_MODELS:
+                    self._models.popitem(last=False)
+            else:
+                self._models.move_to_end(key)
+            return model
+
+    def _bind_client(self, model: genai.GenerativeModel, client: glm.GenerativeServiceClient) -> bool:
+        """
+        把這把 Key 的 service client 塞進 GenerativeModel
+        SDK 沒有公開的參數可以指定 client，只能寫私有屬性 _client (google-generativeai 0.8.x 在第一次呼叫時
+        才用全域設定建立它)；requirements.txt 因此固定在 0.8 版，升級 SDK 前要確認這個屬性還在
+        """
+        if not hasattr(model, "_client"):
+            if not self._warned_private_client:
+                self._warned_private_client = True
+                print("google-generativeai has no GenerativeModel._client; falling back to genai.configure per call")
+            return False
+        model._client = client
+        return True
+
+    def gemini_endpoint(self, api_key: str, model_name: str) -> str:
+        """
+        Gemini 斷路器的名稱：每把 Key 的每個模型各一個，某把 Key 配額用完或失效不會擋到其他使用者
+        """
+        return f"gemini/{self._key_id(api_key)}/{model_name}"
+
+    def gemini_model_client(self, api_key: str) -> glm.ModelServiceClient:
+        with self._lock:
+            return self._clients_for_key(api_key)["model"]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "ollama_sessions": list(self._sessions.keys()),
+                "gemini_keys": len(self._key_clients),
+                "gemini_models": len(self._models),
+            }
+
+
+class _GlobalConfigModel:
+    """
+    SDK 無法綁定 client 時代替 GenerativeModel，只提供 generate_content
+    鎖只握住 configure + 建立 model + 一次請求：串流改成一次拿完整回覆
+    (非串流的回覆一樣可以用 for chunk in response 迭代，只是只有一塊)，鎖不會跟著整段串流被佔住；
+    等鎖超過 CONFIGURE_WAIT 秒視為暫時無法使用，沒指定逾時的請求套用 CONFIGURE_CALL_TIMEOUT
+    """
+
+    def __init__(self, pool: LLMClientPool, api_key: str, model_name: str, system_instruction: str = None):
+        self._pool = pool
+        self._api_key = api_key
+        self._model_name = model_name
+        self._system_instruction = system_instruction
+
+    def generate_content(self, *args, stream: bool = False, **kwargs):
+        lock = self._pool._configure_lock
+        if not lock.acquire(timeout=self._pool.CONFIGURE_WAIT):
+            raise LLMRetryLaterError("Gemini 全域設定忙碌中，請稍後再試")
+        try:
+            genai.configure(api_key=self._api_key)
+            model = genai.GenerativeModel(self._model_name, system_instruction=self._system_instruction)
+            kwargs.setdefault("request_options", {"timeout": self._pool.CONFIGURE_CALL_TIMEOUT})
+            return model.generate_content(*args, **kwargs)
+        finally:
+            lock.release()
+
+
+# 整個行程共用一份 (AIService 會在很多地方被建立)
+client_pool = LLMClientPool()
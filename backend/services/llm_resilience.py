@@ -0,0 +1,326 @@
+# backend/services/llm_resilience.py
+import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import requests
+from google.api_core import exceptions as google_exceptions
+
+
+class LLMRetryLaterError(Exception):
+    """
+    LLM 暫時無法使用 (端點故障、連線逾時、排隊太久)
+    跟模型真的回 HOLD 不同：回測遇到這個要存檔、稍後接續，不能把這天當成觀望
+    """
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMUnavailableError(LLMRetryLaterError):
+    """端點連不上、逾時或回 5xx / 429"""
+
+
+class CircuitOpenError(LLMRetryLaterError):
+    """端點最近一直失敗，斷路器打開中，直接失敗不送出請求"""
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    單一端點的斷路器
+    - closed: 正常；連續失敗 FAILURE_THRESHOLD 次就打開
+    - open: 冷卻期間所有呼叫直接失敗 (CircuitOpenError)，不再讓執行緒卡在逾時上
+    - half_open: 冷卻結束後只放一個試探請求，成功就關閉，失敗就再打開 (冷卻時間加倍，最多 MAX_COOLDOWN)
+    """
+    FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURES", "3"))
+    COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+    MAX_COOLDOWN = 300.0
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.cooldown = self.COOLDOWN
+        self.probing = False
+        self.stats = {"success": 0, "failure": 0, "rejected": 0, "opened": 0}
+
+    def retry_after(self) -> float:
+        return max(self.opened_at + self.cooldown - time.monotonic(), 0.0)
+
+    def acquire(self) -> bool:
+        """
+        能不能送出請求；half_open 時只有拿到試探名額的那一個會回傳 True
+        拿到 True 的呼叫之後一定要呼叫 record_success / record_failure / release 其中一個
+        """
+        with self._lock:
+            if self.state == "open" and self.retry_after() <= 0:
+                self.state = "half_open"
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self.probing:
+                self.probing = True
+                return True
+            self.stats["rejected"] += 1
+            return False
+
+    def available(self) -> bool:
+        # 只看狀態，不佔用試探名額
+        with self._lock:
+            return self.state == "closed" or (self.state == "open" and self.retry_after() <= 0) or \
+                (self.state == "half_open" and not self.probing)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.stats["success"] += 1
+            self.failures = 0
+            self.probing = False
+            if self.state != "closed":
+                print(f"LLM endpoint recovered: {self.endpoint}")
+            self.state = "closed"
+            self.cooldown = self.COOLDOWN
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.stats["failure"] += 1
+            self.failures += 1
+            if self.state == "half_open":
+                # 試探失敗，冷卻加倍
+                self.cooldown = min(self.cooldown * 2, self.MAX_COOLDOWN)
+            elif self.failures < self.FAILURE_THRESHOLD:
+                return
+            self.probing = False
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.stats["opened"] += 1
+            print(f"LLM endpoint circuit open ({self.cooldown:g}s): {self.endpoint}")
+
+    def release(self) -> None:
+        """
+        呼叫結束但看不出端點好壞 (排隊逾時、模型回錯誤、被對沖取消)，只歸還試探名額
+        """
+        with self._lock:
+            self.probing = False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "endpoint": self.endpoint,
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "retry_after": round(self.retry_after(), 1) if self.state == "open" else 0,
+                **self.stats,
+            }
+
+
+class LLMResilience:
+    """
+    LLM 端點的容錯層
+    - 每個端點 (Ollama 網址 / 每把 Gemini Key 的每個模型) 一個斷路器，故障時快速失敗
+    - 對沖請求 (hedged request)：短的交易訊號請求跑超過該端點 + 模型的 p95 延遲還沒回來，
+      就同時送一份到備援端點，先回來的用、另一個取消；主要端點直接失敗時也改送備援端點
+    備援端點由呼叫端給 (Ollama 端點池的其他節點)，或來自 OLLAMA_FALLBACK_URLS (逗號分隔)；都沒有時只有斷路器
+    """
+    FALLBACK_URLS = [u.strip().rstrip("/") for u in os.getenv("OLLAMA_FALLBACK_URLS", "").split(",") if u.strip()]
+    # 累積這麼多筆延遲才開始對沖 (樣本太少 p95 不準)
+    HEDGE_MIN_SAMPLES = 20
+    HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+    # 對沖前最少等幾秒 (避免很快的模型一直重複送)
+    HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "2"))
+    MAX_WORKERS = int(os.getenv("LLM_HEDGE_WORKERS", "32"))
+
+    # 算在端點頭上的錯誤 (連線問題)；其餘錯誤 (模型回錯誤訊息、JSON 壞掉) 不影響斷路器
+    TRANSIENT_ERRORS = (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+        google_exceptions.ResourceExhausted,
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {}
+        self._latencies = {}
+        self._executor = None
+        self.hedge_stats = {"hedged": 0, "hedge_won": 0, "failover": 0}
+
+    def breaker(self, endpoint: str) -> CircuitBreaker:
+        endpoint = endpoint.rstrip("/")
+        with self._lock:
+            breaker = self._breakers.get(endpoint)
+            if breaker is None:
+                breaker = CircuitBreaker(endpoint)
+                self._breakers[endpoint] = breaker
+            return breaker
+
+    def alternates(self, endpoint: str) -> list:
+        endpoint = endpoint.rstrip("/")
+        return [u for u in self.FALLBACK_URLS if u != endpoint and self.breaker(u).available()]
+
+    def record_latency(self, endpoint: str, model_name: str, profile: str, latency: float) -> None:
+        key = (endpoint.rstrip("/"), model_name, profile)
+        with self._lock:
+            samples = self._latencies.get(key)
+            if samples is None:
+                samples = deque(maxlen=200)
+                self._latencies[key] = samples
+            samples.append(latency)
+
+    def hedge_delay(self, endpoint: str, model_name: str, profile: str):
+        """
+        這個端點 + 模型 + 生成設定的 p95 延遲 (秒)，樣本不夠時回傳 None (不對沖)
+        """
+        with self._lock:
+            samples = list(self._latencies.get((endpoint.rstrip("/"), model_name, profile), ()))
+        if len(samples) < self.HEDGE_MIN_SAMPLES:
+            return None
+        return max(float(np.percentile(samples, self.HEDGE_PERCENTILE)), self.HEDGE_MIN_DELAY)
+
+    @contextmanager
+    def guard(self, endpoint: str):
+        """
+        經過斷路器執行一段呼叫：打開中丟出 CircuitOpenError；連線類錯誤記一次失敗並轉成 LLMUnavailableError
+        """
+        breaker = self.breaker(endpoint)
+        if not breaker.acquire():
+            raise CircuitOpenError(f"{breaker.endpoint} 暫停使用中 (連續失敗)", retry_after=breaker.retry_after())
+        try:
+            yield breaker
+        except LLMUnavailableError:
+            breaker.record_failure()
+            raise
+        except self.TRANSIENT_ERRORS as e:
+            breaker.record_failure()
+            # 配額用完至少等一分鐘；斷路器打開時等到冷卻結束
+            retry_after = 60 if isinstance(e, google_exceptions.ResourceExhausted) else None
+            if breaker.state == "open":
+                retry_after = max(retry_after or 0, breaker.retry_after())
+            raise LLMUnavailableError(f"{breaker.endpoint} 無法使用: {e}", retry_after=retry_after) from e
+        except BaseException:
+            breaker.release()
+            raise
+        else:
+            breaker.record_success()
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS, thread_name_prefix="llm-hedge")
+            return self._executor
+
+    def _attempt(self, endpoint: str, attempt_fn, model_name: str, profile: str, cancel: threading.Event, started: threading.Event):
+        try:
+            with self.guard(endpoint):
+                out = attempt_fn(endpoint, cancel, started)
+                if cancel.is_set():
+                    # 被對沖的另一邊搶先，結果不完整，不算成功也不算失敗
+                    raise _Cancelled()
+            self.record_latency(endpoint, model_name, profile, time.time() - out["start"])
+            return out
+        except _Cancelled:
+            return None
+        finally:
+            started.set()
+
+    def call(self, endpoint: str, attempt_fn, model_name: str, profile: str, hedge: bool = False, alternates: list = None) -> dict:
+        """
+        執行一次 LLM 呼叫 (含斷路器、失敗改送備援、對沖)
+        :param attempt_fn: attempt_fn(endpoint, cancel, started) -> dict，結果要包含 "start" (開始產生的時間)；
+                           取得執行槽後 started.set()，cancel 被設定時盡快結束
+        :param hedge: True 時跑超過 p95 延遲就同時送一份到備援端點 (只用在短的交易訊號)
+        :param alternates: 備援端點 (依優先順序)；None 時用 OLLAMA_FALLBACK_URLS
+        回傳 attempt_fn 的結果，另外加上 "endpoint" 與 "hedged"
+        """
+        endpoint = endpoint.rstrip("/")
+        if alternates is None:
+            alternates = self.alternates(endpoint)
+        candidates = [endpoint] + [u.rstrip("/") for u in alternates if u.rstrip("/") != endpoint]
+        # 主要端點斷路中就直接用第一個正常的備援
+        primary = next((u for u in candidates if self.breaker(u).available()), endpoint)
+        delay = self.hedge_delay(primary, model_name, profile) if hedge else None
+
+        if delay is None or len(candidates) < 2:
+            try:
+                return {**self._attempt(primary, attempt_fn, model_name, profile, threading.Event(), threading.Event()),
+                        "endpoint": primary, "hedged": False}
+            except LLMRetryLaterError:
+                fallback = next((u for u in candidates if u != primary and self.breaker(u).available()), None)
+                if fallback is None:
+                    raise
+                self._count_hedge("failover")
+                return {**self._attempt(fallback, attempt_fn, model_name, profile, threading.Event(), threading.Event()),
+                        "endpoint": fallback, "hedged": False}
+
+        pool = self._pool()
+        attempts = {}
+
+        def submit(url):
+            cancel, started = threading.Event(), threading.Event()
+            future = pool.submit(self._attempt, url, attempt_fn, model_name, profile, cancel, started)
+            attempts[future] = (url, cancel, started)
+            return future
+
+        first = submit(primary)
+        # 排隊時間不算在 p95 裡，等主要請求真的開始產生才計時
+        attempts[first][2].wait()
+        wait([first], timeout=delay)
+        if not first.done() or isinstance(first.exception(), LLMRetryLaterError):
+            backup = next((u for u in candidates if u != primary and self.breaker(u).available()), None)
+            if backup is not None:
+                self._count_hedge("hedged" if not first.done() else "failover")
+                submit(backup)
+
+        pending = set(attempts)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception():
+                    error = error or future.exception()
+                    continue
+                out = future.result()
+                if out is None:
+                    continue
+                url = attempts[future][0]
+                # 先回來的用，其餘取消 (關閉連線，Ollama 會停止生成)
+                for other in pending:
+                    attempts[other][1].set()
+                if url != primary:
+                    self._count_hedge("hedge_won")
+                return {**out, "endpoint": url, "hedged": len(attempts) > 1}
+        raise error
+
+    def _count_hedge(self, name: str) -> None:
+        # 多個執行緒同時呼叫 call()，計數要在鎖裡加
+        with self._lock:
+            self.hedge_stats[name] += 1
+
+    def metrics(self) -> dict:
+        with self._lock:
+            breakers = list(self._breakers.values())
+            latencies = {f"{k[0]}|{k[1]}|{k[2]}": list(v) for k, v in self._latencies.items()}
+            hedge = dict(self.hedge_stats)
+        return {
+            "breakers": [b.snapshot() for b in breakers],
+            "fallback_urls": self.FALLBACK_URLS,
+            "hedge": hedge,
+            "hedge_delay": {
+                k: round(max(float(np.percentile(v, self.HEDGE_PERCENTILE)), self.HEDGE_MIN_DELAY), 2)
+                for k, v in latencies.items() if len(v) >= self.HEDGE_MIN_SAMPLES
+            },
+        }
+
+
+# 整個行程共用一份 (斷路器狀態要跨請求保留)
+resilience = LLMResilience()
@@ -0,0 +1,277 @@
+# backend/services/llm_scheduler.py
+import os
+import time
+import heapq
+import itertools
+import threading
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+from services.llm_resilience import LLMRetryLaterError
+
+
+class LLMSchedulerError(LLMRetryLaterError):
+    """排隊逾時或佇列已滿 (跟端點故障一樣是「稍後再試」，回測會存檔後停止)"""
+
+
+class LLMQueueTimeout(LLMSchedulerError):
+    pass
+
+
+class LLMQueueFull(LLMSchedulerError):
+    pass
+
+
+class _Lane:
+    """
+    一個 (base_url, 模型) 的執行槽與等待佇列
+    """
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.running = 0
+        self.waiting = []  # heap: (優先序, 進場順序)
+        self.waits = {p: deque(maxlen=500) for p in LLMScheduler.PRIORITIES}
+        self.served = {p: 0 for p in LLMScheduler.PRIORITIES}
+        self.timeouts = {p: 0 for p in LLMScheduler.PRIORITIES}
+        self.rejected = 0
+        # Ollama 回報的模型載入次數與載入耗時 (load_duration)
+        self.loads = 0
+        self.load_seconds = 0.0
+
+    def has_batch_waiting(self) -> bool:
+        return any(entry[0] > 0 for entry in self.waiting)
+
+
+class _Server:
+    """
+    一台 Ollama 目前載入的模型 (以最後開始執行的請求推估)
+    """
+    def __init__(self):
+        self.active_model = None
+        self.streak = 0      # 目前模型連續開始幾個請求
+        self.switches = 0    # 換模型的次數
+        self.running = {}    # 模型 -> 執行中數量
+
+
+class LLMScheduler:
+    """
+    LLM 請求排程器
+    同一台 Ollama 上的同一個模型同時只跑 concurrency 個請求，其餘排隊；
+    空出來時依優先序 (interactive > report > batch)、同優先序先到先跑。
+    互動式的分析不會被正在跑的回測矩陣卡住，CPU 跑大模型也不會因為同時太多請求而拖垮。
+
+    模型親和 (model affinity)：同一台 Ollama 上，report / batch 請求會先把目前已載入模型的佇列跑完才換模型，
+    而且換模型前要等其他模型的請求都結束，避免大模型一直被卸載又重新載入。
+    連續跑了 AFFINITY_MAX_STREAK 個之後，若有別的模型在等，就讓它們先 (避免餓死)。interactive 不受限制
+    """
+    PRIORITIES = {"interactive": 0, "report": 1, "batch": 2}
+    # 每個 (base_url, 模型) 同時執行數，可用 LLM_MODEL_CONCURRENCY="gpt-oss:20b=1,llama3:8b=2" 個別指定
+    DEFAULT_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "2"))
+    # 每條佇列最多排幾個 (超過直接拒絕，避免無止盡堆積)
+    MAX_QUEUE = int(os.getenv("LLM_QUEUE_LIMIT", "64"))
+    # 各優先序最久排多久 (秒)
+    QUEUE_TIMEOUT = {
+        "interactive": float(os.getenv("LLM_QUEUE_TIMEOUT_INTERACTIVE", "60")),
+        "report": float(os.getenv("LLM_QUEUE_TIMEOUT_REPORT", "600")),
+        "batch": float(os.getenv("LLM_QUEUE_TIMEOUT_BATCH", "1800")),
+    }
+    MODEL_AFFINITY = os.getenv("LLM_MODEL_AFFINITY", "1") != "0"
+    AFFINITY_MAX_STREAK = int(os.getenv("LLM_AFFINITY_MAX_STREAK", "50"))
+    # 超過這個秒數的 load_duration 才算真的載入模型 (已載入時只有幾毫秒)
+    LOAD_THRESHOLD = 0.5
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._profiles = {}
+        self._lanes = {}
+        self._servers = {}
+        self._seq = itertools.count()
+        self._overrides = {}
+        for item in os.getenv("LLM_MODEL_CONCURRENCY", "").split(","):
+            if "=" in item:
+                model, n = item.rsplit("=", 1)
+                self._overrides[model.strip()] = max(int(n), 1)
+
+    def _lane(self, key: tuple) -> _Lane:
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = _Lane(self._overrides.get(key[1], self.DEFAULT_CONCURRENCY))
+            self._lanes[key] = lane
+        return lane
+
+    def _server(self, base_url: str) -> _Server:
+        server = self._servers.get(base_url)
+        if server is None:
+            server = _Server()
+            self._servers[base_url] = server
+        return server
+
+    def _can_start(self, key: tuple, lane: _Lane, entry: tuple) -> bool:
+        if not (lane.running < lane.concurrency and lane.waiting[0] == entry):
+            return False
+        if not self.MODEL_AFFINITY or entry[0] == self.PRIORITIES["interactive"]:
+            return True
+
+        base_url, model_name = key
+        server = self._server(base_url)
+        # 其他模型還在產生中，先不要載入這個模型
+        if any(n > 0 for m, n in server.running.items() if m != model_name):
+            return False
+        others_waiting = any(
+            k[0] == base_url and k[1] != model_name and l.has_batch_waiting()
+            for k, l in self._lanes.items()
+        )
+        if server.active_model == model_name:
+            # 已經連續跑很久，讓別的模型先
+            return not (others_waiting and server.streak >= self.AFFINITY_MAX_STREAK)
+        active_lane = self._lanes.get((base_url, server.active_model))
+        # 目前模型的佇列還有工作 (而且還沒跑太久) 就繼續等
+        if active_lane and active_lane.has_batch_waiting() and server.streak < self.AFFINITY_MAX_STREAK:
+            return False
+        return True
+
+    def _mark_start(self, key: tuple) -> None:
+        base_url, model_name = key
+        server = self._server(base_url)
+        if server.active_model != model_name:
+            if server.active_model is not None:
+                server.switches += 1
+            server.active_model = model_name
+            server.streak = 0
+        server.streak += 1
+        server.running[model_name] = server.running.get(model_name, 0) + 1
+
+    def active_model(self, base_url: str):
+        """
+        這台 Ollama 最後開始執行的模型 (推估目前載入的模型，沒跑過回傳 None)
+        """
+        with self._cond:
+            server = self._servers.get(base_url.rstrip("/"))
+            return server.active_model if server else None
+
+    def record_load(self, base_url: str, model_name: str, load_seconds: float) -> None:
+        """
+        依 Ollama 回應的 load_duration 記錄模型載入 (超過門檻才算)
+        """
+        if load_seconds < self.LOAD_THRESHOLD:
+            return
+        with self._cond:
+            lane = self._lane((base_url.rstrip("/"), model_name))
+            lane.loads += 1
+            lane.load_seconds += load_seconds
+
+    def record_generation(self, profile: str, latency: float, prompt_tokens: int = None,
+                          output_tokens: int = None, early_stop: bool = False) -> None:
+        """
+        依生成設定 (signal / report) 累計呼叫數、token 數與延遲
+        """
+        with self._cond:
+            stats = self._profiles.get(profile)
+            if stats is None:
+                stats = {"calls": 0, "early_stops": 0, "prompt_tokens": 0, "output_tokens": 0, "latencies": deque(maxlen=500)}
+                self._profiles[profile] = stats
+            stats["calls"] += 1
+            stats["early_stops"] += int(bool(early_stop))
+            stats["prompt_tokens"] += prompt_tokens or 0
+            stats["output_tokens"] += output_tokens or 0
+            stats["latencies"].append(latency)
+
+    @contextmanager
+    def slot(self, base_url: str, model_name: str, priority: str = "batch"):
+        """
+        取得執行槽才進入 with 區塊 (as 取得排隊秒數)；排太久丟出 LLMQueueTimeout，佇列滿了丟出 LLMQueueFull
+        """
+        if priority not in self.PRIORITIES:
+            raise ValueError(f"不支援的優先序: {priority}")
+        key = (base_url.rstrip("/"), model_name)
+        entry = (self.PRIORITIES[priority], next(self._seq))
+        start = time.monotonic()
+        deadline = start + self.QUEUE_TIMEOUT[priority]
+
+        with self._cond:
+            lane = self._lane(key)
+            if len(lane.waiting) >= self.MAX_QUEUE:
+                lane.rejected += 1
+                raise LLMQueueFull(f"{model_name} 佇列已滿 ({self.MAX_QUEUE})")
+            heapq.heappush(lane.waiting, entry)
+            # 輪到自己 = 有空的槽而且自己排在最前面
+            while not self._can_start(key, lane, entry):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    lane.waiting.remove(entry)
+                    heapq.heapify(lane.waiting)
+                    lane.timeouts[priority] += 1
+                    self._cond.notify_all()
+                    raise LLMQueueTimeout(f"{model_name} 排隊超過 {self.QUEUE_TIMEOUT[priority]:g} 秒")
+                self._cond.wait(remaining)
+            heapq.heappop(lane.waiting)
+            lane.running += 1
+            self._mark_start(key)
+            wait = time.monotonic() - start
+            lane.waits[priority].append(wait)
+            lane.served[priority] += 1
+            # 可能還有空槽，讓下一位也檢查一次
+            self._cond.notify_all()
+
+        try:
+            yield wait
+        finally:
+            with self._cond:
+                lane.running -= 1
+                self._server(key[0]).running[key[1]] -= 1
+                self._cond.notify_all()
+
+    def metrics(self) -> dict:
+        """
+        每條佇列的執行中/排隊數、各優先序的排隊時間 (秒)、模型載入次數、每台 Ollama 換模型的次數，
+        以及各生成設定的 token 與延遲
+        model_loads 來自 Ollama 的 load_duration；交易訊號提早停止時拿不到，這部分看 model_switches
+        """
+        with self._cond:
+            rows = []
+            for (base_url, model_name), lane in self._lanes.items():
+                queue_time = {}
+                for priority, waits in lane.waits.items():
+                    if not lane.served[priority] and not lane.timeouts[priority]:
+                        continue
+                    w = np.array(waits, dtype=float)
+                    queue_time[priority] = {
+                        "served": lane.served[priority],
+                        "timeouts": lane.timeouts[priority],
+                        "avg": round(float(w.mean()), 3) if len(w) else None,
+                        "p95": round(float(np.percentile(w, 95)), 3) if len(w) else None,
+                        "max": round(float(w.max()), 3) if len(w) else None,
+                    }
+                rows.append({
+                    "base_url": base_url,
+                    "model_name": model_name,
+                    "concurrency": lane.concurrency,
+                    "running": lane.running,
+                    "queued": len(lane.waiting),
+                    "rejected": lane.rejected,
+                    "queue_time": queue_time,
+                    "model_loads": lane.loads,
+                    "load_seconds": round(lane.load_seconds, 1),
+                })
+            servers = [{
+                "base_url": base_url,
+                "active_model": server.active_model,
+                "model_switches": server.switches,
+            } for base_url, server in self._servers.items()]
+            profiles = {}
+            for profile, stats in self._profiles.items():
+                lat = np.array(stats["latencies"], dtype=float)
+                profiles[profile] = {
+                    "calls": stats["calls"],
+                    "early_stops": stats["early_stops"],
+                    "prompt_tokens": stats["prompt_tokens"],
+                    "output_tokens": stats["output_tokens"],
+                    "avg_output_tokens": round(stats["output_tokens"] / stats["calls"], 1),
+                    "latency_avg": round(float(lat.mean()), 3),
+                    "latency_p95": round(float(np.percentile(lat, 95)), 3),
+                }
+            return {"lanes": rows, "servers": servers, "profiles": profiles}
+
+
+# 整個行程共用一份，所有 AIService 的 Ollama 請求都經過這裡
+scheduler = LLMScheduler()
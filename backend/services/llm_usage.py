@@ -0,0 +1,203 @@
+# backend/services/llm_usage.py
+import os
+import time
+import queue
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import func, case
+import models
+from database import SessionLocal
+
+
+class LLMUsageLog:
+    """
+    LLM 呼叫紀錄 (llm_call_logs) 的寫入與彙總
+    record() 只把一列放進記憶體佇列，由背景執行緒批次寫入，AI 呼叫不用等資料庫；
+    佇列滿了 (資料庫卡住) 就丟掉並計數，不影響分析
+    """
+    # 累積幾筆或幾秒寫一次
+    BATCH_SIZE = 200
+    FLUSH_INTERVAL = float(os.getenv("LLM_USAGE_FLUSH_SECONDS", "2"))
+    MAX_PENDING = 10000
+    # 紀錄保留天數 (背景每小時清一次)
+    RETAIN_DAYS = int(os.getenv("LLM_USAGE_RETAIN_DAYS", "30"))
+    PRUNE_INTERVAL = 3600
+
+    FIELDS = (
+        "created_at", "provider", "model_name", "prompt_style", "call_type", "priority", "stock_id", "status",
+        "prompt_tokens", "completion_tokens", "queue_ms", "ttft_ms", "latency_ms", "eval_ms", "early_stop",
+        "base_url", "hedged",
+    )
+    # 彙總可以依哪些欄位分組
+    GROUPS = {
+        "model": ("provider", "model_name"),
+        "style": ("prompt_style",),
+        "model_style": ("provider", "model_name", "prompt_style"),
+    }
+
+    def __init__(self, session_factory=None):
+        self.session_factory = session_factory or SessionLocal
+        self._queue = queue.Queue(maxsize=self.MAX_PENDING)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_prune = 0.0
+        self.dropped = 0
+
+    def record(self, **fields) -> None:
+        row = {k: fields.get(k) for k in self.FIELDS}
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            return
+        self._ensure_writer()
+
+    def _ensure_writer(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="llm-usage-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            rows = [self._queue.get()]
+            # 第一筆進來後再收一段時間，湊成一批寫入
+            deadline = time.monotonic() + self.FLUSH_INTERVAL
+            while len(rows) < self.BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(rows)
+
+    def _write(self, rows: list) -> None:
+        db = self.session_factory()
+        try:
+            db.bulk_insert_mappings(models.LLMCallLog, rows)
+            if time.monotonic() - self._last_prune >= self.PRUNE_INTERVAL:
+                db.query(models.LLMCallLog).filter(
+                    models.LLMCallLog.created_at < datetime.utcnow() - timedelta(days=self.RETAIN_DAYS)
+                ).delete(synchronize_session=False)
+                self._last_prune = time.monotonic()
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            self.dropped += len(rows)
+            print(f"LLM usage write failed: {e}")
+        finally:
+            db.close()
+            for _ in rows:
+                self._queue.task_done()
+
+    def flush(self, timeout: float = 10) -> None:
+        """
+        等佇列裡的紀錄寫進資料庫 (查詢前呼叫，結果才會包含剛剛的呼叫)，最多等 timeout 秒
+        """
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and self._thread and self._thread.is_alive():
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(0.05)
+
+    def summary(self, db, group_by: str = "model_style", since_days: int = 7, call_type: str = None) -> list:
+        """
+        依模型 / 風格彙總呼叫次數、token 與耗時
+        交易訊號另外對上同期間的回測紀錄，算出每次回測花多少秒 / token，以及每 1% 報酬的成本
+        """
+        if group_by not in self.GROUPS:
+            raise ValueError(f"不支援的分組: {group_by} (可用: {', '.join(self.GROUPS)})")
+        keys = self.GROUPS[group_by]
+        since = datetime.utcnow() - timedelta(days=since_days)
+        L = models.LLMCallLog
+        group_cols = [getattr(L, k) for k in keys]
+
+        # 真的呼叫到模型的 (快取命中與失敗不算在平均 token / 延遲裡)
+        called = L.status.in_(("ok", "cancelled"))
+        query = db.query(
+            *group_cols, L.call_type,
+            func.count(L.id),
+            func.sum(case((L.status == "cached", 1), else_=0)),
+            func.sum(case((L.status.in_(("error", "busy", "unavailable")), 1), else_=0)),
+            func.sum(case((L.hedged.is_(True), 1), else_=0)),
+            func.sum(case((called, 1), else_=0)),
+            func.sum(case((L.early_stop.is_(True), 1), else_=0)),
+            func.coalesce(func.sum(L.prompt_tokens), 0),
+            func.coalesce(func.sum(L.completion_tokens), 0),
+            func.avg(L.queue_ms),
+            func.avg(L.ttft_ms),
+            func.avg(case((called, L.latency_ms))),
+            func.max(L.latency_ms),
+            func.coalesce(func.sum(L.latency_ms), 0),
+            func.coalesce(func.sum(L.eval_ms), 0),
+            func.coalesce(func.sum(case((L.eval_ms.isnot(None), L.completion_tokens))), 0),
+        ).filter(L.created_at >= since)
+        if call_type:
+            query = query.filter(L.call_type == call_type)
+        rows = query.group_by(*group_cols, L.call_type).all()
+
+        returns = self._backtest_returns(db, keys, since)
+        result = []
+        for row in rows:
+            group = dict(zip(keys, row[:len(keys)]))
+            (kind, calls, cached, errors, hedged, completed, early_stops, prompt_tokens, completion_tokens,
+             queue_ms, ttft_ms, latency_ms, max_latency_ms, total_ms, eval_ms, eval_tokens) = row[len(keys):]
+            item = {
+                **group,
+                "call_type": kind,
+                "calls": calls,
+                "cached": int(cached or 0),
+                "errors": int(errors or 0),
+                "hedged": int(hedged or 0),
+                "early_stops": int(early_stops or 0),
+                "prompt_tokens": int(prompt_tokens),
+                "completion_tokens": int(completion_tokens),
+                "avg_completion_tokens": round(completion_tokens / completed, 1) if completed else None,
+                "avg_queue_ms": round(float(queue_ms)) if queue_ms is not None else None,
+                "avg_ttft_ms": round(float(ttft_ms)) if ttft_ms is not None else None,
+                "avg_latency_ms": round(float(latency_ms)) if latency_ms is not None else None,
+                "max_latency_ms": max_latency_ms,
+                "total_seconds": round(total_ms / 1000, 1),
+                # 只用有 eval_duration 的 (Ollama) 呼叫計算產生速度
+                "tokens_per_second": round(eval_tokens / (eval_ms / 1000), 1) if eval_ms else None,
+            }
+            if kind == "signal":
+                backtests = returns.get(tuple(group[k] for k in keys))
+                item.update(self._cost_per_return(item, backtests))
+            result.append(item)
+        result.sort(key=lambda r: r["total_seconds"], reverse=True)
+        return result
+
+    def _backtest_returns(self, db, keys: tuple, since: datetime) -> dict:
+        # 同期間的 AI 回測 (規則型回測沒有呼叫 LLM) 依相同欄位分組的筆數與平均報酬
+        R = models.BacktestRecord
+        cols = [getattr(R, k) for k in keys]
+        rows = db.query(*cols, func.count(R.id), func.avg(R.total_return_pct)).filter(
+            R.created_at >= since, R.provider != "rule", R.total_return_pct.isnot(None)
+        ).group_by(*cols).all()
+        return {tuple(row[:len(keys)]): (row[len(keys)], row[len(keys) + 1]) for row in rows}
+
+    def _cost_per_return(self, item: dict, backtests: tuple) -> dict:
+        if not backtests or not backtests[0]:
+            return {"backtests": 0, "avg_return_pct": None, "seconds_per_backtest": None,
+                    "tokens_per_backtest": None, "seconds_per_return_pct": None}
+        count, avg_return = backtests
+        seconds = item["total_seconds"] / count
+        tokens = (item["prompt_tokens"] + item["completion_tokens"]) / count
+        return {
+            "backtests": count,
+            "avg_return_pct": round(float(avg_return), 2),
+            "seconds_per_backtest": round(seconds, 1),
+            "tokens_per_backtest": round(tokens),
+            # 平均報酬 <= 0 時沒有意義
+            "seconds_per_return_pct": round(seconds / avg_return, 2) if avg_return > 0 else None,
+        }
+
+
+# 整個行程共用一份，所有 AIService 的呼叫都寫到這裡
+usage_log = LLMUsageLog()
@@ -0,0 +1,167 @@
+# backend/services/monte_carlo_service.py
+from typing import Optional
+import numpy as np
+from sqlalchemy.orm import Session
+import models
+from services.analytics_service import AnalyticsService
+from services.backtest_engine import BacktestEngine
+
+
+class MonteCarloService:
+    """
+    交易重抽樣的穩健度測試 (Monte Carlo)
+    把一筆回測的交易報酬重新抽樣 (bootstrap，可重複抽) 或打亂順序 (shuffle)，產生上千條資產路徑，
+    看最終資產、最大回撤與破產機率的分布，判斷結果是實力還是運氣。
+    所有紀錄 x 路徑 x 交易筆數一起放進 NumPy 陣列計算，不對每條路徑跑 Python 迴圈
+    """
+    METHODS = ("bootstrap", "shuffle")
+    MAX_PATHS = 20000
+    # 每次計算的陣列大小上限 (紀錄數 x 路徑數 x 交易筆數)，超過就分批
+    MAX_CELLS = 2_000_000
+    PERCENTILES = (5, 25, 50, 75, 95)
+
+    def __init__(self):
+        self.analytics = AnalyticsService()
+        # 單檔回測每次用現金的 cash_ratio 買進，交易報酬換算成帳戶報酬要乘上這個比例
+        self.position_ratio = BacktestEngine().cash_ratio
+
+    def trade_returns(self, trades: list) -> np.ndarray:
+        """
+        每筆交易對帳戶的報酬率 (小數)
+        """
+        pct = np.array([t.get("profit_pct", 0) for t in trades], dtype=float)
+        return pct / 100 * self.position_ratio
+
+    def simulate(self, returns_list: list, n_paths: int = 1000, method: str = "bootstrap",
+                 ruin_pct: float = 0.5, seed: Optional[int] = None) -> dict:
+        """
+        對多組交易報酬同時做重抽樣
+        :param returns_list: 每筆紀錄一個交易報酬陣列
+        :param ruin_pct: 資產曾經跌掉這個比例就算破產
+        :return: {"final": (紀錄數, 路徑數) 的期末資產倍數, "drawdown": 同形狀的最大回撤 (正數), "ruined": bool 陣列}
+        """
+        if method not in self.METHODS:
+            raise ValueError(f"不支援的抽樣方式: {method}")
+        rng = np.random.default_rng(seed)
+        n = len(returns_list)
+        final = np.ones((n, n_paths))
+        drawdown = np.zeros((n, n_paths))
+        ruined = np.zeros((n, n_paths), dtype=bool)
+
+        counts = np.array([len(r) for r in returns_list], dtype=int)
+        # 交易筆數相近的放在同一批，補零比較少；由少到多排序後，每批最後一筆決定陣列寬度
+        order = np.argsort(counts)
+        start = 0
+        while start < n:
+            end = start + 1
+            while end < n and (end + 1 - start) * n_paths * max(int(counts[order[end]]), 1) <= self.MAX_CELLS:
+                end += 1
+            rows = order[start:end]
+            f, d, r = self._simulate_batch([returns_list[k] for k in rows], counts[rows], n_paths, method, ruin_pct, rng)
+            final[rows], drawdown[rows], ruined[rows] = f, d, r
+            start = end
+
+        return {"final": final, "drawdown": drawdown, "ruined": ruined}
+
+    def _simulate_batch(self, returns_list: list, counts: np.ndarray, n_paths: int, method: str,
+                        ruin_pct: float, rng: np.random.Generator):
+        m = len(returns_list)
+        width = max(int(counts.max()), 1)
+
+        # (紀錄數, 交易筆數) 的報酬矩陣，不足的位置補 0 (報酬 0 不影響資產)
+        padded = np.zeros((m, width))
+        valid = np.arange(width)[None, :] < counts[:, None]
+        if counts.sum():
+            padded[valid] = np.concatenate(returns_list)
+        rows = np.arange(m)[:, None, None]
+
+        if method == "bootstrap":
+            # 每個位置從該紀錄自己的交易中隨機抽一筆 (可重複)
+            picks = (rng.random((m, n_paths, width)) * counts[:, None, None]).astype(int)
+            sampled = padded[rows, picks] * valid[:, None, :]
+        else:
+            # 隨機排序：補零的位置排到最後，真實交易的順序打亂
+            keys = rng.random((m, n_paths, width))
+            keys[~np.broadcast_to(valid[:, None, :], keys.shape)] = np.inf
+            sampled = padded[rows, np.argsort(keys, axis=2)]
+
+        growth = np.cumprod(1 + sampled, axis=2)
+        peak = np.maximum(np.maximum.accumulate(growth, axis=2), 1.0)
+        drawdown = np.max(1 - growth / peak, axis=2)
+        ruined = np.min(growth, axis=2) <= 1 - ruin_pct
+        return growth[:, :, -1], drawdown, ruined
+
+    def _distribution(self, values: np.ndarray) -> dict:
+        result = {f"p{p}": round(float(v), 2) for p, v in zip(self.PERCENTILES, np.percentile(values, self.PERCENTILES))}
+        result["mean"] = round(float(np.mean(values)), 2)
+        return result
+
+    def run(self, db: Session, record_ids: Optional[list] = None, stock_id: Optional[str] = None,
+            n_paths: int = 1000, method: str = "bootstrap", ruin_pct: float = 0.5, seed: Optional[int] = None) -> dict:
+        """
+        對回測紀錄做 Monte Carlo，回傳每筆紀錄與每個模型/風格的分布
+        沒有指定 record_ids / stock_id 時跑全部紀錄
+        """
+        if not 1 <= n_paths <= self.MAX_PATHS:
+            raise ValueError(f"路徑數需介於 1 ~ {self.MAX_PATHS}")
+        if not 0 < ruin_pct < 1:
+            raise ValueError("ruin_pct 需介於 0 ~ 1")
+
+        query = db.query(models.BacktestRecord)
+        if record_ids:
+            query = query.filter(models.BacktestRecord.id.in_(record_ids))
+        if stock_id:
+            query = query.filter(models.BacktestRecord.stock_id == stock_id)
+        records = query.order_by(models.BacktestRecord.id).all()
+        if not records:
+            return {"method": method, "n_paths": n_paths, "ruin_pct": ruin_pct, "records": [], "groups": []}
+
+        data = self.analytics.load_curves(db, records)
+        returns_list = [self.trade_returns(data[r.id]["trades"]) for r in records]
+        sim = self.simulate(returns_list, n_paths, method, ruin_pct, seed)
+
+        return_pct = (sim["final"] - 1) * 100
+        drawdown_pct = sim["drawdown"] * 100
+
+        results = []
+        for k, record in enumerate(records):
+            capital = record.initial_capital
+            results.append({
+                "record_id": record.id,
+                "stock_id": record.stock_id,
+                "strategy_name": record.strategy_name,
+                "trade_count": len(returns_list[k]),
+                "actual_return_pct": record.total_return_pct,
+                "final_equity": self._distribution(sim["final"][k] * capital),
+                "return_pct": self._distribution(return_pct[k]),
+                "max_drawdown_pct": self._distribution(drawdown_pct[k]),
+                "loss_prob": round(float(np.mean(sim["final"][k] < 1)), 4),
+                "ruin_prob": round(float(np.mean(sim["ruined"][k])), 4),
+            })
+
+        # 依完整的策略設定分組 (含 "|gate:..."、"|rolled" 等附加設定，變體不跟原本的設定混在一起)，
+        # 把各紀錄的路徑合在一起看分布
+        groups = {}
+        for k, record in enumerate(records):
+            key = record.strategy_name.replace("Backtest_", "", 1)
+            groups.setdefault(key, []).append(k)
+
+        group_results = []
+        for key, rows in groups.items():
+            group_results.append({
+                "strategy": key,
+                "record_count": len(rows),
+                "return_pct": self._distribution(return_pct[rows].ravel()),
+                "max_drawdown_pct": self._distribution(drawdown_pct[rows].ravel()),
+                "loss_prob": round(float(np.mean(sim["final"][rows] < 1)), 4),
+                "ruin_prob": round(float(np.mean(sim["ruined"][rows])), 4),
+            })
+        group_results.sort(key=lambda g: g["return_pct"]["p50"], reverse=True)
+
+        return {
+            "method": method,
+            "n_paths": n_paths,
+            "ruin_pct": ruin_pct,
+            "records": results,
+            "groups": group_results
+        }
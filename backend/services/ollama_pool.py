@@ -0,0 +1,189 @@
+# backend/services/ollama_pool.py
+import os
+import time
+import threading
+from contextlib import contextmanager
+from services.llm_clients import client_pool
+from services.llm_scheduler import scheduler
+from services.llm_resilience import resilience
+
+
+class _Endpoint:
+    """
+    一台 Ollama 節點的狀態
+    """
+    def __init__(self, url: str):
+        self.url = url
+        self.healthy = True      # 第一次健康檢查前先當作可用
+        self.loaded = set()      # /api/ps：目前在記憶體裡的模型
+        self.installed = None    # /api/tags：已下載的模型 (None = 還不知道)
+        self.outstanding = 0     # 送到這台、還沒結束的請求 (含在排程器排隊中的)
+        self.served = 0
+        self.last_check = None
+        self.check_ms = None
+        self.last_error = None
+
+
+class OllamaEndpointPool:
+    """
+    多台 Ollama 的端點池，OLLAMA_URLS="http://box1:11434,http://box2:11434"
+    - 健康檢查：背景每 HEALTH_INTERVAL 秒查 /api/ps (目前載入的模型) 與 /api/tags (已下載的模型)
+    - 路由：挑進行中請求最少的節點 (least outstanding requests)；已經載入該模型的節點少算 AFFINITY_BONUS 個，
+      所以同一個模型會先集中在已載入的節點，差距超過才分到別台 (批次工作才會隨節點數擴展)
+    - 健康檢查失敗、斷路器打開、或沒有下載這個模型的節點不會被選到
+    沒有設定 OLLAMA_URLS 時不啟用，每個請求照舊用自己指定的網址
+    """
+    URLS = [u.strip().rstrip("/") for u in os.getenv("OLLAMA_URLS", "").split(",") if u.strip()]
+    HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "15"))
+    HEALTH_TIMEOUT = 3
+    # 已載入模型的節點可以比其他節點多排幾個請求 (約等於每個模型的同時執行數)
+    AFFINITY_BONUS = float(os.getenv("OLLAMA_POOL_AFFINITY", str(scheduler.DEFAULT_CONCURRENCY)))
+
+    def __init__(self, urls: list = None):
+        self._lock = threading.Lock()
+        self._endpoints = {url: _Endpoint(url) for url in (self.URLS if urls is None else urls)}
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._endpoints)
+
+    @property
+    def urls(self) -> list:
+        return list(self._endpoints)
+
+    def contains(self, url: str) -> bool:
+        return (url or "").rstrip("/") in self._endpoints
+
+    def _model_tag(self, model_name: str) -> str:
+        # Ollama 的 "llama3" 等於 "llama3:latest"
+        return model_name if ":" in model_name else f"{model_name}:latest"
+
+    def _eligible(self, ep: _Endpoint, tag: str) -> bool:
+        return ep.healthy and resilience.breaker(ep.url).available() and (ep.installed is None or tag in ep.installed)
+
+    def _score(self, ep: _Endpoint, tag: str) -> float:
+        loaded = tag in ep.loaded or scheduler.active_model(ep.url) in (tag, tag.rsplit(":latest", 1)[0])
+        return ep.outstanding - (self.AFFINITY_BONUS if loaded else 0)
+
+    def ranked(self, model_name: str, exclude: tuple = ()) -> list:
+        """
+        可以跑這個模型的節點，依路由分數由好到壞排序
+        """
+        self.start()
+        tag = self._model_tag(model_name)
+        with self._lock:
+            candidates = [ep for url, ep in self._endpoints.items() if url not in exclude and self._eligible(ep, tag)]
+            candidates.sort(key=lambda ep: (self._score(ep, tag), ep.served))
+            return [ep.url for ep in candidates]
+
+    def pick(self, model_name: str):
+        """
+        挑一台節點送這個模型的請求，沒有可用的節點回傳 None
+        """
+        ranked = self.ranked(model_name)
+        return ranked[0] if ranked else None
+
+    def parallelism(self) -> int:
+        """
+        整個池同時能跑幾個請求 (健康節點數 x 每個模型的同時執行數)，沒啟用時回傳 1
+        """
+        if not self.enabled:
+            return 1
+        with self._lock:
+            healthy = sum(1 for ep in self._endpoints.values() if ep.healthy)
+        return max(healthy, 1) * scheduler.DEFAULT_CONCURRENCY
+
+    @contextmanager
+    def lease(self, url: str):
+        """
+        請求進行中 (含排隊) 計入該節點的 outstanding；不在池裡的網址不計
+        """
+        ep = self._endpoints.get((url or "").rstrip("/"))
+        if ep is None:
+            yield
+            return
+        with self._lock:
+            ep.outstanding += 1
+            ep.served += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                ep.outstanding -= 1
+
+    def check(self, url: str) -> None:
+        """
+        健康檢查一台節點：/api/ps 與 /api/tags 都要回 200 才算健康
+        """
+        ep = self._endpoints[url]
+        session = client_pool.http_session(url)
+        start = time.time()
+        try:
+            ps = session.get(f"{url}/api/ps", timeout=self.HEALTH_TIMEOUT)
+            tags = session.get(f"{url}/api/tags", timeout=self.HEALTH_TIMEOUT)
+            ps.raise_for_status()
+            tags.raise_for_status()
+            loaded = {m.get("name") or m.get("model") for m in ps.json().get("models", [])}
+            installed = {m.get("name") or m.get("model") for m in tags.json().get("models", [])}
+            with self._lock:
+                if not ep.healthy:
+                    print(f"Ollama endpoint healthy again: {url}")
+                ep.healthy, ep.loaded, ep.installed, ep.last_error = True, loaded, installed, None
+        except Exception as e:
+            with self._lock:
+                if ep.healthy:
+                    print(f"Ollama endpoint unhealthy: {url} ({e})")
+                ep.healthy, ep.last_error = False, str(e)
+        finally:
+            with self._lock:
+                ep.last_check = time.time()
+                ep.check_ms = round((time.time() - start) * 1000)
+
+    def check_all(self) -> None:
+        threads = [threading.Thread(target=self.check, args=(url,), daemon=True) for url in self._endpoints]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def start(self) -> None:
+        """
+        啟動背景健康檢查 (第一次路由時自動啟動；daemon，跟著主程式結束)
+        """
+        if not self.enabled or (self._thread and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+
+            def loop():
+                while True:
+                    self.check_all()
+                    if self._stop.wait(self.HEALTH_INTERVAL):
+                        break
+
+            self._thread = threading.Thread(target=loop, name="ollama-health", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def stats(self) -> list:
+        with self._lock:
+            return [{
+                "url": ep.url,
+                "healthy": ep.healthy,
+                "outstanding": ep.outstanding,
+                "served": ep.served,
+                "loaded_models": sorted(m for m in ep.loaded if m),
+                "installed_models": len(ep.installed) if ep.installed is not None else None,
+                "check_ms": ep.check_ms,
+                "last_check": ep.last_check,
+                "last_error": ep.last_error,
+            } for ep in self._endpoints.values()]
+
+
+# 整個行程共用一份
+endpoint_pool = OllamaEndpointPool()
@@ -0,0 +1,285 @@
+# backend/services/portfolio_service.py
+import json
+import numpy as np
+import pandas as pd
+from sqlalchemy.orm import Session
+import models
+from services.stock_service import StockService
+from services.backtest_engine import BacktestEngine
+
+# 訊號種類 (對齊後的 NumPy 陣列用整數表示)
+ACTION_NONE = 0   # 沒有訊號 (例如當天沒有 K 棒)
+ACTION_HOLD = 1
+ACTION_BUY = 2
+ACTION_SKIP = 3   # 預篩沒通過，不進入冷卻
+
+
+class PortfolioService:
+    """
+    多檔股票組合回測 (共用一個現金水位)
+    所有股票先對齊到同一條交易日時間軸，轉成 (天數 x 股票數) 的 NumPy 陣列，
+    每天用向量化的方式處理停損停利、掛單成交與新訊號；訊號必須事先算好 (規則型或已保存的 AI 訊號)
+    """
+
+    def __init__(self):
+        self.stock_service = StockService()
+        self.engine = BacktestEngine()
+
+    def build_price_arrays(self, data_map: dict) -> dict:
+        """
+        把各檔股票的 OHLC 對齊到同一條時間軸
+        缺資料的日子為 NaN；收盤價另外做 forward fill 用來計算市值
+        """
+        stock_ids = list(data_map.keys())
+        # 只取日期部分，避免不同股票的時區/時間不同而對不上
+        frames = {}
+        for sid in stock_ids:
+            df = data_map[sid].copy()
+            df.index = pd.to_datetime([d.date() for d in df.index])
+            frames[sid] = df[~df.index.duplicated(keep="last")]
+
+        calendar = sorted(set().union(*[f.index for f in frames.values()]))
+        calendar = pd.DatetimeIndex(calendar)
+
+        def stack(col):
+            return np.column_stack([frames[sid][col].reindex(calendar).to_numpy(dtype=float) for sid in stock_ids])
+
+        close = stack("Close")
+        return {
+            "stock_ids": stock_ids,
+            "calendar": calendar,
+            "dates": [str(d.date()) for d in calendar],
+            "open": stack("Open"),
+            "high": stack("High"),
+            "low": stack("Low"),
+            "close": close,
+            "close_ffill": pd.DataFrame(close).ffill().to_numpy(),
+            "tradable": ~np.isnan(close),
+            "frames": frames,
+        }
+
+    def build_signal_arrays(self, db: Session, arrays: dict, configs: list) -> dict:
+        """
+        依每檔股票的訊號來源，產生對齊後的訊號陣列
+        config["source"]:
+          - "rule": 選股策略任一成立就以收盤價掛單 (同 simulate_rule_backtest)，觀望不冷卻
+          - "signals": 重播已保存的 AI 訊號 (config["record_id"])，沒有訊號的日子視為觀望
+        """
+        n_days, n_stocks = arrays["close"].shape
+        action = np.full((n_days, n_stocks), ACTION_NONE, dtype=np.int8)
+        entry = np.full((n_days, n_stocks), np.nan)
+        stop_loss = np.full((n_days, n_stocks), np.nan)
+        take_profit = np.full((n_days, n_stocks), np.nan)
+        cooldown_len = np.zeros(n_stocks, dtype=int)
+        date_pos = {d: t for t, d in enumerate(arrays["dates"])}
+
+        for j, sid in enumerate(arrays["stock_ids"]):
+            config = configs[sid]
+            tradable = arrays["tradable"][:, j]
+
+            if config.get("source", "rule") == "rule":
+                df = arrays["frames"][sid]
+                flags = self.stock_service.compute_strategy_signals(df, config.get("strategies") or [])
+                hit = flags.any(axis=1).reindex(arrays["calendar"], fill_value=False).to_numpy(dtype=bool)
+                closes = arrays["close"][:, j]
+                sl_pct = config.get("stop_loss_pct", 0.05)
+                tp_pct = config.get("take_profit_pct", 0.10)
+
+                action[tradable, j] = ACTION_HOLD
+                action[hit & tradable, j] = ACTION_BUY
+                entry[:, j] = closes
+                stop_loss[:, j] = np.round(closes * (1 - sl_pct), 2)
+                take_profit[:, j] = np.round(closes * (1 + tp_pct), 2)
+            else:
+                record = db.query(models.BacktestRecord).filter(models.BacktestRecord.id == config.get("record_id")).first()
+                if not record:
+                    raise ValueError(f"{sid} 找不到回測紀錄 {config.get('record_id')}")
+                signal_set_id = json.loads(record.result_data).get("signal_set_id")
+                signal_set = db.query(models.BacktestSignalSet).filter(models.BacktestSignalSet.id == signal_set_id).first()
+                if not signal_set:
+                    raise ValueError(f"{sid} 的回測紀錄沒有保存訊號")
+
+                cooldown_len[j] = self.engine.hold_cooldown
+                action[tradable, j] = ACTION_HOLD
+                for signal in json.loads(signal_set.signals):
+                    t = date_pos.get(signal["date"])
+                    if t is None or not tradable[t]:
+                        continue
+                    if signal.get("action") == "SKIP":
+                        action[t, j] = ACTION_SKIP
+                    elif signal.get("action") == "BUY" and all(k in signal for k in ("entry_price", "stop_loss", "take_profit")):
+                        action[t, j] = ACTION_BUY
+                        entry[t, j] = float(signal["entry_price"])
+                        stop_loss[t, j] = float(signal["stop_loss"])
+                        take_profit[t, j] = float(signal["take_profit"])
+
+        return {
+            "action": action,
+            "entry": entry,
+            "stop_loss": stop_loss,
+            "take_profit": take_profit,
+            "cooldown_len": cooldown_len,
+        }
+
+    def simulate(self, arrays: dict, signals: dict, initial_capital: float, sizing: str = "equal",
+                 max_positions: int = 10, position_pct: float = 0.1) -> dict:
+        """
+        共用現金的逐日模擬 (每天對所有股票做向量化運算)
+        撮合規則與單檔回測相同：隔天最低價碰到掛單價成交、停損優先於停利、掛單 N 天過期、觀望後冷卻
+        :param sizing: "equal" = 每檔最多 總資產/max_positions；"fraction" = 每檔 總資產*position_pct
+        """
+        engine = self.engine
+        stock_ids = arrays["stock_ids"]
+        dates = arrays["dates"]
+        o, h, l = arrays["open"], arrays["high"], arrays["low"]
+        close_ffill = arrays["close_ffill"]
+        tradable = arrays["tradable"]
+        action = signals["action"]
+        n_days, n_stocks = o.shape
+
+        cash = float(initial_capital)
+        shares = np.zeros(n_stocks, dtype=np.int64)
+        entry_price = np.zeros(n_stocks)
+        cost_basis = np.zeros(n_stocks)
+        pos_sl = np.zeros(n_stocks)
+        pos_tp = np.zeros(n_stocks)
+        entry_day = np.zeros(n_stocks, dtype=int)
+
+        has_order = np.zeros(n_stocks, dtype=bool)
+        order_price = np.zeros(n_stocks)
+        order_sl = np.zeros(n_stocks)
+        order_tp = np.zeros(n_stocks)
+        order_expiry = np.zeros(n_stocks, dtype=int)
+        cooldown = np.zeros(n_stocks, dtype=int)
+
+        trades = []
+        equity_curve = []
+
+        for t in range(engine.START_INDEX, n_days - 1):
+            nt = t + 1
+            # 當天一開始的狀態 (跟單檔回測一樣，每檔當天只會處於其中一種狀態)
+            held = shares > 0
+            pending = has_order & ~held
+            flat = ~held & ~pending
+
+            equity = cash + float(np.sum(shares * np.nan_to_num(close_ffill[t])))
+            equity_curve.append({"date": dates[t], "equity": equity})
+
+            next_ok = tradable[nt]
+
+            # --- 1. 持倉：檢查停損停利 ---
+            stop_hit = held & next_ok & (l[nt] <= pos_sl)
+            take_hit = held & next_ok & ~stop_hit & (h[nt] >= pos_tp)
+            for j in np.flatnonzero(stop_hit | take_hit):
+                if stop_hit[j]:
+                    exit_price = min(o[nt, j], pos_sl[j])
+                    reason = "停損出場"
+                else:
+                    exit_price = max(o[nt, j], pos_tp[j])
+                    reason = "停利出場"
+                revenue = engine.calculate_cost(exit_price, int(shares[j]), is_buy=False)
+                cash += revenue
+                profit = revenue - cost_basis[j]
+                trades.append({
+                    "entry_date": dates[entry_day[j]],
+                    "exit_date": dates[nt],
+                    "stock_id": stock_ids[j],
+                    "type": "Long",
+                    "entry_price": float(entry_price[j]),
+                    "exit_price": float(exit_price),
+                    "stop_loss": float(pos_sl[j]),
+                    "take_profit": float(pos_tp[j]),
+                    "shares": int(shares[j]),
+                    "profit": int(profit),
+                    "profit_pct": round(float(profit / cost_basis[j] * 100), 2),
+                    "reason": reason
+                })
+                shares[j] = 0
+                cooldown[j] = 0
+
+            # --- 2. 掛單：檢查過期或成交 ---
+            order_expiry[pending] -= 1
+            expired = pending & (order_expiry <= 0)
+            has_order[expired] = False
+            cooldown[expired] = 0
+
+            fillable = pending & ~expired & next_ok & (l[nt] <= order_price)
+            for j in np.flatnonzero(fillable):
+                if sizing == "equal" and np.count_nonzero(shares) >= max_positions:
+                    break
+                real_price = min(o[nt, j], order_price[j])
+                if sizing == "fraction":
+                    target = equity * position_pct
+                else:
+                    target = equity / max_positions
+                amount = min(target, cash * engine.cash_ratio)
+                qty = int(amount / real_price)
+                if qty <= 0:
+                    continue
+                cost = engine.calculate_cost(real_price, qty, is_buy=True)
+                if cash < cost:
+                    continue
+                cash -= cost
+                shares[j] = qty
+                entry_price[j] = real_price
+                cost_basis[j] = cost
+                pos_sl[j] = order_sl[j]
+                pos_tp[j] = order_tp[j]
+                entry_day[j] = nt
+                has_order[j] = False
+
+            # --- 3. 空手：冷卻中就倒數，否則讀取當天訊號 ---
+            cooling = flat & (cooldown > 0)
+            cooldown[cooling] -= 1
+
+            ask = flat & ~cooling & (action[t] != ACTION_NONE)
+            buy = ask & (action[t] == ACTION_BUY)
+            hold = ask & (action[t] == ACTION_HOLD)
+
+            has_order[buy] = True
+            order_price[buy] = signals["entry"][t, buy]
+            order_sl[buy] = signals["stop_loss"][t, buy]
+            order_tp[buy] = signals["take_profit"][t, buy]
+            order_expiry[buy] = engine.order_expiry
+            cooldown[hold] = signals["cooldown_len"][hold]
+
+        final_equity = cash + float(np.sum(shares * np.nan_to_num(close_ffill[-1])))
+
+        # 各檔股票的貢獻
+        per_stock = {sid: {"stock_id": sid, "trade_count": 0, "profit": 0} for sid in stock_ids}
+        for trade in trades:
+            per_stock[trade["stock_id"]]["trade_count"] += 1
+            per_stock[trade["stock_id"]]["profit"] += trade["profit"]
+
+        return {
+            "stock_ids": stock_ids,
+            "initial_capital": initial_capital,
+            "final_equity": int(final_equity),
+            "total_return_pct": round(((final_equity - initial_capital) / initial_capital) * 100, 2),
+            "trade_count": len(trades),
+            "open_positions": [stock_ids[j] for j in np.flatnonzero(shares)],
+            "per_stock": sorted(per_stock.values(), key=lambda x: x["profit"], reverse=True),
+            "trades": trades,
+            "equity_curve": equity_curve
+        }
+
+    def run_portfolio_backtest(self, db: Session, ticker_configs: list, initial_capital: float,
+                               sizing: str = "equal", max_positions: int = 10, position_pct: float = 0.1,
+                               period: str = "1y") -> dict:
+        """
+        執行組合回測
+        :param ticker_configs: [{"stock_id": "2330", "source": "rule", "strategies": [...]}, ...]
+        """
+        configs = {c["stock_id"]: c for c in ticker_configs}
+        data_map = self.stock_service.fetch_data_batch(list(configs.keys()), period=period)
+        if not data_map:
+            return {"error": "無法取得任何股票資料"}
+
+        arrays = self.build_price_arrays(data_map)
+        if len(arrays["dates"]) < 100:
+            return {"error": "資料不足，無法回測"}
+
+        signals = self.build_signal_arrays(db, arrays, configs)
+        result = self.simulate(arrays, signals, initial_capital, sizing, max_positions, position_pct)
+        result["missing_stocks"] = [sid for sid in configs if sid not in data_map]
+        return result
@@ -1,12 +1,12 @@
 # backend/services/report_service.py
 import os
 from sqlalchemy.orm import Session
-from sqlalchemy import desc
 from services.stock_service import StockService
 from services.ai_service import AIService
+from services.backtest_service import BacktestService
 import models, schemas
-import json
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 # PDF 相關
 from reportlab.lib.pagesizes import A4
@@ -17,17 +17,13 @@ from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_JUSTIFY, TA_LEFT
 class ReportService:
+    # 報告用 Ollama 跑文字分析，排行榜上的模型不在這裡面時改用第一個 (預設模型)
+    REPORT_MODELS = ("gpt-oss:20b", "gemma3:12b")
+
     def __init__(self):
         self.stock_service = StockService()
         self.ai_service = AIService()
-
-    def _parse_strategy_style(self, strategy_name: str):
-        try:
-            clean = strategy_name.replace("Backtest_", "")
-            parts = clean.split("_")
-            return parts[-1]
-        except:
-            return "aggressive"
+        self.backtest_service = BacktestService()
 
     def format_ai_text(self, text):
         """
@@ -172,32 +168,6 @@ class ReportService:
         return filename
 
         
-    def _parse_strategy_key(self, strategy_name: str):
-        """
-        解析回測策略名稱
-        格式範例: Backtest_gemini_gemini-1.5-flash_aggressive
-        回傳: (provider, model_name, style)
-        """
-        try:
-            # 移除前綴
-            clean = strategy_name.replace("Backtest_", "")
-            parts = clean.split("_")
-            
-            # 因為模型名稱可能包含 "-" 或 ":"，所以拆解要小心
-            # 假設 provider 是第一個，style 是最後一個
-            provider = parts[0]
-            style = parts[-1]
-            # 中間剩下的就是 model_name
-            model_name = "_".join(parts[1:-1])
-            valid_models = ["gpt-oss:20b", "gemma3:12b"]
-            if model_name not in valid_models:
-                # 如果解析出來的模型不在白名單內，強制使用預設
-                model_name = "gpt-oss:20b"
-            return provider, model_name, style
-        except:
-            # 解析失敗回傳預設
-            return "ollama", "gpt-oss:20b", "aggressive"
-
     def generate_pdf(self, filename: str, report_data: list):
         """
         使用 Platypus 引擎製作支援排版的 PDF
@@ -326,6 +296,7 @@ class ReportService:
             custom_list=req_data.custom_tickers
         )
         final_report_data = []
+        jobs = []  # (股票在報告中的位置, 分析設定, 技術摘要)
 
         # 2. 針對每一檔篩選出來的股票
         for item in screen_results:
@@ -338,27 +309,10 @@ class ReportService:
             summary = self.stock_service.get_technical_summary(df)
             
             # 3. 找出最佳模型組合
-            # 查詢回測紀錄，依報酬率排序，取前 2 名
-            top_records = db.query(models.BacktestRecord)\
-                .filter(models.BacktestRecord.stock_id == stock_id)\
-                .order_by(desc(models.BacktestRecord.result_data))\
-                .all()
-            # 因為 result_data 是字串，不能直接在 SQL 排序 JSON 欄位 (除非用 PostgreSQL JSONB)
-            # 這裡簡單處理：撈出來後用 Python 排序
-            parsed_records = []
-            for r in top_records:
-                try:
-                    res_json = json.loads(r.result_data)
-                    ret = res_json.get('total_return_pct', -999)
-                    parsed_records.append({"record": r, "return": ret})
-                except:
-                    pass
-            
-            # 排序取 Top 2
-            parsed_records.sort(key=lambda x: x['return'], reverse=True)
-            best_2 = parsed_records[:2]
-            
-            analyses = []
+            # 從排行榜 (每個設定最新一次的回測) 依報酬率取前 2 名，走 stock_id + total_return_pct 索引
+            # 規則型回測 (provider = "rule") 只是比較基準，不拿來挑 AI 模型；
+            # 有預篩條件或 roll_window 的變體也排除 (文字分析沒有這些設定，同一組模型/風格也不會選到兩次)
+            best_2 = self.backtest_service.get_top_configs(db, stock_id, limit=2, include_variants=False)
             
             # 如果沒有紀錄，使用預設 (gpt-oss:20b + aggressive)
             if not best_2:
@@ -371,53 +325,68 @@ class ReportService:
                 }]
             else:
                 target_configs = []
-                for p in best_2:
-                    rec = p['record']
-                    prov, mod, style = self._parse_strategy_key(rec.strategy_name)
+                for entry in best_2:
+                    model = entry.model_name if entry.model_name in self.REPORT_MODELS else self.REPORT_MODELS[0]
                     target_configs.append({
-                        "provider": prov,
-                        "model": mod,
-                        "style": style,
-                        "return_pct": p['return']
+                        "provider": entry.provider,
+                        "model": model,
+                        "style": entry.prompt_style or "aggressive",
+                        "return_pct": entry.total_return_pct
                     })
 
-            # 4. 執行 AI 分析
             for config in target_configs:
-                try:
-                    print(f"Analysis {stock_id}")
-                    # 呼叫 AI (文字報告)
-                    ai_text = self.ai_service.get_analysis(
-                        api_key="",
-                        stock_id=stock_id,
-                        stock_name=stock_name,
-                        mode="Long", # 選股通常是做多
-                        cost=summary['close'],
-                        context_data=summary['context_str'],
-                        provider="ollama",
-                        model_name=config['model'],
-                        ollama_url=req_data.ollama_url,
-                        prompt_style=config['style']
-                    )
-                    
-                    analyses.append({
-                        "model": config['model'],
-                        "style": config['style'],
-                        "return": config['return_pct'],
-                        "content": ai_text
-                    })
-                except Exception as e:
-                    print(f"Analysis failed for {stock_id}: {e}")
+                jobs.append((len(final_report_data), config, summary))
 
-            # 收集結果
+            # 收集結果 (AI 分析稍後依模型分組一起跑)
             final_report_data.append({
                 "stock_id": stock_id,
                 "stock_name": stock_name,
                 "price": summary['close'],
                 "trend": summary['trend'],
                 "matched_strategies": item['matched_strategies'],
-                "analyses": analyses
+                "analyses": []
             })
 
+        # 4. 執行 AI 分析：同一個模型的分析排在一起跑完再換下一個，Ollama 不用每檔股票都重新載入模型
+        #    有多台 Ollama (端點池) 時同時送出，數量 = 健康節點數 x 每個模型的同時執行數
+        results = {}
+
+        def analyze(k):
+            pos, config, summary = jobs[k]
+            stock = final_report_data[pos]
+            try:
+                print(f"Analysis {stock['stock_id']} ({config['model']})")
+                # 呼叫 AI (文字報告)
+                results[k] = self.ai_service.get_analysis(
+                    api_key="",
+                    stock_id=stock['stock_id'],
+                    stock_name=stock['stock_name'],
+                    mode="Long", # 選股通常是做多
+                    cost=summary['close'],
+                    context_data=summary['context_str'],
+                    provider="ollama",
+                    model_name=config['model'],
+                    ollama_url=req_data.ollama_url,
+                    prompt_style=config['style'],
+                    priority="report"
+                )
+            except Exception as e:
+                print(f"Analysis failed for {stock['stock_id']}: {e}")
+
+        order = sorted(range(len(jobs)), key=lambda k: (jobs[k][1]['model'], k))
+        with ThreadPoolExecutor(max_workers=self.ai_service.pool.parallelism()) as executor:
+            list(executor.map(analyze, order))
+
+        # 依原本的順序 (每檔股票的前 2 名) 放回報告
+        for k, (pos, config, _) in enumerate(jobs):
+            if k in results:
+                final_report_data[pos]["analyses"].append({
+                    "model": config['model'],
+                    "style": config['style'],
+                    "return": config['return_pct'],
+                    "content": results[k]
+                })
+
         # 5. 生成 PDF
         output_filename = "analysis_report.pdf"
         self.generate_pdf(output_filename, final_report_data)
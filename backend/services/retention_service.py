@@ -0,0 +1,173 @@
+# backend/services/retention_service.py
+import os
+import json
+import zlib
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy.orm import Session
+import models
+from services.backtest_service import BacktestService
+
+
+class RetentionService:
+    """
+    回測紀錄的去重與保留政策
+    - 相同 (股票, 策略, 資金, 內容雜湊) 的紀錄只留最新一筆
+    - 每個 (股票, 策略, 資金) 只保留最近 N 筆，較舊的壓縮後搬到 backtest_archives
+    - 排行榜引用的紀錄不封存；重複的紀錄被刪掉時，排行榜改指向留下的那筆
+    - 沒有紀錄在用、也過了重用期限的 AI 訊號一併清掉
+    背景執行緒定期執行，讓 backtest_records 保持精簡
+    """
+    # 每個 (股票, 策略, 資金) 保留幾筆
+    RETAIN_PER_KEY = int(os.getenv("BACKTEST_RETAIN_PER_KEY", "5"))
+    # 背景整理的間隔 (秒)
+    COMPACT_INTERVAL = int(os.getenv("BACKTEST_COMPACT_INTERVAL", "3600"))
+    # 沒有紀錄在用的訊號保留天數
+    # 重用訊號只看最近幾份 (BacktestService.REUSE_SIGNAL_SETS)，之後的回測會把沿用的訊號一起存進新的一份，
+    # 沒人引用的舊訊號過一陣子就沒用了；預設 10 天，涵蓋週末與春節等連續休市期間的重跑
+    SIGNAL_TTL_DAYS = int(os.getenv("BACKTEST_SIGNAL_TTL_DAYS", "10"))
+
+    def __init__(self):
+        self.backtest_service = BacktestService()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()  # 避免背景與手動整理同時進行
+        self.last_stats = None
+
+    def _delete_record(self, db: Session, record) -> None:
+        db.query(models.BacktestCurve).filter(models.BacktestCurve.record_id == record.id).delete()
+        db.delete(record)
+
+    def _archive_record(self, db: Session, record) -> None:
+        result = self.backtest_service.load_full_result(db, record)
+        # 訊號一起封存，之後還能重播
+        signals = self.backtest_service.load_signals(db, result.get("signal_set_id"))
+        payload = json.dumps({"result": result, "signals": signals}, default=str)
+        db.add(models.BacktestArchive(
+            record_id=record.id,
+            stock_id=record.stock_id,
+            strategy_name=record.strategy_name,
+            initial_capital=record.initial_capital,
+            total_return_pct=record.total_return_pct,
+            content_hash=record.content_hash,
+            payload=zlib.compress(payload.encode("utf-8"), 6),
+            created_at=record.created_at
+        ))
+        self._delete_record(db, record)
+
+    def compact(self, db: Session) -> dict:
+        """
+        執行一次去重與保留政策，回傳處理筆數
+        """
+        with self._lock:
+            stats = {"hashed": 0, "deduplicated": 0, "archived": 0, "signal_sets_removed": 0}
+
+            # 1. 補上舊紀錄的內容雜湊
+            for record in db.query(models.BacktestRecord).filter(models.BacktestRecord.content_hash.is_(None)).all():
+                result = self.backtest_service.load_full_result(db, record)
+                record.content_hash = self.backtest_service.content_hash(record.stock_id, record.initial_capital, record.strategy_name, result)
+                stats["hashed"] += 1
+            db.flush()
+
+            # 2. 去重 + 3. 每個 (股票, 策略, 資金) 只留最近 N 筆
+            # 快取與延伸都以資金區分，不同資金的紀錄各自保留，不會互相擠掉
+            records = db.query(models.BacktestRecord).order_by(
+                models.BacktestRecord.created_at.desc(), models.BacktestRecord.id.desc()
+            ).all()
+            # 排行榜的 record_id 是 backtest_records 的外鍵，被引用的紀錄不能直接刪掉
+            board = {entry.record_id: entry for entry in db.query(models.BacktestLeaderboard).filter(
+                models.BacktestLeaderboard.record_id.isnot(None)
+            ).all()}
+            seen_hash = {}
+            kept = {}
+            for record in records:
+                hash_key = (record.stock_id, record.strategy_name, record.initial_capital, record.content_hash)
+                if hash_key in seen_hash:
+                    # 內容完全相同，排行榜改指向留下來的那筆
+                    entry = board.pop(record.id, None)
+                    if entry is not None:
+                        entry.record_id = seen_hash[hash_key].id
+                        board[entry.record_id] = entry
+                        db.flush()
+                    self._delete_record(db, record)
+                    stats["deduplicated"] += 1
+                    continue
+                seen_hash[hash_key] = record
+
+                key = (record.stock_id, record.strategy_name, record.initial_capital)
+                kept[key] = kept.get(key, 0) + 1
+                # 排行榜還在用的紀錄不封存 (排行榜只留每個策略最新的一筆，通常不會超出保留筆數)
+                if kept[key] > self.RETAIN_PER_KEY and record.id not in board:
+                    self._archive_record(db, record)
+                    stats["archived"] += 1
+            db.flush()
+
+            # 4. 清掉沒人使用、也過了重用期限的訊號
+            in_use = set()
+            for (result_data,) in db.query(models.BacktestRecord.result_data).all():
+                signal_set_id = json.loads(result_data).get("signal_set_id")
+                if signal_set_id:
+                    in_use.add(signal_set_id)
+            expire = datetime.utcnow() - timedelta(days=self.SIGNAL_TTL_DAYS)
+            stale = db.query(models.BacktestSignalSet.id).filter(models.BacktestSignalSet.created_at < expire).all()
+            stale_ids = [sid for (sid,) in stale if sid not in in_use]
+            if stale_ids:
+                db.query(models.BacktestSignalSet).filter(models.BacktestSignalSet.id.in_(stale_ids)).delete(synchronize_session=False)
+            stats["signal_sets_removed"] = len(stale_ids)
+
+            db.commit()
+            self.last_stats = {**stats, "finished_at": datetime.utcnow().isoformat()}
+            return stats
+
+    def get_archives(self, db: Session, stock_id: str = None) -> list:
+        query = db.query(models.BacktestArchive)
+        if stock_id:
+            query = query.filter(models.BacktestArchive.stock_id == stock_id)
+        rows = query.order_by(models.BacktestArchive.created_at.desc()).all()
+        return [{
+            "id": r.id,
+            "record_id": r.record_id,
+            "stock_id": r.stock_id,
+            "strategy_name": r.strategy_name,
+            "initial_capital": r.initial_capital,
+            "total_return_pct": r.total_return_pct,
+            "size_bytes": len(r.payload or b""),
+            "created_at": r.created_at,
+            "archived_at": r.archived_at
+        } for r in rows]
+
+    def load_archive(self, db: Session, archive_id: int):
+        """
+        解壓縮封存的完整結果 {"result": ..., "signals": [...]}
+        """
+        row = db.query(models.BacktestArchive).filter(models.BacktestArchive.id == archive_id).first()
+        if not row:
+            return None
+        return json.loads(zlib.decompress(row.payload).decode("utf-8"))
+
+    def start_background(self, session_factory, interval: int = None) -> None:
+        """
+        啟動背景整理執行緒 (daemon，跟著主程式結束)
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        interval = interval or self.COMPACT_INTERVAL
+
+        def loop():
+            # 先等一個間隔，避免拖慢啟動
+            while not self._stop.wait(interval):
+                db = session_factory()
+                try:
+                    stats = self.compact(db)
+                    print(f"Backtest compaction: {stats}")
+                except Exception as e:
+                    db.rollback()
+                    print(f"Backtest compaction failed: {e}")
+                finally:
+                    db.close()
+
+        self._thread = threading.Thread(target=loop, name="backtest-compaction", daemon=True)
+        self._thread.start()
+
+    def stop_background(self) -> None:
+        self._stop.set()
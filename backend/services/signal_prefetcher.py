@@ -0,0 +1,75 @@
+# backend/services/signal_prefetcher.py
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SignalPrefetcher:
+    """
+    回測訊號的推測式預先查詢 (speculative prefetch)
+    回測是否要在第 i+1 天問 AI 取決於前一天的答案，但 prompt 只用到過去的資料，
+    所以可以先假設 AI 一路都回 HOLD，推算接下來會問的日子，並行送出請求。
+    猜錯 (例如 AI 說 BUY 之後進入持倉) 的結果直接丟掉即可。
+    """
+
+    def __init__(self, fetch_fn, n_days: int, hold_cooldown: int, window: int = 4, candidate_mask=None):
+        """
+        :param fetch_fn: fetch_fn(i) -> dict，實際呼叫 AI 取得第 i 天的訊號
+        :param n_days: 資料總天數 (回測只跑到 n_days - 2)
+        :param hold_cooldown: 回 HOLD 後冷卻的天數 (要跟 BacktestEngine 一致)
+        :param window: 同時預先查詢的天數 (也是並行數)
+        :param candidate_mask: 預篩結果，False 的日子不會問 AI
+        """
+        self.fetch_fn = fetch_fn
+        self.last_day = n_days - 2
+        self.hold_cooldown = hold_cooldown
+        self.window = window
+        self.candidate_mask = candidate_mask
+
+        self.executor = ThreadPoolExecutor(max_workers=window)
+        self.futures = {}  # 第幾天 -> Future
+        # 只在呼叫端 (回測) 的執行緒更新，fetch_fn 在 worker 執行緒裡跑，不碰這些計數
+        self.stats = {"window": window, "requested": 0, "used": 0, "wasted": 0}
+
+    def _is_candidate(self, i: int) -> bool:
+        return self.candidate_mask is None or bool(self.candidate_mask[i])
+
+    def _predict_days(self, i: int) -> list:
+        """
+        假設從第 i 天起 AI 都回 HOLD，推算接下來 window 個會問 AI 的日子 (含第 i 天)
+        """
+        days = [i]
+        day = i
+        while len(days) < self.window:
+            # 回 HOLD 後冷卻 N 天，之後遇到第一個通過預篩的日子才會再問
+            day += self.hold_cooldown + 1
+            while day <= self.last_day and not self._is_candidate(day):
+                day += 1
+            if day > self.last_day:
+                break
+            days.append(day)
+        return days
+
+    def __call__(self, i: int) -> dict:
+        # 比 i 早的推測結果已經用不到了
+        for day in [d for d in self.futures if d < i]:
+            future = self.futures.pop(day)
+            future.cancel()
+            self.stats["wasted"] += 1
+
+        for day in self._predict_days(i):
+            if day not in self.futures:
+                self.futures[day] = self.executor.submit(self.fetch_fn, day)
+                self.stats["requested"] += 1
+
+        future = self.futures.pop(i)
+        self.stats["used"] += 1
+        return future.result()
+
+    def close(self):
+        """
+        取消還沒開始的請求 (已經送出的會自然結束，結果丟掉)
+        """
+        self.stats["wasted"] += len(self.futures)
+        for future in self.futures.values():
+            future.cancel()
+        self.futures = {}
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -2,6 +2,10 @@
 import yfinance as yf
 import pandas as pd
 import numpy as np
+import time
+import hashlib
+from datetime import datetime, time as dtime
+from zoneinfo import ZoneInfo
 from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy.orm import Session
 from utils.stock_mapping import get_stock_name
@@ -22,10 +26,30 @@ class StockService:
         "5876", "6005" # 證券
     ]
 
+    # 選股策略代號 -> 顯示名稱
+    STRATEGY_LABELS = {
+        "MA_Cross_Major": "MA20穿過季線且站穩半年線",
+        "KD_Golden_Cross": "KD低檔黃金交叉",
+        "Volume_Explosion": "爆量長紅",
+        "RSI_Oversold": "RSI超賣(<30)",
+        "Bullish_Alignment": "均線多頭排列",
+        "MA_Entanglement": "5/10/20日均線糾結",
+        "Pullback_Within_Trend": "回檔修正(10MA>股價>20MA)",
+    }
+
+    # fetch_data 的記憶體快取 (所有 StockService 實例共用)
+    # 同一檔股票短時間內重複回測/重播時不用每次都重新下載
+    PRICE_CACHE_SECONDS = 600
+    _price_cache = {}  # (stock_id, period) -> (下載時間, DataFrame)
+
+    MARKET_TZ = ZoneInfo("Asia/Taipei")
+    # 收盤 13:30，留一點時間給資料源更新 (同 LLMResponseCache.SESSION_REFRESH)，之前當天的 K 棒都算盤中
+    SESSION_REFRESH = dtime(14, 0)
+
     def __init__(self):
         pass
 
-    def fetch_data_batch(self, tickers: list) -> dict:
+    def fetch_data_batch(self, tickers: list, period: str = "6mo") -> dict:
         """
         批次下載股票資料 (使用多執行緒加速)
         """
@@ -35,10 +59,10 @@ class StockService:
             try:
                 # 判斷上市或上櫃
                 ticker = f"{stock_id}.TW"
-                df = yf.Ticker(ticker).history(period="6mo")
+                df = yf.Ticker(ticker).history(period=period)
                 if df.empty:
                     ticker = f"{stock_id}.TWO"
-                    df = yf.Ticker(ticker).history(period="6mo")
+                    df = yf.Ticker(ticker).history(period=period)
                 
                 if not df.empty:
                     data_map[stock_id] = df
@@ -51,28 +75,25 @@ class StockService:
             
         return data_map
     
-    def check_strategies(self, df: pd.DataFrame, strategies: list) -> list:
+    def compute_strategy_signals(self, df: pd.DataFrame, strategies: list) -> pd.DataFrame:
         """
-        檢查單一股票是否符合策略，回傳符合的策略名稱列表
+        一次算出整段歷史每一天是否符合各策略 (向量化，不用逐日迴圈)
+        回傳 DataFrame: index 同 df，欄位為策略代號，值為 True/False
         """
-        if len(df) < 120: return [] # 資料太少不跑
-        
-        matched = []
-        curr = df.iloc[-1]
-        prev = df.iloc[-2]
+        close = df['Close']
 
         # --- 計算基礎指標 ---
         # 均線
-        ma5 = df['Close'].rolling(5).mean()
-        ma10 = df['Close'].rolling(10).mean()
-        ma20 = df['Close'].rolling(20).mean()
-        ma60 = df['Close'].rolling(60).mean()   # 季線
-        ma120 = df['Close'].rolling(120).mean() # 半年線
+        ma5 = close.rolling(5).mean()
+        ma10 = close.rolling(10).mean()
+        ma20 = close.rolling(20).mean()
+        ma60 = close.rolling(60).mean()   # 季線
+        ma120 = close.rolling(120).mean() # 半年線
         
         # KD
         low_9 = df['Low'].rolling(9).min()
         high_9 = df['High'].rolling(9).max()
-        rsv = (df['Close'] - low_9) / (high_9 - low_9) * 100
+        rsv = (close - low_9) / (high_9 - low_9) * 100
         k = rsv.ewm(com=2).mean()
         d = k.ewm(com=2).mean()
 
@@ -80,98 +101,153 @@ class StockService:
         vol_ma5 = df['Volume'].rolling(5).mean()
         
         # RSI
-        delta = df['Close'].diff()
+        delta = close.diff()
         gain = (delta.where(delta > 0, 0)).rolling(14).mean()
         loss = (-delta.where(delta < 0, 0)).rolling(14).mean()
         rs = gain / loss
         rsi = 100 - (100 / (1 + rs))
 
         # --- 策略邏輯判斷 ---
+        signals = {}
 
         # 1. 策略: MA20 黃金交叉 季線(MA60) 且 站上半年線(MA120) (你原本的需求)
         if "MA_Cross_Major" in strategies:
             # 條件：今天 MA20 > MA60 且 昨天 MA20 < MA60 (剛交叉) 且 收盤價 > MA120
-            cond_cross = (ma20.iloc[-1] > ma60.iloc[-1]) and (ma20.iloc[-2] <= ma60.iloc[-2])
-            cond_above_half = curr['Close'] > ma120.iloc[-1]
-            if cond_cross and cond_above_half:
-                matched.append("MA20穿過季線且站穩半年線")
+            cond_cross = (ma20 > ma60) & (ma20.shift(1) <= ma60.shift(1))
+            cond_above_half = close > ma120
+            signals["MA_Cross_Major"] = cond_cross & cond_above_half
 
         # 2. 策略: KD 黃金交叉
         if "KD_Golden_Cross" in strategies:
             # K 向上突破 D，且 D < 50 (低檔金叉比較準)
-            if k.iloc[-1] > d.iloc[-1] and k.iloc[-2] <= d.iloc[-2] and d.iloc[-1] < 50:
-                matched.append("KD低檔黃金交叉")
+            signals["KD_Golden_Cross"] = (k > d) & (k.shift(1) <= d.shift(1)) & (d < 50)
 
         # 3. 策略: 爆量長紅
         if "Volume_Explosion" in strategies:
-            # 成交量 > 5日均量 * 2 且 漲幅 > 3%
-            is_explode = curr['Volume'] > (vol_ma5.iloc[-2] * 2)
-            is_up = (curr['Close'] - prev['Close']) / prev['Close'] > 0.03
-            if is_explode and is_up:
-                matched.append("爆量長紅")
+            # 成交量 > 前一日的 5日均量 * 2 且 漲幅 > 3%
+            is_explode = df['Volume'] > (vol_ma5.shift(1) * 2)
+            is_up = (close - close.shift(1)) / close.shift(1) > 0.03
+            signals["Volume_Explosion"] = is_explode & is_up
 
         # 4. 策略: RSI 超賣反彈
         if "RSI_Oversold" in strategies:
             # RSI < 30
-            if rsi.iloc[-1] < 30:
-                matched.append("RSI超賣(<30)")
+            signals["RSI_Oversold"] = rsi < 30
 
         # 5. 策略: 均線多頭排列
         if "Bullish_Alignment" in strategies:
             # MA5 > MA20 > MA60
-            if ma5.iloc[-1] > ma20.iloc[-1] > ma60.iloc[-1]:
-                matched.append("均線多頭排列")
+            signals["Bullish_Alignment"] = (ma5 > ma20) & (ma20 > ma60)
                 
         if "MA_Entanglement" in strategies:
-            # 取得最新的均線值
-            m5 = ma5.iloc[-1]
-            m10 = ma10.iloc[-1]
-            m20 = ma20.iloc[-1]
+            # 計算三條線的最高與最低值 (任一條是 NaN 就不算)
+            ma_frame = pd.concat([ma5, ma10, ma20], axis=1)
+            max_ma = ma_frame.max(axis=1, skipna=False)
+            min_ma = ma_frame.min(axis=1, skipna=False)
             
-            # 確保數值有效 (非 NaN)
-            if pd.notna(m5) and pd.notna(m10) and pd.notna(m20):
-                # 計算三條線的最高與最低值
-                max_ma = max(m5, m10, m20)
-                min_ma = min(m5, m10, m20)
-                
-                # 計算乖離率：(最大值 - 最小值) / 最小值
-                # 設定糾結標準：差距在 2.5% 以內 (0.025)
-                entanglement_rate = (max_ma - min_ma) / min_ma
-                
-                # 額外條件：收盤價最好在均線糾結區之上 (代表蓄勢待發，而非跌破糾結)
-                price_above_ma = curr['Close'] >= min_ma
-                
-                if entanglement_rate <= 0.025 and price_above_ma:
-                    matched.append("5/10/20日均線糾結")
+            # 計算乖離率：(最大值 - 最小值) / 最小值
+            # 設定糾結標準：差距在 2.5% 以內 (0.025)
+            entanglement_rate = (max_ma - min_ma) / min_ma
+            
+            # 額外條件：收盤價最好在均線糾結區之上 (代表蓄勢待發，而非跌破糾結)
+            price_above_ma = close >= min_ma
+            signals["MA_Entanglement"] = (entanglement_rate <= 0.025) & price_above_ma
 
         if "Pullback_Within_Trend" in strategies:
             # 策略：10MA > 股價 > 20MA
             # 意義：短線回檔但守住月線支撐，可能為買點
             # 補充條件：必須是多頭排列 MA10 > MA20，確保不是空頭走勢的下跌
-            if ma10.iloc[-1] > curr['Close'] > ma20.iloc[-1] and ma10.iloc[-1] > ma20.iloc[-1]:
-                 matched.append("回檔修正(10MA>股價>20MA)")
+            signals["Pullback_Within_Trend"] = (ma10 > close) & (close > ma20) & (ma10 > ma20)
 
+        # 依照 STRATEGY_LABELS 的順序排列欄位
+        columns = [code for code in self.STRATEGY_LABELS if code in signals]
+        return pd.DataFrame({code: signals[code] for code in columns}, index=df.index, columns=columns).astype(bool)
 
-        return matched
+    def check_strategies(self, df: pd.DataFrame, strategies: list) -> list:
+        """
+        檢查單一股票是否符合策略，回傳符合的策略名稱列表
+        """
+        if len(df) < 120: return [] # 資料太少不跑
+
+        # 只看最後一天
+        latest = self.compute_strategy_signals(df, strategies).iloc[-1]
+        return [self.STRATEGY_LABELS[code] for code in latest.index if latest[code]]
 
-    def fetch_data(self, stock_id: str) -> pd.DataFrame:
+    def fetch_data(self, stock_id: str, period: str = "1y") -> pd.DataFrame:
         """
         抓取股票數據，自動判斷上市(.TW)或上櫃(.TWO)
         """
+        cached = self._price_cache.get((stock_id, period))
+        if cached and time.time() - cached[0] < self.PRICE_CACHE_SECONDS:
+            return cached[1].copy()
+
         ticker = f"{stock_id}.TW"
         stock = yf.Ticker(ticker)
-        df = stock.history(period="1y")
+        df = stock.history(period=period)
 
         if df.empty:
             ticker = f"{stock_id}.TWO"
             stock = yf.Ticker(ticker)
-            df = stock.history(period="1y")
+            df = stock.history(period=period)
         
         if df.empty:
             raise ValueError(f"無法獲取股票 {stock_id} 的數據")
-            
-        return df
+
+        self._price_cache[(stock_id, period)] = (time.time(), df)
+        return df.copy()
     
+    def price_digest(self, df: pd.DataFrame) -> str:
+        """
+        價格資料的雜湊 (日期 + OHLCV，取到小數第 4 位避免浮點誤差)
+        yfinance 還原權值調整過歷史價格時，雜湊就會不同
+        """
+        dates = "|".join(str(d.date()) for d in df.index)
+        values = np.round(df[['Open', 'High', 'Low', 'Close', 'Volume']].to_numpy(dtype=float), 4)
+        h = hashlib.sha256(dates.encode("utf-8"))
+        h.update(np.ascontiguousarray(values).tobytes())
+        return h.hexdigest()[:16]
+
+    def completed_sessions(self, df: pd.DataFrame, now: datetime = None) -> pd.DataFrame:
+        """
+        去掉盤中還在變動的當天 K 棒，只留已收盤的交易日
+        盤中 yfinance 會回傳今天到目前為止的 K 棒，拿來算雜湊或回測的話，每次抓價 (約 10 分鐘) 結果都會不同
+        """
+        if df.empty:
+            return df
+        local = (now or datetime.now(self.MARKET_TZ)).astimezone(self.MARKET_TZ)
+        if df.index[-1].date() == local.date() and local.time() < self.SESSION_REFRESH:
+            return df.iloc[:-1]
+        return df
+
+    def tail_digest(self, df: pd.DataFrame, end_date: str, bars: int = 20):
+        """
+        截至 end_date 為止最後 bars 根 K 棒的雜湊，用來確認舊的回測結果延伸時，重疊區間的價格沒有被調整過
+        df 裡找不到 end_date 時回傳 None
+        """
+        dates = [str(d.date()) for d in df.index]
+        if end_date not in dates:
+            return None
+        end = dates.index(end_date) + 1
+        return self.price_digest(df.iloc[max(end - bars, 0):end])
+
+    def tail_digests(self, df: pd.DataFrame, bars: int = 20) -> dict:
+        """
+        每一天的 tail_digest ({日期: 雜湊})，逐日比對訊號當時看到的價格是否沒變
+        """
+        return {str(df.index[end - 1].date()): self.price_digest(df.iloc[max(end - bars, 0):end]) for end in range(1, len(df) + 1)}
+
+    def resolve_tickers(self, scope: str = "TW50", custom_list: list = None) -> list:
+        """
+        依掃描範圍 (TW50, Finance, Custom) 取得股票代號清單
+        """
+        if scope == "Custom":
+            return custom_list or []
+        elif scope == "Finance":
+            return self.FINANCE_TICKERS
+        else:
+            # 預設為 TW50
+            return self.TW50_TICKERS
+
     def screen_stocks(self, strategies: list, scope: str = "TW50", custom_list: list = None) -> list:
         """
         執行選股主程式
@@ -181,18 +257,9 @@ class StockService:
         """
         
         # 1. 決定要掃描的股票清單
-        target_tickers = []
-        
-        if scope == "Custom":
-            if custom_list:
-                target_tickers = custom_list
-            else:
-                return [] # 沒給清單就回傳空
-        elif scope == "Finance":
-            target_tickers = self.FINANCE_TICKERS
-        else:
-            # 預設為 TW50
-            target_tickers = self.TW50_TICKERS
+        target_tickers = self.resolve_tickers(scope, custom_list)
+        if not target_tickers:
+            return [] # 沒給清單就回傳空
 
         stock_data = self.fetch_data_batch(target_tickers)
         
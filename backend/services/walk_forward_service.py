@@ -0,0 +1,243 @@
+# backend/services/walk_forward_service.py
+import os
+from typing import Optional
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from services.stock_service import StockService
+from services.backtest_service import BacktestService, simulate_rule_backtest
+from services.backtest_engine import BacktestEngine
+from services.analytics_service import AnalyticsService
+from services.llm_resilience import LLMRetryLaterError
+from services.ollama_pool import endpoint_pool
+
+
+def _window_result(df: pd.DataFrame, result: dict, start_index: int) -> dict:
+    """
+    只回傳摘要與資產數值，避免整段明細在行程間搬來搬去
+    """
+    return {
+        "start_date": str(df.index[start_index].date()),
+        "end_date": str(df.index[-1].date()),
+        "final_equity": result["final_equity"],
+        "total_return_pct": result["total_return_pct"],
+        "trade_count": result["trade_count"],
+        "equity": [p["equity"] for p in result["equity_curve"]],
+    }
+
+
+def _walk_forward_rule_worker(job: tuple) -> dict:
+    """
+    規則型視窗的 worker (不呼叫 AI，純 CPU)
+    """
+    window_id, config_id, df, stock_id, capital, start_index, config, flags = job
+    try:
+        result = simulate_rule_backtest(
+            df, stock_id, config.get("strategies") or [], capital,
+            config.get("stop_loss_pct", 0.05), config.get("take_profit_pct", 0.10),
+            start_index=start_index, flags=flags
+        )
+        return {"window_id": window_id, "config_id": config_id, **_window_result(df, result, start_index)}
+    except Exception as e:
+        return {"window_id": window_id, "config_id": config_id, "error": str(e)}
+
+
+class WalkForwardService:
+    """
+    Walk-forward 回測：把長期歷史切成多個滾動視窗，每個視窗分別回測，
+    看各模型/風格在不同行情 (多頭、空頭、盤整) 的表現是否穩定。
+    每個視窗 = 前面 train_days 根 K 棒當作暖身 (技術指標與 AI 看的歷史) + 後面 test_days 根實際模擬。
+    技術指標、策略訊號與預篩都先用完整歷史算好再切給各視窗，MA120 這類長週期指標不受暖身長度限制。
+    規則型視窗用滿所有 CPU (行程池)；AI 視窗在主行程的執行緒池跑，
+    跟其他 AI 請求一起經過同一個排程器 (batch 優先序)，實際同時連線數由排程器的每台 / 每個模型上限控制
+    """
+    # 同時進行的 AI 回測視窗數 (本機 Ollama 或 API 配額的上限)
+    LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "2"))
+    # 少於這個天數的尾端視窗不跑 (結果沒有參考價值)
+    MIN_TEST_DAYS = 20
+
+    def __init__(self):
+        self.stock_service = StockService()
+        self.analytics = AnalyticsService()
+        self.backtest_service = BacktestService()
+
+    def _run_ai_window(self, job: tuple) -> dict:
+        """
+        AI 視窗：逐日問 AI (在執行緒裡跑，共用主行程的排程器、斷路器與端點池)
+        視窗只在記憶體裡模擬、不讀寫資料庫，所以不需要自己的 session
+        """
+        window_id, config_id, df, stock_id, capital, start_index, config, gate_mask, api_key, ollama_url = job
+        try:
+            service = self.backtest_service
+            engine = service.engine
+            calls = {"llm": 0}
+
+            def ask_ai(i):
+                if gate_mask is not None and not gate_mask[i]:
+                    return {"action": "SKIP"}
+                calls["llm"] += 1
+                # request_signal 以 batch 優先序排隊，不會擋到互動分析
+                return service.request_signal(
+                    df, i, api_key, stock_id, config.get("provider", "gemini"), config.get("model_name"),
+                    ollama_url=ollama_url, prompt_style=config.get("prompt_style", "balanced")
+                )
+
+            state = engine.new_state(capital)
+            state["next_index"] = start_index
+            engine.run(df, state, stock_id, ask_ai)
+            result = engine.summarize(df, state, stock_id, capital)
+            return {"window_id": window_id, "config_id": config_id, "llm_calls": calls["llm"], **_window_result(df, result, start_index)}
+        except LLMRetryLaterError as e:
+            # AI 暫時無法使用，這個視窗沒有結果 (不是一路觀望)
+            return {"window_id": window_id, "config_id": config_id, "error": str(e), "retry_later": True}
+        except Exception as e:
+            return {"window_id": window_id, "config_id": config_id, "error": str(e)}
+
+    def build_windows(self, n_bars: int, train_days: int, test_days: int, step_days: Optional[int] = None) -> list:
+        """
+        切出滾動視窗 (K 棒位置)，回傳 [{"window_id", "begin", "start", "end"}]
+        begin = 暖身開始，start = 模擬開始，end = 模擬結束 (不含)
+        """
+        step = step_days or test_days
+        windows = []
+        start = train_days
+        while start < n_bars - 1:
+            end = min(start + test_days, n_bars)
+            if end - start < self.MIN_TEST_DAYS:
+                break
+            windows.append({"window_id": len(windows), "begin": start - train_days, "start": start, "end": end})
+            start += step
+        return windows
+
+    def config_label(self, config: dict) -> str:
+        if config.get("type", "rule") == "rule":
+            return "rule_" + "+".join(config.get("strategies") or [])
+        label = f"{config.get('provider')}_{config.get('model_name')}_{config.get('prompt_style', 'balanced')}"
+        if config.get("gate"):
+            label += "|gate:" + ",".join(config["gate"])
+        return label
+
+    def run(self, stock_id: str, configs: list, initial_capital: float, period: str = "5y",
+            train_days: int = 60, test_days: int = 120, step_days: Optional[int] = None,
+            api_key: str = None, ollama_url: str = None, max_workers: int = None) -> dict:
+        """
+        執行 walk-forward 回測
+        :param configs: [{"type": "rule", "strategies": [...]}, {"type": "ai", "provider": ..., "model_name": ..., "prompt_style": ...}]
+        """
+        if train_days < BacktestEngine.START_INDEX:
+            raise ValueError(f"train_days 至少要 {BacktestEngine.START_INDEX} 天 (技術指標暖身)")
+        if test_days < self.MIN_TEST_DAYS:
+            raise ValueError(f"test_days 至少要 {self.MIN_TEST_DAYS} 天")
+
+        df = self.stock_service.calculate_indicators(self.stock_service.fetch_data(stock_id, period=period))
+        windows = self.build_windows(len(df), train_days, test_days, step_days)
+        if not windows:
+            return {"error": "資料不足，無法切出回測視窗"}
+
+        # 每個設定的策略訊號 / 預篩用完整歷史算一次，各視窗只拿對應的片段
+        # (在視窗片段上重算的話，開頭只有 train_days 根 K 棒，MA60 / MA120 會是 NaN)
+        precomputed = {}
+        for config_id, config in enumerate(configs):
+            if config.get("type", "rule") == "rule":
+                precomputed[config_id] = self.stock_service.compute_strategy_signals(df, config.get("strategies") or [])
+            elif config.get("gate"):
+                precomputed[config_id] = self.backtest_service.compute_gate_mask(df, config["gate"])
+            else:
+                precomputed[config_id] = None
+
+        rule_jobs, ai_jobs = [], []
+        for w in windows:
+            begin, end = w["begin"], w["end"]
+            window_df = df.iloc[begin:end]
+            start_index = w["start"] - begin
+            for config_id, config in enumerate(configs):
+                pre = precomputed[config_id]
+                if config.get("type", "rule") == "rule":
+                    rule_jobs.append((w["window_id"], config_id, window_df, stock_id, initial_capital, start_index, config,
+                                      pre.iloc[begin:end]))
+                else:
+                    gate_mask = pre[begin:end] if pre is not None else None
+                    ai_jobs.append((w["window_id"], config_id, window_df, stock_id, initial_capital, start_index, config,
+                                    gate_mask, api_key, ollama_url))
+
+        # AI 視窗依模型排序後送出，同一個模型的視窗先跑完再換下一個 (減少 Ollama 換模型重新載入)
+        ai_jobs.sort(key=lambda job: (job[6].get("provider") or "", job[6].get("model_name") or ""))
+
+        # 規則型用行程池吃滿 CPU，AI 型用執行緒池 (排程器、斷路器等狀態是整個行程共用的，不能 fork 到子行程)
+        # 先送出規則型工作，子行程在 AI 執行緒開始之前就 fork 好
+        results = []
+        rule_pool = ProcessPoolExecutor(max_workers=max_workers) if rule_jobs else None
+        futures = [rule_pool.submit(_walk_forward_rule_worker, job) for job in rule_jobs]
+        # 有多台 Ollama (端點池) 時，同時跑的 AI 視窗跟著節點數增加
+        ai_workers = self.LLM_MAX_CONCURRENCY * max(len(endpoint_pool.urls), 1)
+        ai_pool = ThreadPoolExecutor(max_workers=ai_workers, thread_name_prefix="walk-forward-ai") if ai_jobs else None
+        try:
+            futures += [ai_pool.submit(self._run_ai_window, job) for job in ai_jobs]
+            for future in as_completed(futures):
+                results.append(future.result())
+        finally:
+            for pool in (rule_pool, ai_pool):
+                if pool:
+                    pool.shutdown(cancel_futures=True)
+
+        return self.aggregate(df, windows, configs, results)
+
+    def aggregate(self, df: pd.DataFrame, windows: list, configs: list, results: list) -> dict:
+        """
+        彙整成「每個視窗的排名」與「每個設定跨視窗的穩定度」
+        """
+        ok = [r for r in results if "error" not in r]
+        errors = [r for r in results if "error" in r]
+
+        # 一次算完所有視窗結果的 Sharpe / 最大回撤
+        curve_metrics = self.analytics.compute_curve_metrics([np.asarray(r["equity"], dtype=float) for r in ok]) if ok else {}
+        for k, r in enumerate(ok):
+            r["sharpe"] = round(float(curve_metrics["sharpe"][k]), 3)
+            r["max_drawdown_pct"] = round(float(curve_metrics["max_drawdown_pct"][k]), 2)
+            r["label"] = self.config_label(configs[r["config_id"]])
+            del r["equity"]
+
+        # 每個視窗的大盤 (買進持有) 報酬，用來判斷行情
+        closes = df["Close"].to_numpy(dtype=float)
+        window_rows = []
+        for w in windows:
+            market = (closes[w["end"] - 1] / closes[w["start"]] - 1) * 100
+            rows = sorted([r for r in ok if r["window_id"] == w["window_id"]], key=lambda r: r["total_return_pct"], reverse=True)
+            window_rows.append({
+                "window_id": w["window_id"],
+                "start_date": str(df.index[w["start"]].date()),
+                "end_date": str(df.index[w["end"] - 1].date()),
+                "market_return_pct": round(float(market), 2),
+                "results": rows
+            })
+        market_by_window = {w["window_id"]: w["market_return_pct"] for w in window_rows}
+
+        summary = []
+        for config_id, config in enumerate(configs):
+            rows = [r for r in ok if r["config_id"] == config_id]
+            if not rows:
+                continue
+            returns = np.array([r["total_return_pct"] for r in rows])
+            excess = returns - np.array([market_by_window[r["window_id"]] for r in rows])
+            summary.append({
+                "config_id": config_id,
+                "label": self.config_label(config),
+                "windows": len(rows),
+                "mean_return_pct": round(float(returns.mean()), 2),
+                "median_return_pct": round(float(np.median(returns)), 2),
+                "std_return_pct": round(float(returns.std()), 2),
+                "worst_return_pct": round(float(returns.min()), 2),
+                "positive_windows_pct": round(float(np.mean(returns > 0) * 100), 2),
+                "beat_market_pct": round(float(np.mean(excess > 0) * 100), 2),
+                "mean_sharpe": round(float(np.mean([r["sharpe"] for r in rows])), 3),
+                "max_drawdown_pct": round(float(max(r["max_drawdown_pct"] for r in rows)), 2),
+                "trade_count": int(sum(r["trade_count"] for r in rows)),
+            })
+        summary.sort(key=lambda s: s["mean_return_pct"], reverse=True)
+
+        return {
+            "window_count": len(windows),
+            "windows": window_rows,
+            "summary": summary,
+            "errors": errors
+        }
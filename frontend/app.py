@@ -1082,6 +1082,18 @@ def backtest_page():
 # ==========================================
 #  頁面 F: 回測儀表板 (新增)
 # ==========================================
+def fetch_backtest_curve(record_id):
+    """
+    取得單筆回測的資產曲線與交易明細 (列表只有摘要，用到時才查，查過的存在 session_state)
+    """
+    cache = st.session_state.setdefault("curve_cache", {})
+    if record_id not in cache:
+        res = requests.get(f"{BACKEND_URL}/api/backtest/records/{record_id}/curve")
+        if res.status_code != 200:
+            return {"equity_curve": [], "trades": []}
+        cache[record_id] = res.json()
+    return cache[record_id]
+
 def backtest_dashboard_page():
     stock_ids = []
     try:
@@ -1157,10 +1169,20 @@ def backtest_dashboard_page():
             "final_equity": res.get('final_equity', 0),
             "trades": res.get('trade_count', 0),
             "date": pd.to_datetime(r['created_at']).strftime('%Y-%m-%d %H:%M'),
-            "raw_data": res # 暫存原始資料供繪圖用
+            # 後端一次算好的績效指標
+            **(r.get('metrics') or {})
         })
     
     df_table = pd.DataFrame(table_data)
+
+    # 依指定的指標排名 (最大回撤越小越好，其餘越大越好)
+    rank_options = {
+        "return": "報酬率", "sharpe": "Sharpe", "sortino": "Sortino",
+        "max_drawdown_pct": "最大回撤", "win_rate_pct": "勝率", "exposure_pct": "持倉比例"
+    }
+    rank_options = {k: v for k, v in rank_options.items() if k in df_table.columns}
+    rank_by = st.selectbox("排名依據", list(rank_options.keys()), format_func=lambda k: rank_options[k])
+    df_table = df_table.sort_values(rank_by, ascending=(rank_by == "max_drawdown_pct"), na_position="last").reset_index(drop=True)
     
     # 使用 AgGrid 或簡單的 dataframe 加上 checkbox (這裡用 multiselect 比較簡單)
     options = df_table.apply(lambda x: f"[{x['date']}] {x['strategy']} (報酬率: {x['return']}%)", axis=1).tolist()
@@ -1180,13 +1202,19 @@ def backtest_dashboard_page():
         compare_df = pd.DataFrame(selected_rows)
         
         # 顯示比較表格
+        metric_cols = [c for c in ['sharpe', 'sortino', 'max_drawdown_pct', 'win_rate_pct', 'exposure_pct'] if c in compare_df.columns]
         st.dataframe(
-            compare_df[['strategy', 'return', 'final_equity', 'trades', 'date']],
+            compare_df[['strategy', 'return', 'final_equity', 'trades'] + metric_cols + ['date']],
             column_config={
                 "strategy": "使用模型",
                 "return": st.column_config.NumberColumn("報酬率 %", format="%.2f%%"),
                 "final_equity": st.column_config.NumberColumn("最終資產", format="$%d"),
                 "trades": "交易次數",
+                "sharpe": st.column_config.NumberColumn("Sharpe", format="%.2f"),
+                "sortino": st.column_config.NumberColumn("Sortino", format="%.2f"),
+                "max_drawdown_pct": st.column_config.NumberColumn("最大回撤 %", format="%.2f%%"),
+                "win_rate_pct": st.column_config.NumberColumn("勝率 %", format="%.1f%%"),
+                "exposure_pct": st.column_config.NumberColumn("持倉比例 %", format="%.1f%%"),
                 "date": "回測時間"
             },
             hide_index=True,
@@ -1204,7 +1232,9 @@ def backtest_dashboard_page():
         
         for index, row in compare_df.iterrows():
             # 取出這筆紀錄的資產曲線
-            curve = row['raw_data']['equity_curve'] # list of dict
+            curve = fetch_backtest_curve(row['id'])['equity_curve'] # list of dict
+            if not curve:
+                continue
             temp_df = pd.DataFrame(curve)
             temp_df['date'] = pd.to_datetime(temp_df['date'])
             temp_df.set_index('date', inplace=True)
@@ -1235,8 +1265,8 @@ def backtest_dashboard_page():
             expander_title = f"{row['strategy']} | {row['date']} | 報酬率: {row['return']}%"
             
             with st.expander(expander_title):
-                # 從 raw_data 取出交易列表
-                trades_list = row['raw_data'].get('trades', [])
+                # 交易列表跟資產曲線一起查回來
+                trades_list = fetch_backtest_curve(row['id']).get('trades', [])
                 
                 if trades_list:
                     df_trades = pd.DataFrame(trades_list)
@@ -1269,6 +1299,57 @@ def backtest_dashboard_page():
                 else:
                     st.info("此策略在回測期間選擇觀望，沒有進行任何交易。")
 
+        # --- 比較區塊 3: Monte Carlo 穩健度測試 ---
+        st.divider()
+        st.subheader("🎲 穩健度測試 (Monte Carlo)")
+        st.caption("把交易重新抽樣上千次，看報酬與回撤的分布，判斷結果是否只是運氣好")
+
+        mc_col1, mc_col2, mc_col3 = st.columns(3)
+        with mc_col1:
+            mc_method = st.selectbox("抽樣方式", ["bootstrap", "shuffle"], format_func=lambda m: {"bootstrap": "重複抽樣", "shuffle": "打亂順序"}[m])
+        with mc_col2:
+            mc_paths = st.number_input("路徑數", min_value=100, max_value=20000, value=1000, step=100)
+        with mc_col3:
+            mc_ruin = st.slider("破產門檻 (虧損 %)", 10, 90, 50)
+
+        if st.button("執行穩健度測試"):
+            payload = {
+                "record_ids": [int(i) for i in compare_df['id']],
+                "n_paths": int(mc_paths),
+                "method": mc_method,
+                "ruin_pct": mc_ruin / 100
+            }
+            with st.spinner("模擬中..."):
+                res = requests.post(f"{BACKEND_URL}/api/backtest/montecarlo", json=payload)
+            if res.status_code == 200:
+                mc = res.json()
+                st.dataframe(
+                    pd.DataFrame([{
+                        "strategy": g['strategy'],
+                        "records": g['record_count'],
+                        "p5": g['return_pct']['p5'],
+                        "p50": g['return_pct']['p50'],
+                        "p95": g['return_pct']['p95'],
+                        "mdd_p95": g['max_drawdown_pct']['p95'],
+                        "loss_prob": g['loss_prob'] * 100,
+                        "ruin_prob": g['ruin_prob'] * 100
+                    } for g in mc['groups']]),
+                    column_config={
+                        "strategy": "模型 / 風格",
+                        "records": "紀錄數",
+                        "p5": st.column_config.NumberColumn("報酬 P5 %", format="%.2f%%"),
+                        "p50": st.column_config.NumberColumn("報酬中位數 %", format="%.2f%%"),
+                        "p95": st.column_config.NumberColumn("報酬 P95 %", format="%.2f%%"),
+                        "mdd_p95": st.column_config.NumberColumn("回撤 P95 %", format="%.2f%%"),
+                        "loss_prob": st.column_config.NumberColumn("虧損機率", format="%.1f%%"),
+                        "ruin_prob": st.column_config.NumberColumn("破產機率", format="%.1f%%")
+                    },
+                    hide_index=True,
+                    use_container_width=True
+                )
+            else:
+                st.error(f"模擬失敗: {res.text}")
+
 # ==========================================
 #  頁面 G: 自動化全策略回測 (新增)
 # ==========================================